@@ -0,0 +1,12 @@
+# (C) Copyright 2012-2019 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""Benchmarks of SkinnyWMS. They are not part of the package, and are run
+from the top of the source tree, e.g. 'python -m benchmarks.load --help'.
+
+"""
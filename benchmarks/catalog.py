@@ -0,0 +1,296 @@
+# (C) Copyright 2012-2019 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""Scale and memory benchmark of the catalog.
+
+Catalogs of synthetic `GRIBField` (with the same attributes as the fields
+of real GRIB files, but without reading any file) are built with
+`Availability.add_field`, each size in a new process. For each size:
+
+- build: time to add the fields, and the growth of the RSS
+- types: memory held by the catalog, by type of object (the objects shared
+  between fields, such as the styles, are only counted once)
+- allocations: with --tracemalloc, where the memory of the catalog was
+  allocated, by line of code
+- layers, layer, capabilities: time of `Availability.layers()`, of the
+  lookup of a layer at a given time, and of rendering the capabilities
+
+e.g. python -m benchmarks.catalog --sizes 10000,100000,1000000 --tracemalloc
+
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import gc
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+import tracemalloc
+import types
+
+import jinja2
+
+from benchmarks import report
+from skinnywms import datatypes
+from skinnywms.fields.GRIBField import GRIBField
+from skinnywms.plot.fake import FakeDriver
+from skinnywms.plot.magics import Plotter, Styler
+from skinnywms.server import WMSServer
+
+__all__ = [
+    "FakeGrib",
+    "measure",
+]
+
+LOG = logging.getLogger(__name__)
+
+TEMPLATES = os.path.join(os.path.dirname(datatypes.__file__), "templates")
+
+PARAMS = ("t", "z", "u", "v", "r", "q", "w", "d", "vo", "pv")
+LEVELS = (1000, 925, 850, 700, 600, 500, 400, 300, 250, 200, 150, 100, 50)
+
+# Objects not owned by the catalog
+SKIP = (
+    type,
+    types.ModuleType,
+    types.FunctionType,
+    types.BuiltinFunctionType,
+    types.CodeType,
+    jinja2.Environment,
+)
+
+
+class FakeGrib:
+    """The keys of a GRIB message read by `GRIBField`. As when they are read
+    from a file, all the strings are distinct objects.
+
+    """
+
+    def __init__(self, param, level, base, step, offset):
+        self.offset = offset
+        self.shortName = "".join(param)
+        self.name = "Parameter %s" % (param,)
+        self.levtype = "pl"
+        self.levelist = level
+        self.valid_date = base + datetime.timedelta(hours=step)
+        self.mars_request = {
+            "domain": "g",
+            "levtype": "pl",
+            "levelist": str(level),
+            "date": base.strftime("%Y%m%d"),
+            "time": base.strftime("%H%M"),
+            "step": str(step),
+            "param": "%s" % (param,),
+            "class": "od",
+            "type": "fc",
+            "stream": "oper",
+            "expver": "0001",
+        }
+
+
+def fields(count, context):
+    """Generate `count` fields of all the parameters and levels, with one
+    file per hourly step.
+
+    """
+    base = datetime.datetime(2022, 5, 1)
+    layers = [(p, level) for p in PARAMS for level in LEVELS]
+    path = None
+    for i in range(count):
+        step, index = divmod(i, len(layers))
+        if index == 0:
+            path = "/data/synthetic/%s/step_%04d.grib" % (base.strftime("%Y%m%d"), step)
+        param, level = layers[index]
+        grib = FakeGrib(param, level, base, step, offset=index * 100000)
+        yield GRIBField(context, path, grib, index)
+
+
+def rss():
+    """The resident set size of the process, in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # The maximum, not the current one
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def sizes_by_type(root):
+    """The size of all the objects reachable from `root`, by type."""
+    sizes = collections.defaultdict(lambda: [0, 0])
+    seen = set()
+    stack = [root]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, SKIP):
+            continue
+        seen.add(id(obj))
+
+        entry = sizes[type(obj).__name__]
+        entry[0] += 1
+        entry[1] += sys.getsizeof(obj)
+
+        if isinstance(obj, types.MethodType):
+            stack.append(obj.__self__)
+        else:
+            stack.extend(gc.get_referents(obj))
+
+    result = {
+        name: dict(count=count, bytes=size)
+        for name, (count, size) in sorted(sizes.items(), key=lambda x: -x[1][1])
+    }
+    return result
+
+
+def make_server(styles):
+    driver = FakeDriver(
+        styles=[
+            dict(name="style_%d" % (i,), title="Style %d" % (i,), description="")
+            for i in range(styles)
+        ]
+    )
+    return WMSServer(
+        datatypes.Availability(), Plotter(driver=driver), Styler(driver=driver)
+    )
+
+
+def build(server, count):
+    availability = server.availability
+    for field in fields(count, server):
+        availability.add_field(field)
+    return availability
+
+
+def measure(count, styles=10, with_tracemalloc=False, lookups=1000):
+    """Build a catalog of `count` fields, and return its measurements."""
+    logging.getLogger("skinnywms").setLevel(logging.WARNING)
+    server = make_server(styles)
+
+    gc.collect()
+    before = rss()
+    start = time.perf_counter()
+    availability = build(server, count)
+    seconds = time.perf_counter() - start
+    gc.collect()
+    after = rss()
+
+    result = dict(
+        fields=count,
+        build=dict(
+            seconds=seconds,
+            fields_per_second=count / seconds,
+            rss_bytes=after - before,
+            rss_bytes_per_field=(after - before) / count,
+        ),
+    )
+
+    result["types"] = sizes_by_type(availability)
+    result["catalog_bytes"] = sum(t["bytes"] for t in result["types"].values())
+
+    layers = availability.layers()
+    result["layers"] = dict(
+        count=len(layers),
+        microseconds=report.timer(availability.layers) * 1e6,
+    )
+
+    rng = random.Random(0)
+    steps = count // len(layers)
+    base = datetime.datetime(2022, 5, 1)
+    queries = []
+    for _ in range(lookups):
+        when = base + datetime.timedelta(hours=rng.randrange(steps))
+        queries.append((rng.choice(layers).name, dict(time=when.isoformat())))
+    start = time.perf_counter()
+    for name, dims in queries:
+        availability.layer(name, dims)
+    result["layer"] = dict(
+        microseconds=(time.perf_counter() - start) / lookups * 1e6
+    )
+
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATES))
+
+    def render_template(name, **variables):
+        return env.get_template(name).render(**variables)
+
+    start = time.perf_counter()
+    content_type, content = server.get_capabilities(
+        "1.3.0", "http://localhost/wms", render_template
+    )
+    result["capabilities"] = dict(
+        seconds=time.perf_counter() - start, bytes=len(content)
+    )
+
+    if with_tracemalloc:
+        del layers, availability
+        server = make_server(styles)
+        tracemalloc.start(1)
+        build(server, count)
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        result["allocations"] = [
+            dict(
+                where="%s:%s" % (stat.traceback[0].filename, stat.traceback[0].lineno),
+                bytes=stat.size,
+                count=stat.count,
+            )
+            for stat in snapshot.statistics("lineno")[:20]
+        ]
+
+    return result
+
+
+def _sizes(text):
+    return [int(float(x)) for x in text.split(",") if x]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sizes",
+        type=_sizes,
+        default="10000,100000,1000000",
+        help="Comma separated numbers of fields",
+    )
+    parser.add_argument(
+        "--styles", type=int, default=10, help="Number of styles per layer"
+    )
+    parser.add_argument(
+        "--tracemalloc",
+        action="store_true",
+        help="Also report where the memory is allocated (builds each catalog twice)",
+    )
+    parser.add_argument("-o", "--output", help="Where to write the JSON results")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    results = {}
+    for count in args.sizes:
+        LOG.info("Catalog of %s fields", count)
+        # A new process for each size, so that the RSS of one size does not
+        # include the memory kept by the allocators for the previous one
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            results[str(count)] = pool.submit(
+                measure, count, args.styles, args.tracemalloc
+            ).result()
+
+    options = dict(sizes=args.sizes, styles=args.styles, tracemalloc=args.tracemalloc)
+    report.write(report.document("catalog", options, results), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+# (C) Copyright 2012-2019 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""Micro-benchmarks of the ctypes GRIB bindings and of the scan of GRIB
+files, which is what the server spends its startup time on.
+
+- keys: cost of `grib_get` per key, by native type, and of the typed
+  getters, which skip the lookup of the native type
+- mars: cost of `grib_get_keys_values(handle, "mars")`
+- decode: throughput of `grib_values`, and of `grib_decode` into a
+  preallocated float32 array
+- iterate: messages per second of `GribFile`, reading the whole messages,
+  reading the headers only, and creating the handles from a file read at
+  once in memory
+- scan: time per message of `GRIBReader.get_fields` followed by the
+  lookup of the styles of the fields (as done by the first GetCapabilities),
+  with the styles not yet (cold) or already in the stash (warm), and
+  without styles
+
+e.g. python -m benchmarks.grib data/ecmwf/20220501/00/A_HDXA25ECMW*.bin
+
+"""
+
+import argparse
+import ctypes
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks import report, synthetic
+from skinnywms.fields.GRIBField import GRIBReader
+from skinnywms.grib_bindings import GribFile, bindings
+
+__all__ = [
+    "decode",
+    "iterate",
+    "keys",
+    "mars",
+    "scan",
+]
+
+LOG = logging.getLogger(__name__)
+
+BENCHMARKS = ("keys", "mars", "decode", "iterate", "scan")
+
+TYPE_NAMES = {1: "long", 2: "double", 3: "string"}
+
+TYPED_GETTERS = {
+    1: bindings.grib_get_long,
+    2: bindings.grib_get_double,
+    3: bindings.grib_get_string,
+}
+
+# The keys read by GRIBField and GribField when scanning
+KEYS = (
+    "shortName",
+    "name",
+    "levtype",
+    "levelist",
+    "gridType",
+    "date",
+    "time",
+    "step",
+    "stepUnits",
+    "Ni",
+    "Nj",
+    "scanningMode",
+    "numberOfDataPoints",
+    "latitudeOfFirstGridPointInDegrees",
+    "longitudeOfFirstGridPointInDegrees",
+    "missingValue",
+)
+
+
+def _first_handle(path, headers_only=False):
+    f = bindings.grib_file_open(path)
+    try:
+        handle = f.next(headers_only)
+    finally:
+        f.close()
+    if not handle:
+        raise ValueError("No GRIB message in %s" % (path,))
+    return handle
+
+
+def keys(path):
+    """Cost of reading each key of the first message, in microseconds."""
+    handle = _first_handle(path)
+    result = dict(keys={}, types={})
+    try:
+        for name in KEYS:
+            try:
+                native = bindings.grib_get_native_type(handle, name)
+                bindings.grib_get(handle, name)
+            except bindings.GribError:
+                continue
+            typed = TYPED_GETTERS.get(native)
+            entry = dict(
+                type=TYPE_NAMES.get(native, str(native)),
+                grib_get=report.timer(lambda: bindings.grib_get(handle, name)) * 1e6,
+            )
+            if typed is not None:
+                entry["typed"] = report.timer(lambda: typed(handle, name)) * 1e6
+            result["keys"][name] = entry
+
+        for native, type_name in TYPE_NAMES.items():
+            costs = [e for e in result["keys"].values() if e["type"] == type_name]
+            if costs:
+                result["types"][type_name] = dict(
+                    keys=len(costs),
+                    grib_get=float(np.mean([e["grib_get"] for e in costs])),
+                    typed=float(np.mean([e["typed"] for e in costs])),
+                )
+    finally:
+        bindings.grib_handle_delete(handle)
+    return result
+
+
+def mars(path):
+    """Cost of reading the mars namespace of the first message, compared to
+    reading the same keys one by one.
+
+    """
+    handle = _first_handle(path)
+    try:
+        request = bindings.grib_get_keys_values(handle, "mars")
+
+        def one_by_one():
+            return {name: bindings.grib_get_string(handle, name) for name in request}
+
+        return dict(
+            keys=len(request),
+            namespace=report.timer(
+                lambda: bindings.grib_get_keys_values(handle, "mars")
+            )
+            * 1e6,
+            one_by_one=report.timer(one_by_one) * 1e6,
+        )
+    finally:
+        bindings.grib_handle_delete(handle)
+
+
+def decode(path):
+    """Decoding throughput of the first message, in MB/s of decoded values
+    and of encoded message.
+
+    """
+    handle = _first_handle(path)
+    try:
+        size = bindings.grib_get_size(handle, "values")
+        encoded = bindings.grib_get_long(handle, "totalLength")
+        out = np.empty((size,), dtype=np.float32)
+
+        # Some packings (e.g. grid_jpeg) are only decoded in double precision
+        # by ecCodes, and grib_decode then converts them to float32
+        result = dict(
+            points=size,
+            message_bytes=encoded,
+            packing=bindings.grib_get_string(handle, "packingType"),
+        )
+        for name, func, itemsize in (
+            ("grib_values", lambda: bindings.grib_values(handle), 8),
+            ("grib_decode_float32", lambda: bindings.grib_decode(handle, out=out), 4),
+        ):
+            seconds = report.timer(func, repeat=3, min_time=0.2)
+            result[name] = dict(
+                milliseconds=seconds * 1e3,
+                decoded_mb_per_second=size * itemsize / seconds / 1e6,
+                encoded_mb_per_second=encoded / seconds / 1e6,
+            )
+        return result
+    finally:
+        bindings.grib_handle_delete(handle)
+
+
+def _messages(data):
+    """Offsets and lengths of the GRIB messages in `data`, read from their
+    section 0.
+
+    """
+    offset = data.find(b"GRIB")
+    while offset >= 0:
+        edition = data[offset + 7]
+        if edition == 1:
+            # Large GRIB 1 messages (> 8MB) are not supported here
+            length = int.from_bytes(data[offset + 4 : offset + 7], "big")
+        else:
+            length = int.from_bytes(data[offset + 8 : offset + 16], "big")
+        yield offset, length
+        offset = data.find(b"GRIB", offset + length)
+
+
+def _in_memory(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    buffer = ctypes.create_string_buffer(data, len(data))
+    base = ctypes.addressof(buffer)
+    count = 0
+    for offset, length in _messages(data):
+        # No copy, the handles point into the buffer
+        handle = bindings.grib_handle_new_from_message(base + offset, length)
+        bindings.grib_get_long(handle, "level")
+        bindings.grib_handle_delete(handle)
+        count += 1
+    return count
+
+
+def _iterate(path, headers_only):
+    count = 0
+    for field in GribFile(path, headers_only=headers_only):
+        field.level
+        count += 1
+    return count
+
+
+def iterate(paths):
+    """Messages per second when iterating over the files, reading one key
+    of each message.
+
+    """
+    size = sum(os.path.getsize(path) for path in paths)
+    result = dict(files=len(paths), bytes=size)
+
+    # So that the first method is not the only one reading from the disk
+    for path in paths:
+        with open(path, "rb") as f:
+            while f.read(1024 * 1024):
+                pass
+
+    for name, func in (
+        ("gribfile", lambda path: _iterate(path, False)),
+        ("gribfile_headers_only", lambda path: _iterate(path, True)),
+        ("in_memory", _in_memory),
+    ):
+        start = time.perf_counter()
+        count = sum(func(path) for path in paths)
+        seconds = time.perf_counter() - start
+        result["messages"] = count
+        result[name] = dict(
+            seconds=seconds,
+            messages_per_second=count / seconds,
+            mb_per_second=size / seconds / 1e6,
+        )
+    return result
+
+
+class Context:
+    """The parts of `WMSServer` used by `GRIBReader`."""
+
+    def __init__(self, styler):
+        self.styler = styler
+        self.stash = {}
+
+
+class NoStyles:
+    def grib_styles(self, field, grib, path, index):
+        return []
+
+
+def _scan(context, path):
+    fields = GRIBReader(context, path).get_fields()
+    for field in fields:
+        field.styles
+    return len(fields)
+
+
+def scan(paths, styles=True):
+    """Time per message of `GRIBReader.get_fields()` and of the styles."""
+    stylers = dict(no_styles=NoStyles)
+    if styles:
+        from skinnywms.plot.magics import Styler
+
+        stylers = dict(styles=Styler, no_styles=NoStyles)
+
+    result = {}
+    for name, styler in stylers.items():
+        context = Context(styler())
+        for run in ("cold", "warm"):
+            start = time.perf_counter()
+            count = sum(_scan(context, path) for path in paths)
+            seconds = time.perf_counter() - start
+            result["%s_%s" % (name, run)] = dict(
+                seconds=seconds,
+                messages=count,
+                milliseconds_per_message=seconds / count * 1e3,
+            )
+            if name == "no_styles":
+                # Nothing is stashed
+                break
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        help="GRIB files to use, instead of a synthetic dataset",
+    )
+    synthetic.add_arguments(parser)
+    parser.add_argument(
+        "--benchmarks",
+        default=",".join(BENCHMARKS),
+        help="Comma separated benchmarks to run, among %s" % (", ".join(BENCHMARKS),),
+    )
+    parser.add_argument(
+        "--no-styles",
+        action="store_true",
+        help="Do not look up the styles with Magics when scanning",
+    )
+    parser.add_argument("-o", "--output", help="Where to write the JSON results")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("skinnywms").setLevel(logging.WARNING)
+
+    dataset = synthetic.dataset_from_args(args)
+    root = None
+    paths = args.paths
+    if not paths:
+        root = tempfile.mkdtemp(prefix="skinnywms-benchmark-")
+        paths = synthetic.generate(root, dataset, "grib")
+
+    benchmarks = dict(
+        keys=lambda: keys(paths[0]),
+        mars=lambda: mars(paths[0]),
+        decode=lambda: decode(paths[0]),
+        iterate=lambda: iterate(paths),
+        scan=lambda: scan(paths, styles=not args.no_styles),
+    )
+
+    names = synthetic._list(args.benchmarks)
+    results = {}
+    try:
+        for name in BENCHMARKS:
+            if name in names:
+                LOG.info("Benchmark %s", name)
+                results[name] = benchmarks[name]()
+    finally:
+        if root is not None:
+            shutil.rmtree(root)
+
+    options = dict(paths=args.paths or None, benchmarks=names)
+    if not args.paths:
+        options["dataset"] = dataset.as_dict()
+    report.write(report.document("grib", options, results), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,377 @@
+# (C) Copyright 2012-2019 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""End to end benchmark of the WMS application, on a synthetic dataset.
+
+The requests are sent by `--concurrency` threads, either through the Flask
+test client, or over HTTP to a server started in this process. For each
+scenario, the throughput and the latency percentiles are reported as JSON:
+
+- cold_scan: first GetCapabilities of a new application, which scans the
+  dataset and resolves the styles of every field
+- getcapabilities: GetCapabilities once the catalog is loaded
+- getmap_cold: the first GetMap of each layer, in a new application
+- getmap_warm: the same requests again
+- legends: GetLegendGraphic of every style of every layer
+- animation: GetMap of one layer for every time of the dataset
+
+e.g. python -m benchmarks.load --concurrency 8 --steps 0/120/6 -o result.json
+
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import logging
+import re
+import shutil
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+from contextlib import contextmanager
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+from benchmarks import report, synthetic
+from skinnywms.grib_bindings import cache
+from skinnywms.wmssvr import create_app
+
+__all__ = [
+    "Benchmark",
+    "HTTPClient",
+    "TestClient",
+    "run",
+]
+
+LOG = logging.getLogger(__name__)
+
+WMS = "{http://www.opengis.net/wms}"
+
+SCENARIOS = (
+    "cold_scan",
+    "getcapabilities",
+    "getmap_cold",
+    "getmap_warm",
+    "legends",
+    "animation",
+)
+
+
+class TestClient:
+    """Send the requests through the Flask test client, i.e. without any
+    HTTP server or network in between.
+
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    @contextmanager
+    def started(self):
+        yield self
+
+    def get(self, url):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.get(url)
+        return response.status_code, response.get_data()
+
+
+class HTTPClient:
+    """Send the requests to a threaded HTTP server started in this process."""
+
+    def __init__(self, app, host="127.0.0.1", port=0):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.base = None
+
+    @contextmanager
+    def started(self):
+        from werkzeug.serving import make_server
+
+        server = make_server(self.host, self.port, self.app, threaded=True)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.base = "http://%s:%s" % (self.host, server.server_port)
+        try:
+            yield self
+        finally:
+            server.shutdown()
+            thread.join()
+
+    def get(self, url):
+        try:
+            with urlopen(self.base + url) as response:
+                return response.status, response.read()
+        except HTTPError as exc:
+            return exc.code, exc.read()
+
+
+CLIENTS = {
+    "test": TestClient,
+    "http": HTTPClient,
+}
+
+
+def run(client, urls, concurrency=1):
+    """Get all the `urls` with `concurrency` threads, and return the
+    throughput and latency summary.
+
+    """
+
+    def get(url):
+        start = time.perf_counter()
+        status, content = client.get(url)
+        return time.perf_counter() - start, status, len(content)
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(get, urls))
+    seconds = time.perf_counter() - start
+
+    errors = [status for _, status, _ in results if status != 200]
+    if errors:
+        LOG.warning("%s requests failed, statuses %s", len(errors), set(errors))
+
+    result = report.summary(
+        [latency for latency, _, _ in results], seconds, errors=len(errors)
+    )
+    result["bytes"] = sum(size for _, _, size in results)
+    return result
+
+
+def _duration(text):
+    match = re.fullmatch(r"P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?", text)
+    if match is None:
+        raise ValueError("Unsupported period %s" % (text,))
+    days, hours, minutes, seconds = (int(x or 0) for x in match.groups())
+    return datetime.timedelta(
+        days=days, hours=hours, minutes=minutes, seconds=seconds
+    )
+
+
+def _parse_time(text):
+    return datetime.datetime.strptime(text, "%Y-%m-%dT%H:%M:%SZ")
+
+
+def _format_time(value):
+    return value.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def dimension_values(text):
+    """Expand the values of a WMS dimension, e.g. 'start/end/PT6H,other'."""
+    values = []
+    for part in text.split(","):
+        part = part.strip()
+        if part.count("/") == 2:
+            start, end, period = part.split("/")
+            value, end, period = _parse_time(start), _parse_time(end), _duration(period)
+            while value <= end:
+                values.append(_format_time(value))
+                value += period
+        elif part:
+            values.append(part)
+    return values
+
+
+def layers(capabilities):
+    """The named layers of a capabilities document, as a list of
+    (name, times, styles).
+
+    """
+    result = []
+    for layer in ET.fromstring(capabilities).iter(WMS + "Layer"):
+        name = layer.findtext(WMS + "Name")
+        if not name:
+            continue
+        times = []
+        for dimension in layer.findall(WMS + "Dimension"):
+            if dimension.get("name") == "time":
+                times = dimension_values(dimension.text or "")
+        styles = [s.findtext(WMS + "Name") for s in layer.findall(WMS + "Style")]
+        result.append((name, times, styles))
+    return result
+
+
+class Benchmark:
+    def __init__(self, root, dataset, client="test", concurrency=1, size=(512, 256)):
+        self.root = root
+        self.dataset = dataset
+        self.client = client
+        self.concurrency = concurrency
+        self.size = size
+
+    def url(self, **params):
+        # The run first, as the WMS parameters are not case sensitive and
+        # the last 'time' or 'TIME' is the one used for the dimension
+        query = dict(
+            model=self.dataset.model,
+            date=self.dataset.date,
+            time=self.dataset.time,
+            service="WMS",
+            version="1.3.0",
+        )
+        query.update(params)
+        return "/wms?" + urlencode(query)
+
+    def getmap(self, layer, time=None, style=""):
+        params = dict(
+            request="GetMap",
+            layers=layer,
+            styles=style,
+            crs="EPSG:4326",
+            bbox="-90,-180,90,180",
+            width=self.size[0],
+            height=self.size[1],
+            format="image/png",
+            transparent="true",
+        )
+        if time is not None:
+            # The lower case 'time' selects the run of the dataset
+            params["TIME"] = time
+        return self.url(**params)
+
+    @contextmanager
+    def client_for(self, app):
+        with CLIENTS[self.client](app).started() as client:
+            yield client
+
+    def new_app(self):
+        for geometry_cache in cache.CACHES:
+            geometry_cache.clear()
+        return create_app(dict(data_root=self.root))
+
+    def layers(self, client):
+        status, capabilities = client.get(self.url(request="GetCapabilities"))
+        if status != 200:
+            raise RuntimeError("GetCapabilities failed with status %s" % (status,))
+        return [
+            layer
+            for layer in layers(capabilities)
+            if layer[0] != "background" and layer[1]
+        ]
+
+    def cold_scan(self, runs=3):
+        latencies = []
+        for _ in range(runs):
+            with self.client_for(self.new_app()) as client:
+                start = time.perf_counter()
+                client.get(self.url(request="GetCapabilities"))
+                latencies.append(time.perf_counter() - start)
+        result = report.summary(latencies)
+        result["fields_per_second"] = self.dataset.fields / min(latencies)
+        return result
+
+    def scenarios(self, names, requests=100):
+        results = {}
+
+        if "cold_scan" in names:
+            LOG.info("Scenario cold_scan")
+            results["cold_scan"] = self.cold_scan()
+
+        with self.client_for(self.new_app()) as client:
+            available = self.layers(client)
+            LOG.info("%s layers", len(available))
+
+            first = [self.getmap(name, times[0]) for name, times, _ in available]
+            legends = [
+                self.url(
+                    request="GetLegendGraphic",
+                    layer=name,
+                    style=style,
+                    width=500,
+                    height=125,
+                    format="image/png",
+                )
+                for name, _, styles in available
+                for style in styles
+            ]
+            name, times, _ = available[0]
+            animation = [self.getmap(name, t) for t in times]
+
+            urls = dict(
+                getcapabilities=[self.url(request="GetCapabilities")] * requests,
+                getmap_cold=first,
+                getmap_warm=first,
+                legends=legends,
+                animation=animation,
+            )
+
+            if "getmap_warm" in names and "getmap_cold" not in names:
+                run(client, first, concurrency=self.concurrency)
+
+            for scenario in SCENARIOS:
+                if scenario in names and scenario in urls:
+                    LOG.info("Scenario %s, %s requests", scenario, len(urls[scenario]))
+                    results[scenario] = run(
+                        client, urls[scenario], concurrency=self.concurrency
+                    )
+
+        return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    synthetic.add_arguments(parser)
+    parser.add_argument(
+        "--data-root",
+        help="Use the dataset already generated in this data root",
+    )
+    parser.add_argument("--client", choices=sorted(CLIENTS), default="test")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=100,
+        help="Number of requests of the GetCapabilities scenario",
+    )
+    parser.add_argument(
+        "--scenarios",
+        default=",".join(SCENARIOS),
+        help="Comma separated scenarios to run, among %s" % (", ".join(SCENARIOS),),
+    )
+    parser.add_argument("-o", "--output", help="Where to write the JSON results")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    # The scan logs every file
+    logging.getLogger("skinnywms").setLevel(logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    dataset = synthetic.dataset_from_args(args)
+    root = args.data_root or tempfile.mkdtemp(prefix="skinnywms-benchmark-")
+    try:
+        if args.data_root is None:
+            synthetic.generate(root, dataset, args.format)
+
+        benchmark = Benchmark(
+            root, dataset, client=args.client, concurrency=args.concurrency
+        )
+        names = set(synthetic._list(args.scenarios))
+        results = benchmark.scenarios(names, requests=args.requests)
+    finally:
+        if args.data_root is None:
+            shutil.rmtree(root)
+
+    options = dict(
+        dataset=dataset.as_dict(),
+        format=args.format,
+        client=args.client,
+        concurrency=args.concurrency,
+        requests=args.requests,
+    )
+    report.write(report.document("load", options, results), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+# (C) Copyright 2012-2019 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""Benchmark of the GetMap pipeline of the server, on a synthetic dataset.
+
+With the fake driver (the default), nothing is rendered and what is
+measured is the overhead of SkinnyWMS itself; with '--driver magics', the
+same requests are rendered by Magics, for comparison. Reported:
+
+- steps: time of each step of a GetMap, in microseconds: parsing the
+  parameters, resolving the layer (`get_map` lookup), building the `mmap`
+  parameters, creating and deleting the output file, `send_file`, and the
+  whole `Plotter.plot`
+- requests: latency of GetMap requests through the Flask test client, with
+  the breakdown of their Server-Timing headers (in milliseconds)
+
+e.g. python -m benchmarks.render --requests 200 --driver magics
+
+"""
+
+import argparse
+import logging
+import shutil
+import tempfile
+import time
+from urllib.parse import urlencode
+
+import flask
+import numpy as np
+
+from benchmarks import report, synthetic
+from skinnywms import protocol
+from skinnywms.plot.fake import FakeDriver
+from skinnywms.server import TmpFile
+from skinnywms.wmssvr import create_app, dataset_location
+
+__all__ = [
+    "requests",
+    "steps",
+]
+
+LOG = logging.getLogger(__name__)
+
+DRIVERS = ("fake", "magics")
+
+
+def _params(layer, time, width=512, height=256):
+    return dict(
+        service="WMS",
+        version="1.3.0",
+        request="GetMap",
+        layers=layer,
+        styles="",
+        crs="EPSG:4326",
+        bbox="-90,-180,90,180",
+        width=width,
+        height=height,
+        format="image/png",
+        transparent="true",
+        TIME=time,
+    )
+
+
+def steps(app, server, layer, time):
+    """Time each step of a GetMap, in microseconds."""
+    args = _params(layer, time)
+    plotter = server.plotter
+    result = {}
+
+    def parse():
+        params, _ = protocol.filter_wms_params(args)
+        return protocol.get_wms_parameters("getmap", "1.3.0", params)
+
+    result["parse"] = report.timer(parse)
+
+    params = parse()
+    dims = dict(time=params.get("time"), elevation=None, dim_index=None)
+    result["lookup"] = report.timer(lambda: server.availability.layer(layer, dims))
+
+    result["mmap"] = report.timer(
+        lambda: plotter.mmap([-180, -90, 180, 90], 512, 256, "EPSG:4326", 0.0)
+    )
+
+    def output():
+        tmp = TmpFile()
+        tmp.target("png")
+        tmp.cleanup()
+
+    result["output"] = report.timer(output)
+
+    tmp = TmpFile()
+    path = tmp.target("png")
+    with open(path, "wb") as f:
+        f.write(FakeDriver().image)
+
+    def send_file():
+        with app.test_request_context():
+            response = flask.send_file(path, "image/png")
+            response.direct_passthrough = False
+            response.get_data()
+            response.close()
+
+    result["send_file"] = report.timer(send_file)
+    tmp.cleanup()
+
+    layer_obj = server.availability.layer(layer, dims)
+
+    def plot():
+        output = TmpFile()
+        plotter.plot(
+            server,
+            output,
+            [-90, -180, 90, 180],
+            "EPSG:4326",
+            "image/png",
+            256,
+            [layer_obj],
+            [""],
+            "1.3.0",
+            512,
+            True,
+        )
+        output.cleanup()
+
+    result["plot"] = report.timer(plot, repeat=3)
+
+    return {name: seconds * 1e6 for name, seconds in result.items()}
+
+
+def _server_timing(header):
+    result = {}
+    for entry in header.split(","):
+        name, _, duration = entry.strip().partition(";dur=")
+        result[name] = float(duration)
+    return result
+
+
+def requests(app, dataset, layers, count):
+    """Send `count` GetMap requests through the test client, cycling over
+    the layers and times.
+
+    """
+    client = app.test_client()
+    latencies = []
+    timings = {}
+    for i in range(count):
+        layer, times = layers[i % len(layers)]
+        # The run first, as the WMS parameters are not case sensitive and
+        # the last 'time' or 'TIME' is the one used for the dimension
+        query = dict(model=dataset.model, date=dataset.date, time=dataset.time)
+        query.update(_params(layer, times[(i // len(layers)) % len(times)]))
+        start = time.perf_counter()
+        response = client.get("/wms?" + urlencode(query))
+        response.get_data()
+        latencies.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            raise RuntimeError("GetMap failed: %s" % (response.get_data()[:500],))
+
+        for name, ms in _server_timing(response.headers["Server-Timing"]).items():
+            timings.setdefault(name, []).append(ms)
+
+    result = report.summary(latencies, sum(latencies))
+    result["server_timing"] = {
+        name: float(np.mean(values)) for name, values in timings.items()
+    }
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    synthetic.add_arguments(parser)
+    parser.add_argument("--driver", choices=DRIVERS, default="fake")
+    parser.add_argument(
+        "--delay",
+        type=float,
+        default=0.0,
+        help="Seconds the fake driver takes to 'render' a map",
+    )
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("-o", "--output", help="Where to write the JSON results")
+    parser.set_defaults(steps="0/12/6", levels="500", surface="2t")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("skinnywms").setLevel(logging.WARNING)
+
+    dataset = synthetic.dataset_from_args(args)
+    driver = FakeDriver(delay=args.delay) if args.driver == "fake" else None
+
+    root = tempfile.mkdtemp(prefix="skinnywms-benchmark-")
+    try:
+        synthetic.generate(root, dataset, args.format)
+        app = create_app(dict(data_root=root), driver=driver)
+
+        server = app.extensions["skinnywms"]["server"]
+        location = dataset_location(
+            root, dict(model=dataset.model, date=dataset.date, time=dataset.time)
+        )
+        server.setAvailability(app.extensions["skinnywms"]["catalogs"].get(location))
+
+        times = [t.strftime("%Y-%m-%dT%H:%M:%SZ") for t in dataset.valid_times]
+        layers = [(layer.name, times) for layer in server.availability.layers()]
+        LOG.info("%s layers", len(layers))
+
+        name, times = layers[0]
+        results = dict(
+            steps=steps(app, server, name, times[0]),
+            requests=requests(app, dataset, layers, args.requests),
+        )
+    finally:
+        shutil.rmtree(root)
+
+    options = dict(
+        dataset=dataset.as_dict(),
+        format=args.format,
+        driver=args.driver,
+        delay=args.delay,
+        requests=args.requests,
+    )
+    report.write(report.document("render", options, results), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# (C) Copyright 2012-2019 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""Results of the benchmarks, as JSON documents that can be compared between
+versions.
+
+"""
+
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import skinnywms
+
+__all__ = [
+    "document",
+    "summary",
+    "timer",
+    "write",
+]
+
+PERCENTILES = (50, 95, 99)
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    return dict(
+        skinnywms=skinnywms.__version__,
+        commit=_git_commit(),
+        python=sys.version.split()[0],
+        platform=platform.platform(),
+        cpus=os.cpu_count(),
+    )
+
+
+def summary(latencies, seconds=None, errors=0):
+    """Summarise the latencies (in seconds) of a series of operations, and
+    their throughput if they took `seconds` in total.
+
+    """
+    latencies = np.asarray(latencies, dtype=np.float64)
+    result = dict(count=int(latencies.size), errors=errors)
+    if seconds is not None:
+        result["seconds"] = seconds
+        result["throughput"] = latencies.size / seconds if seconds else None
+    if latencies.size:
+        result["mean"] = float(latencies.mean())
+        result["min"] = float(latencies.min())
+        result["max"] = float(latencies.max())
+        for p, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES)):
+            result["p%s" % (p,)] = float(value)
+    return result
+
+
+def timer(func, repeat=5, min_time=0.05):
+    """Return the time of one call of `func`, in seconds. `func` is called
+    in loops long enough to be timed reliably, and the best of `repeat`
+    loops is kept.
+
+    """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, time.perf_counter() - start)
+    return best / number
+
+
+def document(benchmark, options, results):
+    """The JSON document of a run of `benchmark`."""
+    return dict(
+        benchmark=benchmark,
+        date=datetime.datetime.utcnow().isoformat() + "Z",
+        environment=environment(),
+        options=options,
+        results=results,
+    )
+
+
+def write(document, output=None):
+    """Write the document to the file `output`, or to the standard output."""
+    text = json.dumps(document, indent=2, default=str)
+    if output is None or output == "-":
+        print(text)
+    else:
+        with open(output, "w") as f:
+            f.write(text + "\n")
@@ -0,0 +1,358 @@
+# (C) Copyright 2012-2019 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""Synthetic datasets, laid out like the datasets served from the data root
+(<model>/<date>/<time>/), with one file per forecast step.
+
+The values are smooth (a few waves on top of a typical value of the
+parameter), so that contouring them costs about as much as real data.
+
+e.g. python -m benchmarks.synthetic /tmp/data --resolution 0.25 --steps 0/48/6
+
+"""
+
+import argparse
+import datetime
+import logging
+import os
+import zlib
+
+import numpy as np
+
+from skinnywms.grib_bindings import bindings
+
+__all__ = [
+    "Dataset",
+    "generate",
+]
+
+LOG = logging.getLogger(__name__)
+
+# Typical value and amplitude of the parameters
+PARAMETERS = {
+    "t": (250.0, 30.0),
+    "z": (50000.0, 5000.0),
+    "u": (0.0, 30.0),
+    "v": (0.0, 30.0),
+    "r": (50.0, 50.0),
+    "2t": (280.0, 30.0),
+    "msl": (101325.0, 2000.0),
+    "10u": (0.0, 15.0),
+    "10v": (0.0, 15.0),
+    "tp": (0.005, 0.005),
+}
+
+NETCDF_NAMES = {
+    "t": ("air_temperature", "K"),
+    "z": ("geopotential", "m**2 s**-2"),
+    "u": ("eastward_wind", "m s**-1"),
+    "v": ("northward_wind", "m s**-1"),
+    "r": ("relative_humidity", "%"),
+    "2t": ("air_temperature", "K"),
+    "msl": ("air_pressure_at_mean_sea_level", "Pa"),
+    "10u": ("eastward_wind", "m s**-1"),
+    "10v": ("northward_wind", "m s**-1"),
+    "tp": ("precipitation_amount", "m"),
+}
+
+
+def _range(text):
+    """Parse '0/48/6', '0/6/12/24' or '500' into a list of integers."""
+    parts = [int(x) for x in text.split("/")]
+    if len(parts) == 3 and parts[0] < parts[1] and parts[2] < parts[1]:
+        return list(range(parts[0], parts[1] + 1, parts[2]))
+    return parts
+
+
+def _list(text):
+    return [x for x in text.split(",") if x]
+
+
+class Dataset:
+    """The description of a synthetic dataset: a regular lat/lon grid of
+    `resolution` degrees, the pressure level `params` on each of `levels`,
+    the `surface` parameters, for each of `steps` (hours).
+
+    """
+
+    def __init__(
+        self,
+        resolution=1.0,
+        params=("t", "z", "u", "v"),
+        levels=(1000, 850, 500, 250),
+        surface=("2t", "msl"),
+        steps=tuple(range(0, 49, 6)),
+        model="synthetic",
+        date="20220501",
+        time="00",
+    ):
+        self.resolution = resolution
+        self.params = list(params)
+        self.levels = list(levels)
+        self.surface = list(surface)
+        self.steps = list(steps)
+        self.model = model
+        self.date = date
+        self.time = time
+
+    @property
+    def shape(self):
+        nlat = int(round(180 / self.resolution)) + 1
+        nlon = int(round(360 / self.resolution))
+        return (nlat, nlon)
+
+    @property
+    def fields(self):
+        """Number of fields, i.e. of GRIB messages."""
+        per_step = len(self.params) * len(self.levels) + len(self.surface)
+        return per_step * len(self.steps)
+
+    @property
+    def layers(self):
+        """Number of WMS layers."""
+        return len(self.params) * len(self.levels) + len(self.surface)
+
+    @property
+    def base_time(self):
+        return datetime.datetime.strptime(self.date + self.time, "%Y%m%d%H")
+
+    @property
+    def valid_times(self):
+        return [self.base_time + datetime.timedelta(hours=s) for s in self.steps]
+
+    def location(self, root):
+        return os.path.join(root, self.model, self.date, self.time)
+
+    def as_dict(self):
+        return dict(
+            resolution=self.resolution,
+            shape=self.shape,
+            params=self.params,
+            levels=self.levels,
+            surface=self.surface,
+            steps=self.steps,
+            fields=self.fields,
+            layers=self.layers,
+            model=self.model,
+            date=self.date,
+            time=self.time,
+        )
+
+    def values(self, param, level, step):
+        """The values of a field, as a 2D (lat, lon) array."""
+        mean, amplitude = PARAMETERS.get(param, (0.0, 1.0))
+        nlat, nlon = self.shape
+        lat = np.radians(np.linspace(90, -90, nlat))[:, np.newaxis]
+        lon = np.radians(np.arange(nlon) * self.resolution)[np.newaxis, :]
+
+        # Different patterns for each field, moving with the step
+        seed = zlib.crc32(("%s/%s" % (param, level)).encode())
+        phase = step * np.pi / 24 + np.radians(seed % 360)
+        waves = (
+            np.cos(lat) * np.sin(3 * lon + phase)
+            + 0.5 * np.sin(2 * lat) * np.cos(5 * lon - phase)
+            + 0.25 * np.cos(7 * lat + phase) * np.sin(11 * lon)
+        )
+        return mean + amplitude * waves / 1.75
+
+
+def _set_grid(handle, dataset):
+    nlat, nlon = dataset.shape
+    for key, value in (
+        ("Ni", nlon),
+        ("Nj", nlat),
+        ("iDirectionIncrementInDegrees", float(dataset.resolution)),
+        ("jDirectionIncrementInDegrees", float(dataset.resolution)),
+        ("latitudeOfFirstGridPointInDegrees", 90.0),
+        ("longitudeOfFirstGridPointInDegrees", 0.0),
+        ("latitudeOfLastGridPointInDegrees", -90.0),
+        ("longitudeOfLastGridPointInDegrees", 360.0 - dataset.resolution),
+        ("dataDate", int(dataset.date)),
+        ("dataTime", int(dataset.time) * 100),
+        ("bitsPerValue", 16),
+    ):
+        bindings.grib_set(handle, key, value)
+
+
+def _handle(sample, dataset):
+    handle = bindings.grib_handle_new_from_samples(sample)
+    if not handle:
+        raise ValueError("Cannot load ecCodes sample %s" % (sample,))
+    _set_grid(handle, dataset)
+    return handle
+
+
+def generate_grib(root, dataset):
+    """Write the dataset as GRIB 2, one file per step. Return the paths."""
+    location = dataset.location(root)
+    os.makedirs(location, exist_ok=True)
+
+    pl = _handle("regular_ll_pl_grib2", dataset)
+    sfc = _handle("regular_ll_sfc_grib2", dataset)
+
+    paths = []
+    try:
+        for step in dataset.steps:
+            path = os.path.join(location, "step_%03d.grib2" % (step,))
+            fields = [(pl, p, lev) for p in dataset.params for lev in dataset.levels]
+            fields += [(sfc, p, None) for p in dataset.surface]
+            with open(path, "wb") as f:
+                for handle, param, level in fields:
+                    bindings.grib_set(handle, "shortName", param)
+                    if level is not None:
+                        bindings.grib_set(handle, "level", level)
+                    bindings.grib_set(handle, "step", step)
+                    bindings.grib_set_double_array(
+                        handle, "values", dataset.values(param, level, step)
+                    )
+                    f.write(bindings.grib_get_message(handle))
+            paths.append(path)
+    finally:
+        bindings.grib_handle_delete(pl)
+        bindings.grib_handle_delete(sfc)
+
+    return paths
+
+
+def generate_netcdf(root, dataset):
+    """Write the dataset as CF NetCDF, one file per step. Return the paths.
+    This needs one of the NetCDF backends of xarray (netCDF4, h5netcdf or
+    scipy).
+
+    """
+    import xarray as xr
+
+    location = dataset.location(root)
+    os.makedirs(location, exist_ok=True)
+
+    nlat, nlon = dataset.shape
+    coords = dict(
+        latitude=(
+            "latitude",
+            np.linspace(90, -90, nlat),
+            dict(standard_name="latitude", units="degrees_north"),
+        ),
+        longitude=(
+            "longitude",
+            np.arange(nlon) * dataset.resolution,
+            dict(standard_name="longitude", units="degrees_east"),
+        ),
+        level=(
+            "level",
+            np.array(dataset.levels, dtype=np.float64),
+            dict(standard_name="air_pressure", units="hPa", positive="down"),
+        ),
+    )
+
+    paths = []
+    for step in dataset.steps:
+        valid = dataset.base_time + datetime.timedelta(hours=step)
+        variables = {}
+        for param in dataset.params:
+            standard_name, units = NETCDF_NAMES.get(param, (param, "1"))
+            values = [dataset.values(param, level, step) for level in dataset.levels]
+            variables[param] = (
+                ("time", "level", "latitude", "longitude"),
+                np.array(values, dtype=np.float32)[np.newaxis],
+                dict(standard_name=standard_name, units=units),
+            )
+        for param in dataset.surface:
+            standard_name, units = NETCDF_NAMES.get(param, (param, "1"))
+            variables["sfc_" + param] = (
+                ("time", "latitude", "longitude"),
+                dataset.values(param, None, step).astype(np.float32)[np.newaxis],
+                dict(standard_name=standard_name, units=units),
+            )
+
+        ds = xr.Dataset(
+            variables,
+            coords=dict(
+                coords,
+                time=("time", [np.datetime64(valid)], dict(standard_name="time")),
+            ),
+        )
+
+        path = os.path.join(location, "step_%03d.nc" % (step,))
+        ds.to_netcdf(path)
+        paths.append(path)
+
+    return paths
+
+
+GENERATORS = {
+    "grib": generate_grib,
+    "netcdf": generate_netcdf,
+}
+
+
+def generate(root, dataset=None, format="grib"):
+    """Generate the synthetic `dataset` under the data root `root`, and
+    return the paths of the files written.
+
+    """
+    if dataset is None:
+        dataset = Dataset()
+    LOG.info("Generating %s fields in %s", dataset.fields, dataset.location(root))
+    return GENERATORS[format](root, dataset)
+
+
+def add_arguments(parser):
+    """The options describing a synthetic dataset, shared by the benchmarks."""
+    parser.add_argument(
+        "--resolution", type=float, default=1.0, help="Grid spacing in degrees"
+    )
+    parser.add_argument(
+        "--params",
+        type=_list,
+        default="t,z,u,v",
+        help="Comma separated pressure level parameters",
+    )
+    parser.add_argument(
+        "--levels",
+        type=_range,
+        default="1000/850/500/250",
+        help="Pressure levels, e.g. 1000/850/500 or 100/1000/100",
+    )
+    parser.add_argument(
+        "--surface",
+        type=_list,
+        default="2t,msl",
+        help="Comma separated surface parameters",
+    )
+    parser.add_argument(
+        "--steps",
+        type=_range,
+        default="0/48/6",
+        help="Forecast steps in hours, e.g. 0/48/6 or 0/12/24",
+    )
+    parser.add_argument("--format", choices=sorted(GENERATORS), default="grib")
+
+
+def dataset_from_args(args):
+    return Dataset(
+        resolution=args.resolution,
+        params=args.params,
+        levels=args.levels,
+        surface=args.surface,
+        steps=args.steps,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic dataset")
+    parser.add_argument("root", help="Data root where to write the dataset")
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    paths = generate(args.root, dataset_from_args(args), args.format)
+    print("\n".join(paths))
+
+
+if __name__ == "__main__":
+    main()
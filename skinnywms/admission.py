@@ -0,0 +1,355 @@
+# (C) Copyright 2012-2019 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import logging
+import math
+import socket
+import threading
+import time
+
+from skinnywms import errors, metrics
+
+__all__ = [
+    "CHEAP",
+    "PRIORITIES",
+    "RENDER",
+    "RenderQueue",
+    "socket_alive",
+]
+
+LOG = logging.getLogger(__name__)
+
+# Lower values are served first
+CHEAP = 0
+RENDER = 1
+
+PRIORITIES = {
+    "getlegendgraphic": CHEAP,
+    "getmap": RENDER,
+}
+
+# How often waiting requests check that their client is still there
+POLL_INTERVAL = 0.25
+
+# Ticket admitted by a front end before the request reaches WMSServer
+CURRENT_TICKET = contextvars.ContextVar("skinnywms_render_ticket", default=None)
+
+
+def socket_alive(sock):
+    """Return a callable telling whether the peer of a connected socket,
+    e.g. an HTTP client waiting for its response, is still there. When that
+    cannot be known (e.g. TLS sockets, which cannot be peeked at), the peer
+    is assumed to be there.
+
+    """
+
+    def alive():
+        try:
+            # Peek, so that a pipelined request is left for the server
+            return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) != b""
+        except BlockingIOError:
+            return True
+        except ValueError:
+            # ssl.SSLSocket does not support flags
+            return True
+        except OSError:
+            return False
+
+    return alive
+
+
+class Ticket:
+    """A request admitted in a `RenderQueue`, waiting for or holding one of
+    its slots.
+
+    """
+
+    def __init__(self, queue, priority, deadline, alive=None):
+        self.queue = queue
+        self.priority = priority
+        self.deadline = deadline
+        self.alive = alive
+
+        self.granted = False
+        self.released = False
+        self.created = time.monotonic()
+        self.started = None
+
+        # Why the ticket was dropped from the queue, if it was
+        self.cancelled = None
+        # Set by `abandoned()`, the queue only looks at this
+        self.disconnected = False
+
+        self._event = threading.Event()
+        self._callbacks = []
+
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def abandoned(self):
+        """Whether the client went away. Calls `alive()`, a system call for
+        `socket_alive()`, so it is done by the waiting thread rather than by
+        the queue with its lock held.
+
+        """
+        if not self.disconnected and self.alive is not None and not self.alive():
+            self.disconnected = True
+        return self.disconnected
+
+    def _grant(self):
+        self.granted = True
+        self.started = time.monotonic()
+        self._event.set()
+        for callback in self._callbacks:
+            callback()
+
+    def _poll_timeout(self):
+        remaining = self.remaining()
+        if self.alive is None:
+            return remaining
+        if remaining is None:
+            return POLL_INTERVAL
+        return min(remaining, POLL_INTERVAL)
+
+    def wait(self):
+        """Block until a slot is granted. Raise `errors.ServiceUnavailable`
+        when the deadline passes first, and `errors.RequestCancelled` when
+        the client goes away.
+
+        """
+        while not self._event.wait(self._poll_timeout()):
+            if self.expired() or self.abandoned():
+                break
+        self.queue._settle(self)
+
+    async def wait_async(self):
+        """Same as `wait()`, without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def granted():
+            loop.call_soon_threadsafe(
+                lambda: future.done() or future.set_result(True)
+            )
+
+        with self.queue._lock:
+            if self.granted:
+                future.set_result(True)
+            else:
+                self._callbacks.append(granted)
+
+        while True:
+            try:
+                await asyncio.wait_for(asyncio.shield(future), self._poll_timeout())
+                break
+            except asyncio.TimeoutError:
+                if self.expired() or self.abandoned():
+                    break
+        self.queue._settle(self)
+
+    def release(self):
+        self.queue._release(self)
+
+
+class RenderQueue:
+    """Admission control in front of the renderer.
+
+    At most `concurrency` requests render at the same time. Up to
+    `max_depth` more wait for their turn, cheapest first, then in order of
+    arrival; further requests are rejected straight away. Requests still
+    waiting when their deadline (`timeout` seconds after admission) passes
+    are dropped rather than rendered for a client that has probably given up.
+    Both are reported with `errors.ServiceUnavailable`.
+
+    Requests can also come with an `alive()` callable, telling whether their
+    client is still connected. Requests whose client went away are dropped
+    with `errors.RequestCancelled`, while waiting or when granted a slot,
+    so that they never reach the renderer.
+
+    """
+
+    def __init__(self, max_depth=32, concurrency=1, timeout=30.0):
+        self.max_depth = max_depth
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._waiting = []
+        self._counter = itertools.count()
+        self._running = 0
+
+        # Moving average of the time a request holds its slot
+        self._service_time = 1.0
+
+        self.admitted = 0
+        self.rejected = 0
+        self.expired = 0
+        self.cancelled = 0
+
+    def admit(self, priority, deadline=None, alive=None):
+        """Queue a request, raising `errors.ServiceUnavailable` when the
+        queue is full. `deadline` is a `time.monotonic()` time, and defaults
+        to `timeout` seconds from now.
+
+        """
+        if deadline is None and self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+
+        with self._lock:
+            self._expire()
+            if len(self._waiting) >= self.max_depth:
+                self.rejected += 1
+                raise self._unavailable("Too many requests waiting to be rendered")
+
+            ticket = Ticket(self, priority, deadline, alive)
+            heapq.heappush(self._waiting, (priority, next(self._counter), ticket))
+            self.admitted += 1
+            self._dispatch()
+
+        return ticket
+
+    @contextlib.contextmanager
+    def slot(self, priority, deadline=None, alive=None):
+        """Hold a render slot. A ticket already admitted by the front end
+        for the current request is used if there is one.
+
+        """
+        ticket = CURRENT_TICKET.get()
+        if ticket is None or ticket.queue is not self:
+            ticket = self.admit(priority, deadline, alive)
+
+        try:
+            ticket.wait()
+            metrics.record("queue", ticket.started - ticket.created)
+            # The client may have gone while the slot was being granted
+            if ticket.abandoned():
+                with self._lock:
+                    self.cancelled += 1
+                raise errors.RequestCancelled("Client disconnected")
+            yield ticket
+        finally:
+            ticket.release()
+
+    def unavailable(self, message):
+        with self._lock:
+            return self._unavailable(message)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                waiting=len(self._waiting),
+                running=self._running,
+                admitted=self.admitted,
+                rejected=self.rejected,
+                expired=self.expired,
+                cancelled=self.cancelled,
+                service_time=self._service_time,
+            )
+
+    def families(self):
+        stats = self.stats()
+        families = [
+            metrics.Family(
+                "skinnywms_render_queue_waiting",
+                "gauge",
+                "Requests waiting to be rendered",
+            ).add({}, stats["waiting"]),
+            metrics.Family(
+                "skinnywms_render_queue_running",
+                "gauge",
+                "Requests being rendered",
+            ).add({}, stats["running"]),
+        ]
+        for name in ("admitted", "rejected", "expired", "cancelled"):
+            families.append(
+                metrics.Family(
+                    "skinnywms_render_queue_%s_total" % (name,),
+                    "counter",
+                    "Requests %s by the render queue" % (name,),
+                ).add({}, stats[name])
+            )
+        return families
+
+    # The methods below are called with the lock held
+
+    def _unavailable(self, message):
+        backlog = len(self._waiting) + self._running
+        retry_after = math.ceil(self._service_time * backlog / self.concurrency)
+        return errors.ServiceUnavailable(message, retry_after=max(1, retry_after))
+
+    def _drop(self, ticket):
+        if ticket.disconnected:
+            ticket.cancelled = "cancelled"
+            self.cancelled += 1
+            return True
+        if ticket.expired():
+            ticket.cancelled = "expired"
+            self.expired += 1
+            return True
+        return False
+
+    def _expire(self):
+        waiting = [entry for entry in self._waiting if not self._drop(entry[2])]
+        if len(waiting) != len(self._waiting):
+            heapq.heapify(waiting)
+            self._waiting = waiting
+
+    def _dispatch(self):
+        while self._waiting and self._running < self.concurrency:
+            _, _, ticket = heapq.heappop(self._waiting)
+            if self._drop(ticket):
+                continue
+            self._running += 1
+            ticket._grant()
+
+    def _remove(self, ticket):
+        self._waiting = [e for e in self._waiting if e[2] is not ticket]
+        heapq.heapify(self._waiting)
+
+    def _settle(self, ticket):
+        """Raise the reason why a ticket that was waited for was not granted."""
+        with self._lock:
+            if ticket.granted:
+                return
+
+            if ticket.cancelled is None:
+                # The wait timed out before the ticket was dropped
+                if not self._drop(ticket):
+                    ticket.cancelled = "expired"
+                    self.expired += 1
+                self._remove(ticket)
+
+            if ticket.cancelled == "cancelled":
+                raise errors.RequestCancelled("Client disconnected")
+            raise self._unavailable("Render deadline exceeded")
+
+    def _release(self, ticket):
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+
+            if ticket.granted:
+                self._running -= 1
+                elapsed = time.monotonic() - ticket.started
+                self._service_time = 0.8 * self._service_time + 0.2 * elapsed
+            elif ticket.cancelled is None:
+                ticket.cancelled = "released"
+                self._remove(ticket)
+
+            self._dispatch()
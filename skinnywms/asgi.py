@@ -0,0 +1,351 @@
+# (C) Copyright 2012-2019 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+from urllib.parse import parse_qsl
+
+import jinja2
+
+from skinnywms import admission, errors, metrics, profiler, protocol
+from skinnywms.wmssvr import count_datasets, dataset_location, list_datasets
+
+LOG = logging.getLogger(__name__)
+
+TEMPLATES = os.path.join(os.path.dirname(__file__), "templates")
+
+
+class Headers:
+    """Case-insensitive view of the headers of an ASGI scope."""
+
+    def __init__(self, raw):
+        self._headers = {}
+        for name, value in raw:
+            name = name.decode("latin-1").lower()
+            value = value.decode("latin-1")
+            if name in self._headers:
+                self._headers[name] += ", " + value
+            else:
+                self._headers[name] = value
+
+    def get(self, name, default=None):
+        return self._headers.get(name.lower(), default)
+
+    def __contains__(self, name):
+        return name.lower() in self._headers
+
+
+class Request:
+    """The parts of an HTTP request used by `WMSServer.process()`."""
+
+    def __init__(self, scope):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.headers = Headers(scope.get("headers", []))
+
+        query = scope.get("query_string", b"").decode("latin-1")
+
+        # Like Flask, keep the first value of repeated parameters
+        self.args = {}
+        for name, value in parse_qsl(query, keep_blank_values=True):
+            self.args.setdefault(name, value)
+
+        host = self.headers.get("host")
+        if host is None and scope.get("server"):
+            host = "%s:%s" % scope["server"]
+
+        # Set by the application when the client disconnects
+        self.disconnected = threading.Event()
+
+        self.url = "%s://%s%s%s%s" % (
+            scope.get("scheme", "http"),
+            host or "localhost",
+            scope.get("root_path", ""),
+            self.path,
+            "?" + query if query else "",
+        )
+
+    def alive(self):
+        return not self.disconnected.is_set()
+
+
+class Response:
+    def __init__(self, content=None, status=200, mimetype=None, headers=None):
+        if content is None:
+            content = b""
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+            text = mimetype is not None and mimetype.startswith("text/")
+            if text and "charset" not in mimetype:
+                mimetype += "; charset=utf-8"
+
+        self.content = content
+        self.status = status
+        self.headers = dict(headers or {})
+        if mimetype is not None:
+            self.headers["Content-Type"] = mimetype
+
+    async def send(self, send, body=True):
+        headers = [
+            (name.lower().encode("latin-1"), str(value).encode("latin-1"))
+            for name, value in self.headers.items()
+        ]
+        headers.append((b"content-length", str(len(self.content)).encode("ascii")))
+
+        await send(
+            {"type": "http.response.start", "status": self.status, "headers": headers}
+        )
+        await send(
+            {"type": "http.response.body", "body": self.content if body else b""}
+        )
+
+
+def send_file(path, mimetype):
+    # The file is deleted as soon as this returns
+    with open(path, "rb") as f:
+        return Response(f.read(), mimetype=mimetype)
+
+
+def error_response(exc, version):
+    return Response(
+        exc.body(version),
+        status=exc.status,
+        mimetype=exc.content_type(version),
+        headers=exc.headers(),
+    )
+
+
+def json_response(value, status=200):
+    return Response(json.dumps(value), status=status, mimetype="application/json")
+
+
+class ASGIApplication:
+    """ASGI version of the WMS application.
+
+    Everything that does not block is done on the event loop: parsing the
+    request, looking up the catalog, and serving cached capabilities and
+    static pages. The rest (map and legend rendering, catalog scans and
+    capabilities not yet cached) is run in a thread pool, so that a single
+    process can keep many more connections open than it has threads.
+
+    """
+
+    def __init__(self, config, server, catalogs, executor=None):
+        self.config = config
+        self.server = server
+        self.catalogs = catalogs
+
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=config["render_threads"],
+                thread_name_prefix="skinnywms-render",
+            )
+        self.executor = executor
+
+        self.jinja = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(TEMPLATES),
+            autoescape=jinja2.select_autoescape(["html", "htm", "xml", "xhtml"]),
+        )
+
+        self.routes = {
+            "/wms": self.wms,
+            "/availability": self.availability,
+            "/metrics": self.metrics,
+            "/health": self.health,
+            "/ready": self.ready,
+            "/listdir": self.list_dir,
+            "/timeseries": self.timeseries,
+            "/": self.index,
+        }
+
+        if config.get("admin"):
+            self.routes["/admin/profile"] = self.admin_profile
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+
+        if scope["type"] != "http":
+            raise NotImplementedError("Unsupported ASGI scope %s" % (scope["type"],))
+
+        request = Request(scope)
+        route = self.routes.get(request.path)
+
+        if route is None:
+            response = Response("Not Found", status=404, mimetype="text/plain")
+        elif request.method not in ("GET", "HEAD"):
+            response = Response(
+                "Method Not Allowed", status=405, mimetype="text/plain"
+            )
+        else:
+            watcher = asyncio.ensure_future(self.watch(request, receive))
+            try:
+                response = await route(request)
+            except Exception:
+                LOG.exception("%s: Error", request.url)
+                response = Response(
+                    "Internal Server Error", status=500, mimetype="text/plain"
+                )
+            finally:
+                watcher.cancel()
+
+        response.headers.setdefault("Access-Control-Allow-Origin", "*")
+        with metrics.stage("send"):
+            await response.send(send, body=request.method != "HEAD")
+
+    async def watch(self, request, receive):
+        """Flag the request when its client disconnects."""
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                request.disconnected.set()
+                return
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def offload(self, func, *args):
+        """Run `func` in the thread pool, in a copy of the current context."""
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(context.run, func, *args)
+        )
+
+    def render_template(self, name, **variables):
+        return self.jinja.get_template(name).render(**variables)
+
+    def inline(self, request, availability):
+        """Whether a WMS request can be answered on the event loop."""
+        params, _ = protocol.filter_wms_params(request.args)
+        req = params.get("request", "getcapabilities").lower()
+
+        if req in admission.PRIORITIES:
+            return False
+
+        if req == "getcapabilities":
+            return self.server.has_capabilities(
+                params.get("version", "1.3.0"),
+                request.url.split("?")[0],
+                availability,
+            )
+
+        # Errors
+        return True
+
+    def process(self, request, availability):
+        return self.server.process(
+            request,
+            Response=Response,
+            send_file=send_file,
+            render_template=self.render_template,
+            alive=request.alive,
+            availability=availability,
+        )
+
+    async def wms(self, request):
+        # Time the request from here, to include the wait for a render slot
+        token = metrics.CURRENT_TIMINGS.set(metrics.Timings())
+        try:
+            return await self.dispatch(request)
+        finally:
+            metrics.CURRENT_TIMINGS.reset(token)
+
+    async def dispatch(self, request):
+        try:
+            location = dataset_location(self.config["data_root"], request.args)
+        except errors.DatasetNotDefined as exc:
+            return error_response(exc, errors.version_param(request.args) or "1.3.0")
+        availability = self.catalogs.get(location)
+
+        if self.inline(request, availability):
+            return self.process(request, availability)
+
+        params, _ = protocol.filter_wms_params(request.args)
+        priority = admission.PRIORITIES.get(params.get("request", "").lower())
+        if priority is None:
+            return await self.offload(self.process, request, availability)
+
+        if not availability.loaded:
+            # A cold scan of the dataset must not hold a render slot
+            await self.offload(availability.ensure_loaded)
+
+        # Wait for a render slot here rather than in one of the threads, so
+        # that the threads are only used by requests that can be rendered
+        try:
+            ticket = self.server.render_queue.admit(priority, alive=request.alive)
+            try:
+                await ticket.wait_async()
+                token = admission.CURRENT_TICKET.set(ticket)
+                try:
+                    return await self.offload(self.process, request, availability)
+                finally:
+                    admission.CURRENT_TICKET.reset(token)
+            finally:
+                ticket.release()
+        except (errors.ServiceUnavailable, errors.RequestCancelled) as exc:
+            return error_response(exc, params.get("version", "1.3.0"))
+
+    async def metrics(self, request):
+        return Response(self.server.metrics(), mimetype=metrics.CONTENT_TYPE)
+
+    async def health(self, request):
+        return json_response(dict(status="ok"))
+
+    async def ready(self, request):
+        status = self.catalogs.status()
+        return json_response(status, status=200 if status["ready"] else 503)
+
+    async def admin_profile(self, request):
+        try:
+            options = profiler.options(request.args)
+            # Not in the render threads, which are being profiled
+            loop = asyncio.get_running_loop()
+            stacks = await loop.run_in_executor(
+                None, functools.partial(profiler.profile, **options)
+            )
+        except ValueError as exc:
+            return Response(str(exc), status=400, mimetype="text/plain")
+        return Response(stacks, mimetype="text/plain")
+
+    async def availability(self, request):
+        try:
+            location = dataset_location(self.config["data_root"], request.args)
+        except errors.DatasetNotDefined as exc:
+            return error_response(exc, "1.3.0")
+        availability = self.catalogs.get(location)
+        # Even when loaded, describing the fields may read their files
+        return json_response(await self.offload(availability.as_dict))
+
+    async def list_dir(self, request):
+        return json_response(
+            await self.offload(list_datasets, self.config["data_root"])
+        )
+
+    async def timeseries(self, request):
+        return json_response(
+            await self.offload(count_datasets, self.config["data_root"])
+        )
+
+    async def index(self, request):
+        return Response(
+            self.render_template("leaflet_demo.html"), mimetype="text/html"
+        )
@@ -1,74 +1,381 @@
 # Copyright (C) ECMWF 2018
 
+import fnmatch
 import logging
 import os
-import traceback
 import threading
+import time
+import traceback
+import weakref
 
-from skinnywms import datatypes
+from skinnywms import datatypes, metrics
+from skinnywms.data.rejects import RejectedFiles
 from skinnywms.fields.NetCDFField import NetCDFReader
 
 from skinnywms.fields.GRIBField import GRIBReader
 
 __all__ = [
     "Availability",
+    "Catalogs",
 ]
 
-LOCK = threading.Lock()
+
+# Seconds between the partial catalogs published during a first scan
+PARTIAL_INTERVAL = 1.0
+
+
+class Scan:
+    """A scan of the files of an `Availability` into a new catalog, and its
+    progress.
+
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.paths = {}
+        # Path => what identifies its content, see `_stat()`
+        self.stats = {}
+        # Path => where to resume the scan of a GRIB file appended to
+        self.offsets = {}
+        self.state = "scanning"
+        self.files = 0
+        self.files_done = 0
+        self.skipped = 0
+        self.fields = 0
+        self.errors = 0
+        self.started = time.time()
+        self.seconds = None
+
+    def done(self, state):
+        self.state = state
+        self.seconds = time.time() - self.started
+
+    def as_dict(self):
+        return dict(
+            state=self.state,
+            files=self.files,
+            files_done=self.files_done,
+            skipped=self.skipped,
+            fields=self.fields,
+            errors=self.errors,
+            seconds=self.seconds,
+        )
 
 
 class Availability(datatypes.Availability):
+    """The catalog of the GRIB and NetCDF files of a directory (or of a
+    single file). The files are scanned when the catalog is first needed,
+    and, with `max_age`, scanned again in the background once the catalog
+    is older than `max_age` seconds, the previous catalog being used until
+    the new one is ready.
+
+    With `partial`, the first scan is done in the background, and the
+    layers of the files already scanned are served in the meantime.
+
+    With a `watcher` (see `skinnywms.data.watch`), the files added, changed
+    or removed are found once the catalog is loaded, and only their fields
+    are added or removed (see `refresh()`). Only the messages appended to a
+    GRIB file since it was last scanned are read.
+
+    Only the files of a directory matching one of the `include` patterns,
+    if any, and none of the `exclude` ones are scanned (e.g. "*.grib",
+    "*bufr*"), the patterns being matched against the name of the files
+    and their path relative to the directory. The files that are not GRIB
+    or NetCDF are recorded in `rejected` (see `RejectedFiles`), and are
+    not opened again until they change.
+
+    """
 
     log = logging.getLogger(__name__)
 
-    def __init__(self, path, *args, **kwargs):
+    def __init__(
+        self,
+        path,
+        *args,
+        max_age=None,
+        partial=False,
+        watcher=None,
+        include=None,
+        exclude=None,
+        rejected=None,
+        **kwargs
+    ):
         super(Availability, self).__init__(*args, **kwargs)
         self._path = path
         self._paths = {}
+        self._stats = {}
+        self._offsets = {}
         self._loaded = False
+        self._loaded_at = None
+        self._max_age = max_age
+        self._partial = partial
+        self._scan = None
+        self._watcher = watcher
+        self._include = include or []
+        self._exclude = exclude or []
+        self._rejected = RejectedFiles() if rejected is None else rejected
+        # One per dataset, so that the scan of a directory does not block the
+        # requests to the other datasets
+        self._lock = metrics.InstrumentedLock("fs")
 
     def load(self):
 
-        with LOCK:
+        with self._lock:
 
             if self._loaded:
                 return
 
-            if os.path.isdir(self._path):
-                self.add_directory(self._path)
-            elif os.path.isfile(self._path):
-                self.add_file(self._path)
+            self.scan()
+
+    def reload(self):
+        """Scan the files again, and use the new catalog once done. Returns
+        False, without waiting, if they are already being scanned.
+
+        """
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            self.scan()
+        finally:
+            self._lock.release()
+        return True
+
+    def reload_in_background(self):
+        def reload():
+            try:
+                self.reload()
+            except Exception:
+                self.log.exception("Cannot reload %s", self._path)
+
+        thread = threading.Thread(
+            target=reload, name="reload %s" % (self._path,), daemon=True
+        )
+        thread.start()
+        return thread
+
+    def files(self):
+        """The files to scan."""
+        if os.path.isdir(self._path):
+            return [
+                path
+                for path in _directory_files(self._path)
+                if self._selected(os.path.relpath(path, self._path))
+            ]
+        if os.path.isfile(self._path):
+            return [self._path]
+        raise NotImplementedError(
+            "%s is neither a file not  a directory" % (self._path,)
+        )
+
+    def _selected(self, name):
+        names = (name, os.path.basename(name))
+
+        def matches(patterns):
+            return any(fnmatch.fnmatch(n, p) for p in patterns for n in names)
+
+        if self._include and not matches(self._include):
+            return False
+        return not matches(self._exclude)
+
+    def scan(self):
+        """Scan the files into a new catalog, and publish it."""
+        scan = self._scan = Scan(self.new_catalog())
+        # Only for the first scan, later ones still have the previous catalog
+        partial = self._partial and not self._loaded
+        published = time.monotonic()
+
+        try:
+            with metrics.stage("catalog"):
+                files = self.files()
+                scan.files = len(files)
+                for path in files:
+                    self.add_file(path, scan)
+                    scan.files_done += 1
+
+                    if partial and time.monotonic() - published > PARTIAL_INTERVAL:
+                        self.publish(scan.catalog.copy())
+                        published = time.monotonic()
+        except Exception:
+            scan.done("failed")
+            raise
+        finally:
+            self._rejected.save()
+
+        self._paths = scan.paths
+        self._stats = scan.stats
+        self._offsets = scan.offsets
+        self.publish(scan.catalog)
+        self._loaded_at = time.monotonic()
+        self._loaded = True
+        scan.done("ready")
+
+        if self._watcher is not None:
+            self._watcher.add(self._path, self.refresh)
+
+    def refresh(self):
+        """Scan the files added or changed since the last scan, and publish a
+        catalog with their fields, without the fields of the files changed
+        or removed. Returns whether any file was.
+
+        The GRIB files that have grown, and still have the messages read
+        by the last scan, are only read from the end of these messages.
+
+        """
+        with self._lock:
+
+            if not self._loaded:
+                return False
+
+            stats = {}
+            # The dataset may have been deleted as a whole
+            files = self.files() if os.path.exists(self._path) else []
+            for path in files:
+                stat = _stat(path)
+                if stat is not None:
+                    stats[path] = stat
+
+            previous = self._stats
+            removed = set(previous) - set(stats)
+            changed = {p for p, s in stats.items() if previous.get(p, s) != s}
+            added = set(stats) - set(previous)
+
+            if not (removed or changed or added):
+                return False
+
+            self.log.info(
+                "%s: %s files added, %s changed, %s removed",
+                self._path,
+                len(added),
+                len(changed),
+                len(removed),
+            )
+
+            appended = {
+                path
+                for path in changed
+                if _appended(path, previous[path], stats[path], self._offsets.get(path))
+            }
+
+            with metrics.stage("catalog"):
+                stale = removed | (changed - appended)
+                if stale:
+                    catalog = self.new_catalog()
+                    for field in self._catalog.fields():
+                        if field.path not in stale:
+                            catalog.add_field(field)
+                else:
+                    # Cheaper, and the common case of new files (e.g. steps)
+                    # or messages
+                    catalog = self._catalog.copy()
+
+                scan = Scan(catalog)
+                for path, value in self._paths.items():
+                    if path not in stale:
+                        scan.paths[path] = value
+                        scan.stats[path] = previous[path]
+                        if path in self._offsets:
+                            scan.offsets[path] = self._offsets[path]
+
+                for path in sorted(added | changed):
+                    self.add_file(path, scan, resume=path in appended)
+
+                self._rejected.save()
+
+            self._paths = scan.paths
+            self._stats = scan.stats
+            self._offsets = scan.offsets
+            # Only a new version if the layers have changed
+            self.publish(scan.catalog)
+            return True
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    @property
+    def stale(self):
+        return (
+            self._max_age is not None
+            and self._loaded
+            and time.monotonic() - self._loaded_at > self._max_age
+        )
+
+    def ensure_loaded(self):
+        if self._watcher is not None:
+            self._watcher.start()
+
+        if not self._loaded:
+            if self._partial:
+                # Serve what has been scanned so far
+                if not self._lock.locked():
+                    self.reload_in_background()
             else:
-                raise NotImplementedError(
-                    "%s is neither a file not  a directory" % (self._path,)
-                )
-            self._loaded = True
-
-    def add_directory(self, path):
-        for fname in sorted(os.listdir(path)):
-            fname = os.path.join(path, fname)
-            if os.path.isdir(fname):
-                self.add_directory(fname)
-            if not os.path.isfile(fname):
-                continue
-
-            self.add_file(fname)
-
-    def add_file(self, path):
+                self.load()
+        elif self.stale and not self._lock.locked():
+            self.reload_in_background()
+
+    def status(self):
+        """The progress of the last scan."""
+        if self._scan is None:
+            status = dict(state="pending")
+        else:
+            status = self._scan.as_dict()
+        status["loaded"] = self._loaded
+        return status
+
+    def add_file(self, path, scan, resume=False):
+        """Add the fields of a file to the catalog of the scan. With `resume`,
+        only those of the messages appended to a GRIB file since it was
+        last scanned.
+
+        """
+        # Before reading, so that changes made while reading are seen
+        stat = scan.stats[path] = _stat(path)
+
+        if resume:
+            reader = GRIBReader(self.context, path, *scan.offsets.pop(path))
+        else:
+            reader, reason = None, self._rejected.get(path, stat)
+            if reason is None:
+                try:
+                    reader, reason = _sniff(path)
+                except OSError as exc:
+                    reader, reason = None, str(exc)
+                else:
+                    if reader is None:
+                        self.log.info("Skipping %s: %s", path, reason)
+                        self._rejected.add(path, stat, reason)
+
+            if reader is None:
+                # No traceback, there can be many of these
+                scan.paths[path] = [reason]
+                scan.skipped += 1
+                return
+
+            reader = reader(self.context, path)
+
         self.log.info("Scanning %s", path)
+
+        n = 0
         try:
-            reader = _reader(self.context, path)
-        except ValueError as exc:
-            self.log.info("Skipping file %s: %s", path, exc)
-            self._paths[path] = [traceback.format_exc()]
+            for field in reader.get_fields():
+                n += 1
+                scan.catalog.add_field(field)
+        except Exception:
+            # Keep the rest of the dataset
+            self.log.exception("Cannot scan %s", path)
+            scan.paths[path] = [traceback.format_exc()]
+            scan.errors += 1
             return
+        finally:
+            scan.fields += n
 
-        n = 0
-        for field in reader.get_fields():
-            n += 1
-            self.add_field(field)
+        if resume:
+            n += scan.paths[path]
+        scan.paths[path] = n
 
-        self._paths[path] = n
+        if isinstance(reader, GRIBReader):
+            scan.offsets[path] = reader.resume()
 
     def as_dict(self):
         d = super(Availability, self).as_dict()
@@ -76,6 +383,88 @@ class Availability(datatypes.Availability):
         return d
 
 
+class Catalogs:
+    """The catalogs of all the datasets served, one Availability per
+    location. Catalogs are kept between requests, so that each location is
+    only scanned once.
+
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, *args, **kwargs):
+        self._args = args
+        self._kwargs = kwargs
+        self._availabilities = {}
+        self._context = None
+        # The locations that must be loaded for the server to be ready
+        self._scheduled = set()
+
+    def __contains__(self, location):
+        return location in self._availabilities
+
+    def set_context(self, context):
+        """Set the context of the catalogs created from now on."""
+        self._context = weakref.ref(context)
+
+    def get(self, location):
+        availability = self._availabilities.get(location)
+        if availability is None:
+            availability = Availability(location, *self._args, **self._kwargs)
+            if self._context is not None:
+                availability.set_context(self._context())
+            availability = self._availabilities.setdefault(location, availability)
+        return availability
+
+    def preload(self, context, locations):
+        """Scan the given locations ahead of the first request."""
+        self._scheduled.update(locations)
+        for location in locations:
+            self.log.info("Preloading %s", location)
+            availability = self.get(location)
+            availability.set_context(context)
+            try:
+                availability.load()
+            except Exception:
+                self.log.exception("Cannot preload %s", location)
+
+    def preload_in_background(self, context, locations):
+        """Scan the given locations in a background thread. Until then, they
+        are not ready (see `status()`).
+
+        """
+        self._scheduled.update(locations)
+        for location in locations:
+            self.get(location)
+
+        thread = threading.Thread(
+            target=self.preload, args=(context, locations), name="preload", daemon=True
+        )
+        thread.start()
+        return thread
+
+    def status(self):
+        """Whether all the datasets to preload are loaded (or have failed to
+        be), and the progress of the scans of all the datasets known, with
+        whether they are to be preloaded. The datasets only requested by the
+        clients do not make the server not ready.
+
+        """
+        datasets = {}
+        for location, availability in list(self._availabilities.items()):
+            status = datasets[location] = availability.status()
+            status["preload"] = location in self._scheduled
+
+        return dict(
+            ready=all(
+                status["loaded"] or status["state"] == "failed"
+                for status in datasets.values()
+                if status["preload"]
+            ),
+            datasets=datasets,
+        )
+
+
 READERS = {
     b"GRIB": GRIBReader,
     b"\x89HDF": NetCDFReader,
@@ -83,12 +472,77 @@ READERS = {
     b"CDF\x02": NetCDFReader,
 }
 
+# Files of messages, which may start with some padding, and their reader
+MESSAGES = {
+    b"GRIB": GRIBReader,
+    b"BUFR": None,
+}
+
+PADDING = b"\0 \t\r\n"
+
+# Number of bytes read to find the format of a file
+SNIFF_SIZE = 4096
+
+
+def _directory_files(path):
+    for fname in sorted(os.listdir(path)):
+        fname = os.path.join(path, fname)
+        if os.path.isdir(fname):
+            yield from _directory_files(fname)
+        if not os.path.isfile(fname):
+            continue
+
+        yield fname
 
-def _reader(context, path):
+
+def _stat(path):
+    """What changes when the content of a file does, or None if it does not
+    exist anymore.
+
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _appended(path, previous, stat, offset):
+    """Whether messages have been appended to a GRIB file since it was
+    scanned: it is the same file, larger, and the last message read still
+    ends at the same offset.
+
+    """
+    if offset is None or stat[0] != previous[0] or stat[1] <= previous[1]:
+        return False
+
+    end, _ = offset
+    if end < 4:
+        return False
+
+    try:
+        with open(path, "rb") as f:
+            f.seek(end - 4)
+            return f.read(4) == b"7777"
+    except OSError:
+        return False
+
+
+def _sniff(path):
+    """The reader of a file, from its first bytes, or None and why it cannot
+    be read.
+
+    """
     with open(path, "rb") as f:
-        header = f.read(4)
+        header = f.read(SNIFF_SIZE)
+
+    if header[:4] in READERS:
+        return READERS[header[:4]], None
 
-    if header in READERS:
-        return READERS[header](context, path)
+    magic = header.lstrip(PADDING)[:4]
+    if magic in MESSAGES:
+        if MESSAGES[magic] is not None:
+            return MESSAGES[magic], None
+        return None, "Unsupported {} file".format(magic.decode())
 
-    raise ValueError("Unsupported file {} (header={})".format(path, header))
+    return None, "Unsupported file (header={})".format(header[:4])
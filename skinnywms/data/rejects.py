@@ -0,0 +1,67 @@
+# (C) Copyright 2012-2019 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""Files of the datasets that cannot be read, kept between scans."""
+
+import threading
+
+from skinnywms import jsonfile
+
+__all__ = [
+    "RejectedFiles",
+]
+
+VERSION = 1
+
+
+class RejectedFiles:
+    """The files found not to be GRIB or NetCDF (e.g. BUFR), with why, so that
+    they are not opened again by the scans until their size or modification
+    time changes. With a `path`, they are also kept in a JSON file between
+    runs, shared by the processes of a server as the style cache is (see
+    `skinnywms.stylecache.StyleCache`).
+
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._files = self._read()
+        self._changed = False
+
+    def _read(self):
+        if not self.path:
+            return {}
+        return jsonfile.read(self.path, VERSION, "files", "rejected files")
+
+    def get(self, path, stat):
+        """Why the file was rejected, or None if it was not, or has changed
+        since. `stat` is as returned by `skinnywms.data.fs._stat()`.
+
+        """
+        with self._lock:
+            entry = self._files.get(path)
+            if entry is None or stat is None or entry[:2] != [stat[1], stat[2]]:
+                return None
+            return entry[2]
+
+    def add(self, path, stat, reason):
+        with self._lock:
+            self._files[path] = [stat[1], stat[2], reason]
+            self._changed = True
+
+    def save(self):
+        """Write the files rejected since the last call, if any."""
+        with self._lock:
+            if not self.path or not self._changed:
+                return
+
+            self._files = jsonfile.merge(
+                self.path, VERSION, "files", self._files, "rejected files"
+            )
+            self._changed = False
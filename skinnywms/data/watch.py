@@ -0,0 +1,278 @@
+# (C) Copyright 2012-2019 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""Detection of the changes to the files of the datasets, with inotify on
+Linux, and by polling elsewhere. A watcher only tells which dataset has
+changed: what has changed is found by the dataset itself (see
+`skinnywms.data.fs.Availability.refresh()`).
+
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+__all__ = [
+    "InotifyWatcher",
+    "PollingWatcher",
+    "create_watcher",
+]
+
+LOG = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+MASK = (
+    IN_MODIFY
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+)
+
+_EVENT = struct.Struct("iIII")
+
+
+class Watcher:
+    """Calls the callback of a path (a file or a directory, watched with all
+    its sub-directories) in a background thread when it changes, at most once
+    every `interval` seconds, so that a file being written does not trigger a
+    scan for each block.
+
+    The thread is started by `start()`, which is cheap to call again and
+    starts a new thread in a forked process (e.g. in the workers of a
+    pre-forking server), where the thread of the parent does not exist.
+
+    """
+
+    name = None
+
+    def __init__(self, interval=2.0):
+        self.interval = interval
+        self._callbacks = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stopped = threading.Event()
+
+    def add(self, path, callback):
+        with self._lock:
+            self._callbacks[path] = callback
+            if self._pid == os.getpid():
+                self._added(path)
+
+    def remove(self, path):
+        with self._lock:
+            self._callbacks.pop(path, None)
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._setup()
+            thread = threading.Thread(
+                target=self._run, name="watch %s" % (self.name,), daemon=True
+            )
+            thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _setup(self):
+        pass
+
+    def _added(self, path):
+        pass
+
+    def _run(self):
+        raise NotImplementedError()
+
+    def _notify(self, paths):
+        for path in sorted(paths):
+            with self._lock:
+                callback = self._callbacks.get(path)
+            if callback is None:
+                continue
+            try:
+                callback()
+            except Exception:
+                LOG.exception("Cannot process the changes to %s", path)
+
+
+class PollingWatcher(Watcher):
+    """Calls all the callbacks every `interval` seconds."""
+
+    name = "polling"
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                paths = list(self._callbacks)
+            self._notify(paths)
+
+
+class InotifyWatcher(Watcher):
+    """Calls the callbacks of the paths changed, as reported by inotify."""
+
+    name = "inotify"
+
+    def __init__(self, interval=2.0):
+        super(InotifyWatcher, self).__init__(interval)
+        self._libc = _libc()
+        # Fails here if inotify is not available, so that
+        # `create_watcher()` can fall back to polling
+        self._fd = self._init()
+        self._fd_pid = os.getpid()
+        # Watch descriptor => directory, and the paths it is a part of
+        self._directories = {}
+        self._paths = {}
+
+    def _init(self):
+        fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        return fd
+
+    def _setup(self):
+        if self._fd_pid != os.getpid():
+            # Inherited from the parent process
+            if self._fd is not None:
+                os.close(self._fd)
+            self._fd = None
+            self._fd_pid = os.getpid()
+            try:
+                self._fd = self._init()
+            except OSError as exc:
+                LOG.warning("Cannot use inotify, polling instead: %s", exc)
+                return
+
+        self._directories = {}
+        self._paths = {}
+        for path in self._callbacks:
+            self._added(path)
+
+    def _added(self, path):
+        if self._fd is None:
+            return
+        directory = path if os.path.isdir(path) else os.path.dirname(path)
+        self._watch_tree(directory, path)
+
+    def _watch_tree(self, directory, path):
+        self._watch(directory, path)
+        for root, dirs, _ in os.walk(directory):
+            for name in dirs:
+                self._watch(os.path.join(root, name), path)
+
+    def _watch(self, directory, path):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), MASK)
+        if wd < 0:
+            LOG.warning(
+                "Cannot watch %s: %s", directory, os.strerror(ctypes.get_errno())
+            )
+            return
+        self._directories[wd] = directory
+        self._paths.setdefault(wd, set()).add(path)
+
+    def _run(self):
+        if self._fd is None:
+            return PollingWatcher._run(self)
+
+        fd = self._fd
+        # Path => time of its first change not yet notified
+        pending = {}
+        while not self._stopped.is_set():
+            timeout = 1.0
+            if pending:
+                due = min(pending.values()) + self.interval - time.monotonic()
+                timeout = max(0, min(due, timeout))
+
+            ready, _, _ = select.select([fd], [], [], timeout)
+            now = time.monotonic()
+            if ready:
+                for path in self._read(fd):
+                    pending.setdefault(path, now)
+
+            due = [path for path, t in pending.items() if now - t >= self.interval]
+            for path in due:
+                del pending[path]
+            self._notify(due)
+
+    def _read(self, fd):
+        """The paths changed, from the events available."""
+        try:
+            data = os.read(fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        offset = 0
+        with self._lock:
+            while offset < len(data):
+                wd, mask, _, size = _EVENT.unpack_from(data, offset)
+                name = data[offset + _EVENT.size : offset + _EVENT.size + size]
+                offset += _EVENT.size + size
+
+                if mask & IN_Q_OVERFLOW:
+                    # Some events were lost
+                    changed.update(self._callbacks)
+                    continue
+
+                paths = self._paths.get(wd, ())
+                changed.update(paths)
+
+                if mask & IN_IGNORED:
+                    self._directories.pop(wd, None)
+                    self._paths.pop(wd, None)
+                elif mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    directory = os.path.join(
+                        self._directories[wd], os.fsdecode(name.rstrip(b"\0"))
+                    )
+                    for path in list(paths):
+                        self._watch_tree(directory, path)
+
+        return changed
+
+
+def _libc():
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+def create_watcher(interval=2.0):
+    """An inotify watcher where available, a polling one otherwise."""
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(interval)
+        except (AttributeError, OSError) as exc:
+            LOG.warning("Cannot use inotify, polling instead: %s", exc)
+    return PollingWatcher(interval)
@@ -6,11 +6,16 @@
 # granted to it by virtue of its status as an intergovernmental organisation nor
 # does it submit to any jurisdiction.
 
+import copy
 import datetime
+import functools
+import itertools
 import logging
 from skinnywms import errors
 import weakref
 
+import numpy as np
+
 __all__ = [
     "Availability",
     "CRS",
@@ -21,6 +26,10 @@ __all__ = [
 
 LOG = logging.getLogger(__name__)
 
+# Catalog versions are drawn from a single process-wide sequence, so that two
+# different catalogs can never share a version number.
+_VERSIONS = itertools.count(1)
+
 
 class CRS:
     def __init__(self, name, n_lat, s_lat, w_lon, e_lon):
@@ -57,7 +66,7 @@ class Style:
             name=self.name,
             title=self.title,
             description=self.description,
-            config=[s.as_dict() for s in self.config],
+            config=[s.as_dict() for s in self.config or []],
         )
 
     def adjust_netcdf_plotting(self, params):
@@ -68,6 +77,23 @@ class Style:
 
 
 class Field:
+
+    __slots__ = ()
+
+    # Vertical coordinate of the field, for layers with several levels
+    elevation = None
+
+    def row(self):
+        """The (path, index, offset) of the field in its file, if `view()`
+        can recreate the field from them, or None.
+
+        """
+        return None
+
+    def view(self, path, index, offset, time):
+        """A field like this one, for another message of the same layer."""
+        raise NotImplementedError
+
     def style(self, name):
 
         if name == "":
@@ -100,57 +126,336 @@ class Dimension:
         self.extent = extent
 
 
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def as_seconds(time):
+    """Convert a naive UTC datetime to seconds since the epoch."""
+    return (time - _EPOCH) // datetime.timedelta(seconds=1)
+
+
+def _parse_instant(value):
+    if value.endswith("Z"):
+        value = value[:-1]
+    time = datetime.datetime.fromisoformat(value)
+    if time.tzinfo is not None:
+        time = time.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return as_seconds(time)
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_time(value):
+    """Parse a WMS time value into a (start, end) pair of seconds since the
+    epoch. A single instant gives start == end, 'current' gives (None, None)
+    and an open-ended interval gives end = None. The period of an interval is
+    ignored.
+
+    """
+    parts = [p.strip() for p in value.strip().split("/")]
+
+    if len(parts) == 1:
+        if parts[0].lower() in ("current", "present"):
+            return None, None
+        instant = _parse_instant(parts[0])
+        return instant, instant
+
+    if len(parts) not in (2, 3):
+        raise ValueError("Invalid time interval '%s'" % (value,))
+
+    start = _parse_instant(parts[0])
+    if parts[1].lower() in ("current", "present"):
+        return start, None
+    return start, _parse_instant(parts[1])
+
+
+def _iso_period(seconds, time_unit):
+    if time_unit == "minutes" or seconds % 3600:
+        if seconds % 60 == 0:
+            return "PT%dM" % (seconds // 60,)
+        return "PT%dS" % (seconds,)
+    return "PT%dH" % (seconds // 3600,)
+
+
+def _time_extent(seconds, time_unit):
+    """Compress a sorted array of times (in seconds) into a WMS time extent.
+    Runs of at least three equally spaced times are written as ISO 8601
+    start/end/period intervals.
+
+    """
+    iso = np.char.add(np.datetime_as_string(seconds.astype("datetime64[s]")), "Z")
+
+    if len(seconds) < 3:
+        return ",".join(iso)
+
+    steps = np.diff(seconds)
+    starts = np.flatnonzero(np.concatenate(([True], steps[1:] != steps[:-1])))
+    ends = np.append(starts[1:], len(steps))
+
+    extent = []
+    done = 0
+    for start, end in zip(starts, ends):
+        # The first time of a run may already be the end of the previous interval
+        first = max(start, done)
+        if end - first >= 2:
+            extent.extend(iso[done:first])
+            extent.append(
+                "/".join([iso[first], iso[end], _iso_period(steps[start], time_unit)])
+            )
+            done = end + 1
+
+    extent.extend(iso[done:])
+    return ",".join(extent)
+
+
+class TimeIndex:
+    """Sorted array of unique times, in seconds since the epoch, each with the
+    row of its field in a `FieldTable`.
+
+    """
+
+    def __init__(self):
+        self._seconds = np.empty((16,), dtype=np.int64)
+        self._rows = np.empty((16,), dtype=np.int32)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def seconds(self):
+        return self._seconds[: self._size]
+
+    @property
+    def rows(self):
+        return self._rows[: self._size]
+
+    def add(self, time, row=-1):
+        """Insert a time in the index. Returns False if it was already there,
+        in which case only its row is updated.
+
+        """
+        value = as_seconds(time)
+        seconds = self.seconds
+        i = int(np.searchsorted(seconds, value))
+        if i < self._size and seconds[i] == value:
+            self._rows[i] = row
+            return False
+
+        if self._size == len(self._seconds):
+            self._seconds = np.concatenate((self._seconds, np.empty_like(self._seconds)))
+            self._rows = np.concatenate((self._rows, np.empty_like(self._rows)))
+
+        self._seconds[i + 1 : self._size + 1] = self._seconds[i : self._size]
+        self._rows[i + 1 : self._size + 1] = self._rows[i : self._size]
+        self._seconds[i] = value
+        self._rows[i] = row
+        self._size += 1
+        return True
+
+    def at(self, index):
+        return int(self.seconds[index])
+
+    def copy(self):
+        index = copy.copy(self)
+        index._seconds = self._seconds.copy()
+        index._rows = self._rows.copy()
+        return index
+
+    def row(self, value):
+        """The row of a time of the index, or None if it is not there."""
+        i = int(np.searchsorted(self.seconds, value))
+        if i < self._size and self._seconds[i] == value:
+            return int(self._rows[i])
+        return None
+
+    def match(self, value, matching="nearest"):
+        """Find a time in the index, using one of the 'exact', 'previous',
+        'next' or 'nearest' matching policies. Returns None if there is no
+        suitable time.
+
+        """
+        seconds = self.seconds
+        i = int(np.searchsorted(seconds, value))
+
+        if i < self._size and seconds[i] == value:
+            return value
+
+        if matching == "previous":
+            return int(seconds[i - 1]) if i > 0 else None
+
+        if matching == "next":
+            return int(seconds[i]) if i < self._size else None
+
+        if matching == "nearest":
+            candidates = seconds[max(i - 1, 0) : i + 1]
+            if len(candidates):
+                return int(candidates[np.argmin(np.abs(candidates - value))])
+
+        return None
+
+    def last_within(self, start, end):
+        """Return the latest time between start and end (both inclusive)."""
+        seconds = self.seconds
+        if end is None:
+            i = self._size
+        else:
+            i = int(np.searchsorted(seconds, end, side="right"))
+        if i > 0 and seconds[i - 1] >= start:
+            return int(seconds[i - 1])
+        return None
+
+
 class TimeDimension:
-    def __init__(self, times, time_unit="hours"):
 
-        times = sorted(times)
+    __slots__ = ("_default", "_extent", "_nearest_value")
 
-        self.name = "time"
-        self.units = "ISO8601"
-        self.default = times[0].isoformat() + "Z"
+    def __init__(self, times, time_unit="hours", nearest_value=False):
+        seconds = np.unique(np.array([as_seconds(t) for t in times], dtype=np.int64))
+        self._init(seconds, time_unit, nearest_value)
 
-        extent = []
-        last_step = None
-        last_iso = None
+    @classmethod
+    def from_seconds(cls, seconds, time_unit="hours", nearest_value=False):
+        """Build the dimension from an already sorted array of unique times."""
+        dimension = cls.__new__(cls)
+        dimension._init(seconds, time_unit, nearest_value)
+        return dimension
 
-        prev = times[0]
+    def _init(self, seconds, time_unit, nearest_value):
+        self._nearest_value = nearest_value
+        self._default = np.datetime_as_string(seconds[0].astype("datetime64[s]")) + "Z"
+        self._extent = _time_extent(seconds, time_unit)
 
-        def step_diff(date1, date2, seconds):
-            step = date1 - date2
-            return step.days * 24 + step.seconds / seconds
+    @property
+    def name(self):
+        return "time"
+
+    @property
+    def units(self):
+        return "ISO8601"
+
+    @property
+    def default(self):
+        return self._default
 
-        if time_unit == "hours":
-            seconds = 3600
-            unit = "H"
+    @property
+    def extent(self):
+        return self._extent
 
-        if time_unit == "minutes":
-            seconds = 60
-            unit = "M"
+    @property
+    def nearest_value(self):
+        return self._nearest_value
 
-        for time in times:
-            iso = time.isoformat() + "Z"
 
-            step = step_diff(time, prev, seconds)
-            prev = time
-            if step == last_step:
-                extent[-1] = "/".join([last_iso, iso, "PT%d%s" % (step, unit)])
-            else:
-                extent.append(iso)
-                last_step = step
-                last_iso = iso
+class StringTable:
+    """Strings shared by the fields of a catalog, such as the paths of their
+    files, each kept once and referred to by its number.
+
+    """
+
+    def __init__(self):
+        self._strings = []
+        self._numbers = {}
+
+    def __len__(self):
+        return len(self._strings)
+
+    def __getitem__(self, number):
+        return self._strings[number]
+
+    def number(self, string):
+        number = self._numbers.get(string)
+        if number is None:
+            number = self._numbers[string] = len(self._strings)
+            self._strings.append(string)
+        return number
+
+
+_ROW = np.dtype(
+    [("path", np.int32), ("index", np.int32), ("offset", np.int64), ("time", np.int64)]
+)
+
+
+class FieldTable:
+    """The fields of a layer, one row each. The fields that can be recreated
+    from their path, index and offset (see `Field.row()`) are only kept as
+    rows of an array, and returned as views of the first field of the layer
+    (see `Field.view()`); the others are kept as they are.
+
+    """
+
+    def __init__(self, template, strings=None):
+        self._template = template
+        self._strings = StringTable() if strings is None else strings
+        self._rows = np.empty((16,), dtype=_ROW)
+        self._objects = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def copy(self):
+        """A copy of the table, sharing the strings (which are only added
+        to) and the fields.
+
+        """
+        table = copy.copy(self)
+        table._rows = self._rows.copy()
+        table._objects = dict(self._objects)
+        return table
+
+    def append(self, field):
+        """Add a field to the table, and return its row."""
+        row = self._size
+        if self._size == len(self._rows):
+            self._rows = np.concatenate((self._rows, np.empty_like(self._rows)))
+
+        location = field.row() if field.time is not None else None
+        if location is None:
+            self._objects[row] = field
+            self._rows[row] = (-1, -1, -1, 0)
+        else:
+            path, index, offset = location
+            self._rows[row] = (
+                self._strings.number(path),
+                index,
+                offset,
+                as_seconds(field.time),
+            )
 
-        self.extent = ",".join(extent)
+        self._size += 1
+        return row
+
+    def get(self, row):
+        field = self._objects.get(row)
+        if field is None:
+            path, index, offset, seconds = self._rows[row].item()
+            field = self._template.view(
+                self._strings[path],
+                index,
+                offset,
+                _EPOCH + datetime.timedelta(seconds=seconds),
+            )
+        return field
 
 
 class DataLayer(Layer):
 
     # TODO: check the time-zone of the dates....
 
-    def __init__(self, field):
+    def __init__(self, field, time_matching="nearest", strings=None):
         super(DataLayer, self).__init__(field.name, field.title)
         assert field.time is None or isinstance(field.time, datetime.datetime)
+        self.time_matching = time_matching
         self._first = field
-        self._fields = {field.time: field}
+        self._table = FieldTable(field, strings)
+        self._times = TimeIndex()
+        self._dimensions = None
+        self._levels = {}
+        self._elevations = set()
+        row = self._table.append(field)
+        if field.time is not None:
+            self._times.add(field.time, row)
+        self._add_level(field, row)
 
     def add_field(self, field):
         assert self.name == field.name
@@ -164,10 +469,19 @@ class DataLayer(Layer):
         assert field.time is not None
         assert isinstance(field.time, datetime.datetime)
 
-        if field.time in self._fields:
+        previous = self._times.row(as_seconds(field.time))
+        # Another level of a time already there
+        level = (
+            previous is not None
+            and field.elevation is not None
+            and self._level_key(field) not in self._levels
+        )
+        if previous is None:
+            self._dimensions = None
+        elif not level:
             LOG.info(
                 "Duplicate date %s in %s (%s, %s)"
-                % (field.time, self, field, self._fields[field.time])
+                % (field.time, self, field, self._table.get(previous))
             )
 
             # # Why are we sometimes throwing this exception .. : need to be checked
@@ -176,7 +490,34 @@ class DataLayer(Layer):
             #     % (field.time, self, field, self._fields[field.time])
             # )
 
-        self._fields[field.time] = field
+        row = self._table.append(field)
+        if not level:
+            # The time keeps the row of its first level, selected by default
+            self._times.add(field.time, row)
+        self._add_level(field, row)
+
+    def copy(self):
+        """A copy of the layer, not affected by the fields added to this one."""
+        layer = copy.copy(self)
+        layer._table = self._table.copy()
+        layer._times = self._times.copy()
+        layer._levels = dict(self._levels)
+        layer._elevations = set(self._elevations)
+        return layer
+
+    def fields(self):
+        """The fields of the layer, in the order they were added."""
+        for row in range(len(self._table)):
+            yield self._table.get(row)
+
+    def _level_key(self, field):
+        return (field.time, float(field.elevation))
+
+    def _add_level(self, field, row):
+        if field.elevation is not None:
+            key = self._level_key(field)
+            self._levels[key] = row
+            self._elevations.add(key[1])
 
     @property
     def fixed_layer(self):
@@ -185,9 +526,15 @@ class DataLayer(Layer):
     @property
     def dimensions(self):
         if self.fixed_layer:
-            return []
-        else:
-            return [TimeDimension(self._fields.keys())]
+            return ()
+        if self._dimensions is None:
+            self._dimensions = (
+                TimeDimension.from_seconds(
+                    self._times.seconds,
+                    nearest_value=self.time_matching != "exact",
+                ),
+            )
+        return self._dimensions
 
     @property
     def styles(self):
@@ -198,35 +545,131 @@ class DataLayer(Layer):
         return "DataLayer[%s]" % (self.name,)
 
     def select(self, dims):
-        # TODO: select on more dimensions
-        if dims is None:
+        if dims is None or self.fixed_layer:
             return self._first
-        time = dims.get("time", None)
-        LOG.info("Look up layer with %s and time %s (%s)" % (self, time, type(time)))
-        try:
 
-            if time is None:
-                field = self._first
-            else:
-                time = datetime.datetime.strptime(time[:19], "%Y-%m-%dT%H:%M:%S")
-                field = self._fields[time]
-        except:
+        time = dims.get("time")
+        dim_index = dims.get("dim_index")
+        elevation = dims.get("elevation")
+        LOG.info(
+            "Look up layer with %s and time=%s dim_index=%s elevation=%s",
+            self,
+            time,
+            dim_index,
+            elevation,
+        )
+
+        if time:
+            field = self._table.get(self._times.row(self._select_time(time)))
+        elif dim_index:
+            field = self._table.get(self._times.row(self._select_index(dim_index)))
+        else:
             field = self._first
+
+        if elevation and len(self._elevations) > 1:
+            field = self._table.get(self._select_elevation(field.time, elevation))
+
         return field
 
+    def _select_time(self, value):
+        try:
+            start, end = parse_time(value)
+        except ValueError as exc:
+            raise errors.InvalidDimensionValue(
+                "Invalid time '%s' for layer '%s': %s" % (value, self.name, exc)
+            )
+
+        if start is None:
+            seconds = self._times.at(-1)
+        elif start == end:
+            seconds = self._times.match(start, self.time_matching)
+        else:
+            seconds = self._times.last_within(start, end)
+
+        if seconds is None:
+            raise errors.InvalidDimensionValue(
+                "No time matching '%s' for layer '%s'" % (value, self.name)
+            )
+
+        return seconds
+
+    def _select_index(self, value):
+        try:
+            return self._times.at(int(value))
+        except (ValueError, IndexError):
+            raise errors.InvalidDimensionValue(
+                "Invalid dim_index '%s' for layer '%s'" % (value, self.name)
+            )
+
+    def _select_elevation(self, time, value):
+        try:
+            return self._levels[(time, float(value))]
+        except (ValueError, KeyError):
+            raise errors.InvalidDimensionValue(
+                "Invalid elevation '%s' for layer '%s'" % (value, self.name)
+            )
+
     def as_dict(self):
+        if self.fixed_layer:
+            fields = [self._first]
+        else:
+            fields = [self._table.get(row) for row in self._times.rows]
         return dict(
             _class=self.__class__.__module__ + "." + self.__class__.__name__,
-            fields=[field.as_dict() for _, field in sorted(self._fields.items())],
+            fields=[field.as_dict() for field in fields],
         )
 
 
+class Catalog:
+    """The layers of an `Availability`. A catalog being built can be filled
+    while the previous one is still used: once published (see
+    `Availability.publish()`), requests may be using it from any thread.
+
+    """
+
+    def __init__(self, time_matching="nearest"):
+        self.layers = {}
+        self.aliases = {}
+        self.time_matching = time_matching
+        self.version = next(_VERSIONS)
+        self._strings = StringTable()
+
+    def copy(self):
+        """A copy of the catalog, which can be published while fields are
+        still added to this one.
+
+        """
+        catalog = copy.copy(self)
+        catalog.layers = {name: layer.copy() for name, layer in self.layers.items()}
+        catalog.aliases = dict(self.aliases)
+        return catalog
+
+    def fields(self):
+        for layer in self.layers.values():
+            yield from layer.fields()
+
+    def add_field(self, field):
+        # TODO: Use config....
+        if not self.layers:
+            self.aliases["default"] = field.name
+
+        if field.name in self.layers:
+            self.layers[field.name].add_field(field)
+        else:
+            self.layers[field.name] = DataLayer(
+                field, self.time_matching, self._strings
+            )
+
+        self.version = next(_VERSIONS)
+
+
 class Availability:
-    def __init__(self, auto_add_plotter_layers=True):
+    def __init__(self, auto_add_plotter_layers=True, time_matching="nearest"):
         self._context = None
-        self._layers = {}
-        self._aliases = {}
         self._auto_add_plotter_layers = auto_add_plotter_layers
+        self._time_matching = time_matching
+        self._catalog = self.new_catalog()
+        self._layers_as_dict = (None, None)
 
     @property
     def context(self):
@@ -240,44 +683,79 @@ class Availability:
     def auto_add_plotter_layers(self):
         return self._auto_add_plotter_layers
 
+    @property
+    def version(self):
+        """Version of the catalog, changed every time the catalog is modified."""
+        return self._catalog.version
+
+    def changed(self):
+        self._catalog.version = next(_VERSIONS)
+
+    def new_catalog(self):
+        return Catalog(self._time_matching)
+
+    def publish(self, catalog):
+        """Replace the catalog. Requests already being processed keep the
+        previous one.
+
+        """
+        self._catalog = catalog
+
+    def load(self):
+        pass
+
+    @property
+    def loaded(self):
+        return bool(self._catalog.layers)
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
     def add_field(self, field):
-        # TODO: Use config....
-        if not self._layers:
-            self._aliases["default"] = field.name
+        self._catalog.add_field(field)
 
-        if field.name in self._layers:
-            self._layers[field.name].add_field(field)
-        else:
-            self._layers[field.name] = DataLayer(field)
+    def has_layer(self, name):
+        """Whether a layer is in the catalog, without loading it."""
+        catalog = self._catalog
+        return name in catalog.layers or name in catalog.aliases
 
     def layers(self):
-        if not self._layers:
-            self.load()
+        self.ensure_loaded()
         # TODO: Sort
-        return [l for l in self._layers.values()]
+        return [l for l in self._catalog.layers.values()]
 
     def layer(self, name, dims):
-        if not self._layers:
-            self.load()
+        self.ensure_loaded()
+        catalog = self._catalog
 
         LOG.info("Look up layer with name %s and dims %s", name, dims)
 
-        while name in self._aliases:
-            name = self._aliases[name]
+        while name in catalog.aliases:
+            name = catalog.aliases[name]
 
-        if name not in self._layers:
+        if name not in catalog.layers:
             raise errors.LayerNotDefined("Unknown layer '{}'".format(name))
 
         # TODO: select on othe dimenstions as well
-        return self._layers[name].select(dims)
+        return catalog.layers[name].select(dims)
 
     def as_dict(self):
-        if not self._layers:
-            self.load()
+        self.ensure_loaded()
+        catalog = self._catalog
+
+        # Describing the fields may read their files and find their styles,
+        # so only once for each version of the catalog
+        version, layers = self._layers_as_dict
+        if version != catalog.version:
+            version = catalog.version
+            layers = [layer.as_dict() for layer in catalog.layers.values()]
+            self._layers_as_dict = (version, layers)
+
         return dict(
             _class=self.__class__.__module__ + "." + self.__class__.__name__,
-            aliases=self._aliases,
-            layers=[layer.as_dict() for layer in self._layers.values()],
+            aliases=catalog.aliases,
+            layers=layers,
         )
 
 
@@ -330,3 +808,7 @@ class Styler:
     # @property.setter
     def set_context(self, context):
         self._context = weakref.ref(context)
+
+    def save(self):
+        """Keep the styles found so far, e.g. in a cache on disk."""
+        pass
@@ -9,6 +9,7 @@
 
 __all__ = [
     "CurrentUpdateSequence",
+    "DatasetNotDefined",
     "GenericError",
     "InvalidCRS",
     "InvalidDimensionValue",
@@ -19,7 +20,9 @@ __all__ = [
     "LayerNotQueryable",
     "MissingDimensionValue",
     "OperationNotSupported",
+    "RequestCancelled",
     "ServiceNotDefined",
+    "ServiceUnavailable",
     "StyleNotDefined",
     "version_param",
     "wrap",
@@ -56,9 +59,16 @@ class WMSError(Exception):
 
     """Base class for WMS errors."""
 
+    # HTTP status of the response carrying the exception report
+    status = 200
+
     def __init__(self, message):
         super(WMSError, self).__init__(message)
 
+    def headers(self):
+        """Return the extra HTTP headers of the response."""
+        return {}
+
     def body(self, version):
         """Return the response body for this WMS error."""
         if version == "1.1.1":
@@ -150,6 +160,19 @@ class LayerNotDefined(WMSError):
     """Request is for a Layer not offered by the service instance."""
 
 
+class DatasetNotDefined(LayerNotDefined):
+
+    """Request is for a dataset (model, date and time) not offered by the
+    service instance.
+
+    """
+
+    status = 404
+
+    def code(self, version):
+        return LayerNotDefined.__module__ + "." + LayerNotDefined.__name__
+
+
 class LayerNotQueryable(WMSError):
 
     """GetFeatureInfo request is applied to a Layer which is not declared
@@ -174,11 +197,36 @@ class OperationNotSupported(WMSError):
     """
 
 
+class RequestCancelled(GenericError):
+
+    """The client went away before its request could be processed."""
+
+    # Not a standard status, but the one used by nginx for that case
+    status = 499
+
+
 class ServiceNotDefined(WMSError):
 
     """The requested service is not available in this service instance."""
 
 
+class ServiceUnavailable(GenericError):
+
+    """The server is too busy to handle the request. The client may try
+    again after `retry_after` seconds.
+
+    """
+
+    status = 503
+
+    def __init__(self, message, retry_after=1):
+        super(ServiceUnavailable, self).__init__(message)
+        self.retry_after = retry_after
+
+    def headers(self):
+        return {"Retry-After": str(self.retry_after)}
+
+
 class StyleNotDefined(WMSError):
 
     """Request is for a Layer in a Style not offered by the service
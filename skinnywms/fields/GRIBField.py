@@ -8,7 +8,9 @@
 
 from skinnywms import datatypes
 import logging
-from skinnywms import grib_bindings
+import weakref
+from skinnywms import grib_bindings, metrics
+from skinnywms.grib_bindings import cache
 
 
 companions = { "10u" : "10v" , "10v" : "10u" }
@@ -16,19 +18,43 @@ companions = { "10u" : "10v" , "10v" : "10u" }
 ucomponents = ["10u"]
 vcomponents = ["10v"]
 
-possible_matches = {}
+# Geometries shared by the GRIB fields
+metrics.REGISTRY.caches(cache.stats)
 
 
 class GRIBField(datatypes.Field):
 
+    # Catalogs hold millions of fields, so no __dict__
+    __slots__ = (
+        "path",
+        "index",
+        "offset",
+        "time",
+        "levtype",
+        "shortName",
+        "name",
+        "title",
+        "levelist",
+        "wind",
+        "ucomponent",
+        "vcomponent",
+        "_mars",
+        "_styles",
+        "_context",
+    )
+
     log = logging.getLogger(__name__)
 
-    def __init__(self, context, path, grib, index):
+    def __init__(self, context, path, grib, index, matches=None):
 
         self.path = path
         self.index = index
-        self.mars = grib.mars_request
-        self.render = self.render_contour
+        self.offset = grib.offset
+        # Only read when needed, see `mars` and `styles`
+        self._mars = None
+        self._styles = None
+        self._context = weakref.ref(context)
+        self.wind = False
 
         self.time = grib.valid_date
         self.levtype = grib.levtype
@@ -42,29 +68,17 @@ class GRIBField(datatypes.Field):
             self.title = "%s at %s" % (grib.name, grib.levelist)
             self.levelist = grib.levelist
 
-        if self.shortName in companions:
-            companion = companions[self.shortName]
-            matches = possible_matches.get(companion, [])
-            
-            found = False
-            for match in matches:
-                found = self.match(match)
-                if found :
-                    break; 
-            if not found:
-                if self.name not in possible_matches: 
-                    possible_matches[self.name] = [self]
-                else:
-                    possible_matches[self.name].append(self)
-    
-        key = "style.grib.%s" % (self.name,)
+        # The components of the winds are paired within a file, see
+        # `GRIBReader.get_fields()`
+        if matches is not None and self.shortName in companions:
+            candidates = matches.get(companions[self.shortName], [])
 
-        # Optimisation
-        self.styles = context.stash.get(key)
-        if self.styles is None:
-            self.styles = context.stash[key] = context.styler.grib_styles(
-                self, grib, path, index
-            )
+            for i, candidate in enumerate(candidates):
+                if self.match(candidate):
+                    del candidates[i]
+                    break
+            else:
+                matches.setdefault(self.name, []).append(self)
 
     def match(self, companion):
         if self.time != companion.time: 
@@ -75,7 +89,7 @@ class GRIBField(datatypes.Field):
             if self.levelist != companion.levelist: 
                 return False
         #  Found a match WE have a vector
-        self.render = self.render_wind
+        self.wind = True
         if self.name in ucomponents:
             self.ucomponent = self.index
             self.vcomponent = companion.index
@@ -105,6 +119,74 @@ class GRIBField(datatypes.Field):
         
 
 
+    def _message(self):
+        return grib_bindings.GribFile(self.path, headers_only=True).at_offset(
+            self.offset
+        )
+
+    @property
+    def mars(self):
+        if self._mars is None:
+            self._mars = self._message().mars_request
+        return self._mars
+
+    def identity(self):
+        """What Magics chooses the styles of the field from."""
+        grib = self._message()
+        identity = dict(
+            paramId=grib.get("paramId"),
+            shortName=self.shortName,
+            levtype=self.levtype,
+            units=grib.get("units"),
+        )
+        if self.levtype != "sfc":
+            identity["levelist"] = self.levelist
+        return identity
+
+    @property
+    def styles(self):
+        if self._styles is None:
+            key = "style.grib.%s" % (self.name,)
+            context = self._context()
+
+            # Optimisation
+            self._styles = context.stash.get(key)
+            if self._styles is None:
+                self._styles = context.stash[key] = context.styler.grib_styles(
+                    self, None, self.path, self.index
+                )
+        return self._styles
+
+    def row(self):
+        # The components of the winds are not in the table
+        if self.wind:
+            return None
+        return (self.path, self.index, self.offset)
+
+    def view(self, path, index, offset, time):
+        field = GRIBField.__new__(GRIBField)
+        field.path = path
+        field.index = index
+        field.offset = offset
+        field.time = time
+        field._mars = None
+        field._styles = self._styles
+        field._context = self._context
+        field.wind = False
+
+        field.levtype = self.levtype
+        field.shortName = self.shortName
+        field.name = self.name
+        field.title = self.title
+        if self.levtype != "sfc":
+            field.levelist = self.levelist
+        return field
+
+    def render(self, context, driver, style, legend={}):
+        if self.wind:
+            return self.render_wind(context, driver, style, legend)
+        return self.render_contour(context, driver, style, legend)
+
     def render_contour(self, context, driver, style, legend={}):
         data = []
         params = dict(
@@ -149,28 +231,51 @@ class GRIBField(datatypes.Field):
         )
 
     def __repr__(self):
-        return "GRIBField[%r,%r,%r]" % (self.path, self.index, self.mars)
+        return "GRIBField[%r,%r,%r]" % (self.path, self.index, self.name)
 
 
 class GRIBReader:
 
-    """Get WMS layers from a GRIB file."""
+    """Get WMS layers from a GRIB file.
+
+    The scan can be resumed from the end of the last message read (see
+    `resume()`), e.g. for a file still being written, so that only the
+    messages added since are read. A message partially written at the end of
+    the file is not read, and is read by the next scan once complete.
+
+    """
 
     log = logging.getLogger(__name__)
 
-    def __init__(self, context, path):
+    def __init__(self, context, path, offset=0, index=0):
         self.path = path
         self.context = context
+        self.offset = offset
+        self.index = index
 
     def get_fields(self):
-        self.log.info("Scanning file: %s", self.path)
+        self.log.info("Scanning file: %s from offset %s", self.path, self.offset)
 
         fields = []
-
-        for i, m in enumerate(grib_bindings.GribFile(self.path)):
-            fields.append(GRIBField(self.context, self.path, m, i))
-
-        if not fields:
+        # Components of the winds not yet paired, by name
+        matches = {}
+
+        # The fields only need the keys, the values are decoded by Magics
+        grib = grib_bindings.GribFile(self.path, headers_only=True)
+        grib.seek(self.offset)
+        for m in grib:
+            fields.append(GRIBField(self.context, self.path, m, self.index, matches))
+            self.index += 1
+            self.offset = grib.tell()
+
+        if not fields and self.index == 0:
             raise Exception("GRIBReader no 2D fields found in %s", self.path)
 
         return fields
+
+    def resume(self):
+        """Where to resume the scan of the file: the end of the last message
+        read, and the index of the next one.
+
+        """
+        return (self.offset, self.index)
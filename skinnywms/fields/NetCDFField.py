@@ -10,6 +10,7 @@ from skinnywms import datatypes
 import logging
 import datetime
 import os
+import weakref
 
 from contextlib import closing
 from itertools import product
@@ -58,6 +59,10 @@ class TimeSlice(Slice):
     pass
 
 
+class LevelSlice(Slice):
+    pass
+
+
 class Coordinate:
     def __init__(self, variable, info):
         self.variable = variable
@@ -97,7 +102,7 @@ class TimeCoordinate(Coordinate):
 class LevelCoordinate(Coordinate):
     # This class is just in case we want to specialise
     # 'level', othewise, it is the same as OtherCoordinate
-    slice_class = Slice
+    slice_class = LevelSlice
     is_dimension = False
     convert = as_level
 
@@ -148,17 +153,38 @@ class NetCDFField(datatypes.Field):
             if isinstance(s, TimeSlice):
                 self.time = s.value
 
+            if isinstance(s, LevelSlice):
+                self.elevation = s.value
+
             if s.is_info:
                 self.title += " (" + s.name + "=" + str(s.value) + ")"
 
-        key = "style.netcdf.%s" % (self.name,)
-
-        # Optimisation
-        self.styles = context.stash.get(key)
-        if self.styles is None:
-            self.styles = context.stash[key] = context.styler.netcdf_styles(
-                self, ds[variable], path, variable
-            )
+        # What Magics chooses the styles from, see `identity`
+        self._attributes = {
+            k: str(v) for k, v in ds[self.variable].attrs.items()
+        }
+
+        # Only looked up when needed, see `styles`
+        self._styles = None
+        self._context = weakref.ref(context)
+
+    @property
+    def styles(self):
+        if self._styles is None:
+            key = "style.netcdf.%s" % (self.name,)
+            context = self._context()
+
+            # Optimisation
+            self._styles = context.stash.get(key)
+            if self._styles is None:
+                self._styles = context.stash[key] = context.styler.netcdf_styles(
+                    self, None, self.path, self.variable
+                )
+        return self._styles
+
+    def identity(self):
+        """What Magics chooses the styles of the field from."""
+        return dict(variable=self.variable, attributes=self._attributes)
 
     def render(self, context, driver, style, legend={}):
 
@@ -8,9 +8,10 @@
 #
 
 import datetime
+
 import numpy as np
 
-from .bindings import grib_handle_delete, grib_get, grib_values
+from .bindings import grib_handle_delete, grib_get, grib_values, grib_decode
 from .bindings import (
     grib_get_keys_values,
     grib_get_gaussian_latitudes,
@@ -18,10 +19,11 @@ from .bindings import (
     grib_get_size,
     grib_get_code,
 )
+from .cache import GAUSSIAN_CACHE, REDUCED_CACHE, REGULAR_CACHE
 
 
-REGULAR_CACHE = {}
-REDUCED_CACHE = {}
+def gaussian_latitudes(N):
+    return GAUSSIAN_CACHE.get_or_create(N, lambda: grib_get_gaussian_latitudes(N))
 
 
 class Regular(object):
@@ -30,27 +32,14 @@ class Regular(object):
         assert grib.scanningMode == 0
         return grib.values.reshape((grib.Nj, grib.Ni))
 
-    def coordinates(self, grib, coords, combine_order, attributes, dims):
-
-        key = self.cache_key(grib)
-        _coords, _attributes = REGULAR_CACHE.get(key, (None, None))
-
-        if _coords is None:
-
-            _coords = {}
-            _attributes = {}
-
-            _coords["latitude"] = self.latitudes(grib)
-            _attributes["latitude"] = dict(
-                long_name="Latitude", units="degrees_north", standard_name="latitude"
-            )
-
-            _coords["longitude"] = self.longitudes(grib)
-            _attributes["longitude"] = dict(
-                long_name="Longitude", units="degrees_east", standard_name="longitude"
-            )
+    def coordinates(
+        self, grib, coords, combine_order, attributes, dims, dtype=np.float64
+    ):
 
-        REGULAR_CACHE[key] = (_coords, _attributes)
+        key = (self.cache_key(grib), np.dtype(dtype).str)
+        _coords, _attributes = REGULAR_CACHE.get_or_create(
+            key, lambda: self._coordinates(grib, dtype)
+        )
 
         coords.update(_coords)
         attributes.update(_attributes)
@@ -58,6 +47,22 @@ class Regular(object):
         dims.append("latitude")
         dims.append("longitude")
 
+    def _coordinates(self, grib, dtype):
+        _coords = {}
+        _attributes = {}
+
+        _coords["latitude"] = self.latitudes(grib).astype(dtype, copy=False)
+        _attributes["latitude"] = dict(
+            long_name="Latitude", units="degrees_north", standard_name="latitude"
+        )
+
+        _coords["longitude"] = self.longitudes(grib).astype(dtype, copy=False)
+        _attributes["longitude"] = dict(
+            long_name="Longitude", units="degrees_east", standard_name="longitude"
+        )
+
+        return _coords, _attributes
+
 
 class RegularLL(Regular):
     def cache_key(self, grib):
@@ -103,7 +108,7 @@ class RegularGG(Regular):
 
     def latitudes(self, grib):
         assert grib.scanningMode == 0
-        return grib_get_gaussian_latitudes(grib.N)
+        return gaussian_latitudes(grib.N)
 
     def longitudes(self, grib):
         assert grib.scanningMode == 0
@@ -124,63 +129,81 @@ def reduced_grid(pl_array, latitudes):
             yield lat, lon
 
 
+def reduced_grid_coordinates(pl_array, latitudes, dtype=np.float64):
+    """Vectorised version of reduced_grid(), returns the latitudes and
+    longitudes of all the points of the grid as two arrays.
+
+    """
+    rows = min(len(pl_array), len(latitudes))
+    pl = np.asarray(pl_array[:rows], dtype=np.int64)
+
+    lats = np.repeat(np.asarray(latitudes[:rows], dtype=dtype), pl)
+
+    # Position of each point in its row, then (360.0 * n) / pl as in reduced_grid()
+    lons = np.arange(lats.size, dtype=np.float64)
+    lons -= np.repeat(np.cumsum(pl) - pl, pl)
+    lons *= 360.0
+    lons /= np.repeat(pl, pl)
+
+    return lats, lons.astype(dtype, copy=False)
+
+
 class Reduced(object):
     def array(self, grib):
         assert grib.scanningMode == 0
         return grib.values.reshape((grib.numberOfDataPoints,))
 
-    def coordinates(self, grib, coords, combine_order, attributes, dims):
+    def coordinates(
+        self, grib, coords, combine_order, attributes, dims, dtype=np.float64
+    ):
 
-        key = self.cache_key(grib)
-        _coords, _attributes = REDUCED_CACHE.get(key, (None, None))
+        key = (self.cache_key(grib), np.dtype(dtype).str)
+        _coords, _attributes = REDUCED_CACHE.get_or_create(
+            key, lambda: self._coordinates(grib, dtype)
+        )
 
-        if _coords is None:
+        coords.update(_coords)
+        attributes.update(_attributes)
 
-            _coords = {}
-            _attributes = {}
+        combine_order.append(("rgrid", 0))
+        dims.append("rgrid")
 
-            # TODO: that may not be the fastest way...
-            n = grib.numberOfDataPoints
-            lats = np.ndarray((n,))
-            lons = np.ndarray((n,))
-            i = 0
-            for lat, lon in reduced_grid(grib.pl_array, self.latitudes(grib)):
-                lats[i] = lat
-                lons[i] = lon
-                i = i + 1
+    def _coordinates(self, grib, dtype):
+        _coords = {}
+        _attributes = {}
 
-            _coords["latitude"] = ("rgrid", lats.reshape((n,)))
-            _attributes["latitude"] = dict(
-                long_name="Latitude", units="degrees_north", standard_name="latitude"
-            )
-
-            _coords["longitude"] = ("rgrid", lons.reshape((n,)))
-            _attributes["longitude"] = dict(
-                long_name="Longitude", units="degrees_east", standard_name="longitude"
-            )
+        n = grib.numberOfDataPoints
+        lats, lons = reduced_grid_coordinates(
+            grib.pl_array, self.latitudes(grib), dtype
+        )
+        assert lats.size == n, (lats.size, n)
 
-            """
-            See http://cfconventions.org/cf-conventions/v1.6.0/cf-conventions.html#reduced-horizontal-grid
-            Panoply can open these files. The values for latdim and londim seem irrelevant
-            """
-            londim = len(grib.pl_array)
-            latdim = n // londim
+        _coords["latitude"] = ("rgrid", lats.reshape((n,)))
+        _attributes["latitude"] = dict(
+            long_name="Latitude", units="degrees_north", standard_name="latitude"
+        )
 
-            # We use rgrid:latdim and rgrid:londim to pass the information that will
-            # be used when saving to netcdf
+        _coords["longitude"] = ("rgrid", lons.reshape((n,)))
+        _attributes["longitude"] = dict(
+            long_name="Longitude", units="degrees_east", standard_name="longitude"
+        )
 
-            _coords["rgrid"] = np.array(range(0, n))
-            _attributes["rgrid"] = dict(
-                compress="latdim londim", latdim=latdim, londim=londim
-            )
+        """
+        See http://cfconventions.org/cf-conventions/v1.6.0/cf-conventions.html#reduced-horizontal-grid
+        Panoply can open these files. The values for latdim and londim seem irrelevant
+        """
+        londim = len(grib.pl_array)
+        latdim = n // londim
 
-            REDUCED_CACHE[key] = (_coords, _attributes)
+        # We use rgrid:latdim and rgrid:londim to pass the information that will
+        # be used when saving to netcdf
 
-        coords.update(_coords)
-        attributes.update(_attributes)
+        _coords["rgrid"] = np.arange(n)
+        _attributes["rgrid"] = dict(
+            compress="latdim londim", latdim=latdim, londim=londim
+        )
 
-        combine_order.append(("rgrid", 0))
-        dims.append("rgrid")
+        return _coords, _attributes
 
     #     int rgrid(rgrid);
     # rgrid:compress = "latdim londim";
@@ -231,7 +254,7 @@ class ReducedGG(Reduced):
 
     def latitudes(self, grib):
         assert grib.scanningMode == 0
-        return grib_get_gaussian_latitudes(grib.N)
+        return gaussian_latitudes(grib.N)
 
 
 GRID_TYPES = {
@@ -333,12 +356,24 @@ class GribField(object):
                 "Unsupported level type '{}' in grib {}".format(self.levtype, path)
             )
 
+    @property
+    def offset(self):
+        """Offset of the message in its file."""
+        return self._offset
+
     @property
     def values(self):
         if self._values is None:
             self._values = grib_values(self._handle)
         return self._values
 
+    def decode(self, out=None, dtype=np.float64):
+        """Decode the values into `out` (or a new array of type `dtype`),
+        without keeping them in the field.
+
+        """
+        return grib_decode(self._handle, out=out, dtype=dtype)
+
     @property
     def array(self):
         return self._grid.array(self)
@@ -453,7 +488,7 @@ class GribField(object):
             # fall back to hours
             return datetime.timedelta(hours=step)
 
-    def coordinates(self, coords, combine_order, attributes, dims):
+    def coordinates(self, coords, combine_order, attributes, dims, dtype=np.float64):
 
         coords["reftime"] = self.base_date
         combine_order.append(("reftime", self.base_date))
@@ -475,4 +510,6 @@ class GribField(object):
             )
 
         self._levtype.coordinates(self, coords, combine_order, attributes, dims)
-        self._grid.coordinates(self, coords, combine_order, attributes, dims)
+        self._grid.coordinates(
+            self, coords, combine_order, attributes, dims, dtype=dtype
+        )
@@ -14,12 +14,13 @@ from .GribField import GribField
 
 
 class GribFile(object):
-    def __init__(self, path):
+    def __init__(self, path, headers_only=False):
 
         if path.startswith("~"):
             path = os.path.expanduser(path)
 
         self.path = path
+        self.headers_only = headers_only
         self.file = grib_file_open(path)
 
     def __del__(self):
@@ -34,13 +35,19 @@ class GribFile(object):
     def __next__(self):
         return self.next()
 
+    def seek(self, offset):
+        self.file.position(offset)
+
+    def tell(self):
+        return self.file.tell()
+
     def at_offset(self, offset):
         self.file.position(offset)
         return self.next()
 
     def next(self):
         here = self.file.tell()
-        h = self.file.next()
+        h = self.file.next(self.headers_only)
         if not h:
             raise StopIteration()
         return GribField(h, self.path, here)
@@ -11,6 +11,7 @@ import ctypes
 import ctypes.util
 import sys
 import os
+import threading
 
 import numpy as np
 from functools import partial
@@ -143,6 +144,9 @@ c_ulong_p = ctypes.POINTER(c_ulong)
 c_double = ctypes.c_double
 c_double_p = ctypes.POINTER(c_double)
 
+c_float = ctypes.c_float
+c_float_p = ctypes.POINTER(c_float)
+
 c_char = ctypes.c_char
 c_char_p = ctypes.c_char_p
 
@@ -202,6 +206,18 @@ grib_handle_new_from_file.argtypes = (grib_context_p, FILE_p, c_int_p)
 
 ####################################################################
 
+grib_new_from_file = dll.grib_new_from_file
+grib_new_from_file.restype = grib_handle_p
+grib_new_from_file.argtypes = (grib_context_p, FILE_p, c_int, c_int_p)
+
+####################################################################
+
+grib_handle_new_from_message = dll.grib_handle_new_from_message
+grib_handle_new_from_message.restype = grib_handle_p
+grib_handle_new_from_message.argtypes = (grib_context_p, c_void_p, ctypes.c_size_t)
+
+####################################################################
+
 grib_handle_new_from_message_copy = dll.grib_handle_new_from_message_copy
 grib_handle_new_from_message_copy.restype = grib_handle_p
 grib_handle_new_from_message_copy.argtypes = (grib_context_p, c_void_p, c_size_t)
@@ -324,6 +340,18 @@ _grib_get_double_array.argtypes = (grib_handle_p, c_char_p, c_double_p, c_size_t
 _grib_get_double_array = convert_strings(_grib_get_double_array)
 _grib_get_double_array = checked_return_code(_grib_get_double_array)
 
+####################################################################
+try:
+    _grib_get_float_array = dll.grib_get_float_array
+except AttributeError:
+    # Only available in recent versions of ecCodes
+    _grib_get_float_array = None
+else:
+    _grib_get_float_array.restype = c_int
+    _grib_get_float_array.argtypes = (grib_handle_p, c_char_p, c_float_p, c_size_t_p)
+    _grib_get_float_array = convert_strings(_grib_get_float_array)
+    _grib_get_float_array = checked_return_code(_grib_get_float_array)
+
 ####################################################################
 _grib_get_long_array = dll.grib_get_long_array
 _grib_get_long_array.restype = c_int
@@ -376,14 +404,27 @@ def grib_get_gaussian_latitudes(N):
 ####################################################################
 
 
+# Error code of the functions not implemented for some messages
+GRIB_NOT_IMPLEMENTED = -4
+
+
 class GribError(Exception):
     def __init__(self, err):
         super(GribError, self).__init__("%s (%s)" % (grib_get_error_message(err), err))
+        self.code = err
 
 
 grib_handle_new_from_file = partial(grib_handle_new_from_file, None)
 grib_handle_new_from_file = checked_error_in_last_paramater(grib_handle_new_from_file)
 
+####################################################################
+grib_new_from_file = partial(grib_new_from_file, None)
+grib_new_from_file = checked_error_in_last_paramater(grib_new_from_file)
+
+####################################################################
+# The message is not copied, and must outlive the handle
+grib_handle_new_from_message = partial(grib_handle_new_from_message, None)
+
 ####################################################################
 grib_handle_new_from_message_copy = partial(grib_handle_new_from_message_copy, None)
 grib_handle_new_from_message_copy = checked_error_in_last_paramater(
@@ -431,6 +472,89 @@ def grib_get_double_array(handle, name):
     return array
 
 
+####################################################################
+# Encoding, used to generate test and benchmark data
+
+grib_handle_new_from_samples = dll.grib_handle_new_from_samples
+grib_handle_new_from_samples.restype = grib_handle_p
+grib_handle_new_from_samples.argtypes = (grib_context_p, c_char_p)
+grib_handle_new_from_samples = convert_strings(grib_handle_new_from_samples)
+grib_handle_new_from_samples = partial(grib_handle_new_from_samples, None)
+
+grib_handle_clone = dll.grib_handle_clone
+grib_handle_clone.restype = grib_handle_p
+grib_handle_clone.argtypes = (grib_handle_p,)
+
+grib_set_long = dll.grib_set_long
+grib_set_long.restype = c_int
+grib_set_long.argtypes = (grib_handle_p, c_char_p, c_long)
+grib_set_long = convert_strings(grib_set_long)
+grib_set_long = checked_return_code(grib_set_long)
+
+grib_set_double = dll.grib_set_double
+grib_set_double.restype = c_int
+grib_set_double.argtypes = (grib_handle_p, c_char_p, c_double)
+grib_set_double = convert_strings(grib_set_double)
+grib_set_double = checked_return_code(grib_set_double)
+
+_grib_set_string = dll.grib_set_string
+_grib_set_string.restype = c_int
+_grib_set_string.argtypes = (
+    grib_handle_p,
+    c_char_p,
+    c_char_p,
+    ctypes.POINTER(ctypes.c_size_t),
+)
+_grib_set_string = checked_return_code(_grib_set_string)
+
+
+def grib_set_string(handle, name, value):
+    value = string_to_char(value)
+    size = ctypes.c_size_t(len(value))
+    _grib_set_string(handle, string_to_char(name), value, ctypes.byref(size))
+
+
+_grib_set_double_array = dll.grib_set_double_array
+_grib_set_double_array.restype = c_int
+_grib_set_double_array.argtypes = (grib_handle_p, c_char_p, c_double_p, ctypes.c_size_t)
+_grib_set_double_array = convert_strings(_grib_set_double_array)
+_grib_set_double_array = checked_return_code(_grib_set_double_array)
+
+
+def grib_set_double_array(handle, name, values):
+    values = np.ascontiguousarray(values, dtype=np.float64).reshape(-1)
+    _grib_set_double_array(
+        handle, name, values.ctypes.data_as(c_double_p), values.size
+    )
+
+
+def grib_set(handle, name, value):
+    if isinstance(value, str):
+        grib_set_string(handle, name, value)
+    elif isinstance(value, float):
+        grib_set_double(handle, name, value)
+    else:
+        grib_set_long(handle, name, value)
+
+
+_grib_get_message = dll.grib_get_message
+_grib_get_message.restype = c_int
+_grib_get_message.argtypes = (
+    grib_handle_p,
+    ctypes.POINTER(c_void_p),
+    ctypes.POINTER(ctypes.c_size_t),
+)
+_grib_get_message = checked_return_code(_grib_get_message)
+
+
+def grib_get_message(handle):
+    """Return the encoded message, as bytes."""
+    message = c_void_p()
+    size = ctypes.c_size_t()
+    _grib_get_message(handle, ctypes.byref(message), ctypes.byref(size))
+    return ctypes.string_at(message, size.value)
+
+
 ####################################################################
 
 fopen = libc.fopen
@@ -475,7 +599,10 @@ class CFile(object):
     def position(self, position, whence=0):
         return fseek(self.f, position, whence)
 
-    def next(self):
+    def next(self, headers_only=False):
+        if headers_only:
+            # The data section is skipped, the values cannot be decoded
+            return grib_new_from_file(self.f, 1)
         return grib_handle_new_from_file(self.f)
 
 
@@ -500,14 +627,108 @@ def grib_file_open(path):
 
 
 ####################################################################
-def grib_values(handle, name="values"):
-    array = grib_get_double_array(handle, name)
 
-    if grib_get(handle, "bitmapPresent"):
-        missingValue = grib_get(handle, "missingValue")
-        array[array == missingValue] = np.nan
+# Per-thread buffer used to decode into single precision when the ecCodes
+# library cannot do it directly
+_SCRATCH = threading.local()
 
-    return array
+# Number of points above which that buffer is not kept between decodes, so
+# that a thread does not hold a double precision copy of a large field
+_SCRATCH_MAX = 1024 * 1024
+
+# Missing values are replaced by NaNs by chunks of that many points
+_MISSING_CHUNK = 64 * 1024
+
+
+def _scratch(size):
+    if size > _SCRATCH_MAX:
+        return np.empty((size,), dtype=np.float64)
+
+    buffer = getattr(_SCRATCH, "buffer", None)
+    if buffer is None or buffer.size < size:
+        buffer = _SCRATCH.buffer = np.empty((size,), dtype=np.float64)
+    return buffer[:size]
+
+
+def _missing_to_nan(values, missing):
+    missing = values.dtype.type(missing)
+    mask = np.empty((min(_MISSING_CHUNK, values.size),), dtype=bool)
+    for start in range(0, values.size, _MISSING_CHUNK):
+        chunk = values[start : start + _MISSING_CHUNK]
+        chunk_mask = mask[: chunk.size]
+        np.equal(chunk, missing, out=chunk_mask)
+        np.copyto(chunk, np.nan, where=chunk_mask)
+
+
+def _has_missing(handle):
+    if not grib_get(handle, "bitmapPresent"):
+        return False
+    try:
+        return grib_get_long(handle, "numberOfMissing") > 0
+    except GribError:
+        return True
+
+
+def grib_decode(handle, out=None, dtype=np.float64, name="values"):
+    """Decode the values of a message into `out`, which can be any writeable
+    C-contiguous float32 or float64 array of the right size (e.g. a slot of
+    a cache or a view on shared memory). If `out` is None, a new array of
+    type `dtype` is allocated. Missing values are set to NaN.
+
+    """
+    size = grib_get_size(handle, name)
+
+    if out is None:
+        out = np.empty((size,), dtype=dtype)
+
+    if out.size != size or not out.flags.c_contiguous or not out.flags.writeable:
+        raise ValueError(
+            "Cannot decode %s values into array of shape %s" % (size, out.shape)
+        )
+
+    values = out.reshape((size,))
+
+    length = c_size_t(size)
+    length_p = ctypes.cast(ctypes.addressof(length), c_size_t_p)
+
+    if values.dtype == np.float64:
+        _grib_get_double_array(
+            handle, name, values.ctypes.data_as(c_double_p), length_p
+        )
+    elif values.dtype == np.float32:
+        decoded = False
+        if _grib_get_float_array is not None:
+            try:
+                _grib_get_float_array(
+                    handle, name, values.ctypes.data_as(c_float_p), length_p
+                )
+                decoded = True
+            except GribError as exc:
+                # e.g. grid_jpeg packing, only decoded in double precision
+                if exc.code != GRIB_NOT_IMPLEMENTED:
+                    raise
+                length.value = size
+
+        if not decoded:
+            scratch = _scratch(size)
+            _grib_get_double_array(
+                handle, name, scratch.ctypes.data_as(c_double_p), length_p
+            )
+            np.copyto(values, scratch, casting="same_kind")
+    else:
+        raise TypeError("Cannot decode values into %s array" % (values.dtype,))
+
+    # ecCodes sets the points missing from the bitmap to missingValue. The
+    # bitmap itself is only available as an array of longs, larger than the
+    # values, so the values are compared with missingValue instead
+    if _has_missing(handle):
+        _missing_to_nan(values, grib_get(handle, "missingValue"))
+
+    return out
+
+
+def grib_values(handle, name="values", dtype=np.float64):
+    return grib_decode(handle, dtype=dtype, name=name)
 
 
 def grib_pl_array(handle, name="pl"):
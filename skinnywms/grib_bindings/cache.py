@@ -0,0 +1,131 @@
+# (C) Copyright 2012-2019 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+#
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+CACHES = []
+
+
+def _arrays(value):
+    if isinstance(value, np.ndarray):
+        yield value
+    elif isinstance(value, dict):
+        for v in value.values():
+            for a in _arrays(v):
+                yield a
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            for a in _arrays(v):
+                yield a
+
+
+class GeometryCache(object):
+    """Thread-safe LRU cache of grid geometries, bounded both in number of
+    entries and in total size of the arrays they hold. The cached arrays
+    are made read-only, so they can be shared between fields.
+
+    """
+
+    def __init__(self, name, maxsize=32, maxbytes=256 * 1024 * 1024):
+        self.name = name
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        CACHES.append(self)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, _ = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Add a value to the cache, and return the cached value, which may
+        have been added by another thread in the meantime.
+
+        """
+        nbytes = 0
+        for array in _arrays(value):
+            array.flags.writeable = False
+            nbytes += array.nbytes
+
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                return self._data[key][0]
+
+            self._data[key] = (value, nbytes)
+            self.nbytes += nbytes
+
+            # Always keep the latest entry, even if it is larger than maxbytes
+            while len(self._data) > 1 and (
+                len(self._data) > self.maxsize or self.nbytes > self.maxbytes
+            ):
+                _, (_, size) = self._data.popitem(last=False)
+                self.nbytes -= size
+                self.evictions += 1
+
+        return value
+
+    def get_or_create(self, key, create):
+        value = self.get(key)
+        if value is None:
+            # Not created under the lock, so that other grids are not blocked
+            value = self.put(key, create())
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                name=self.name,
+                entries=len(self._data),
+                nbytes=self.nbytes,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                maxsize=self.maxsize,
+                maxbytes=self.maxbytes,
+            )
+
+
+def stats():
+    return [cache.stats() for cache in CACHES]
+
+
+REGULAR_CACHE = GeometryCache("regular", maxsize=64, maxbytes=64 * 1024 * 1024)
+
+# Reduced grid coordinates are large (160MB for O1280 in double precision), so
+# only keep the most recently used ones
+REDUCED_CACHE = GeometryCache("reduced", maxsize=8, maxbytes=512 * 1024 * 1024)
+
+GAUSSIAN_CACHE = GeometryCache("gaussian", maxsize=64, maxbytes=16 * 1024 * 1024)
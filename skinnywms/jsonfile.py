@@ -0,0 +1,74 @@
+# (C) Copyright 2012-2019 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""JSON files of entries kept between runs and shared by the processes of a
+server, such as the style cache and the rejected files of the datasets.
+
+"""
+
+import json
+import logging
+import os
+import tempfile
+
+__all__ = [
+    "merge",
+    "read",
+]
+
+LOG = logging.getLogger(__name__)
+
+
+def read(path, version, key, what):
+    """The entries under `key` in the JSON file at `path`, or an empty dict
+    if it does not exist, cannot be read or is of another `version`. `what`
+    describes the file in the log messages.
+
+    """
+    try:
+        with open(path) as f:
+            content = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as exc:
+        LOG.warning("Ignoring %s %s: %s", what, path, exc)
+        return {}
+
+    if not isinstance(content, dict) or content.get("version") != version:
+        LOG.info("Ignoring %s %s of another version", what, path)
+        return {}
+
+    return content.get(key, {})
+
+
+def merge(path, version, key, entries, what):
+    """Merge `entries` with those of the file, which the other processes may
+    have written since it was read, and replace the file atomically with the
+    result. Return the merged entries.
+
+    """
+    merged = read(path, version, key, what)
+    merged.update(entries)
+    try:
+        _write(path, {"version": version, key: merged})
+    except (OSError, TypeError, ValueError) as exc:
+        LOG.warning("Cannot write %s %s: %s", what, path, exc)
+    return merged
+
+
+def _write(path, content):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(content, f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
@@ -0,0 +1,450 @@
+# (C) Copyright 2012-2019 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""Counters and histograms of the server activity, exposed in the
+Prometheus text format.
+
+"""
+
+import bisect
+import contextlib
+import contextvars
+import threading
+import time
+
+__all__ = [
+    "CONTENT_TYPE",
+    "Counter",
+    "Histogram",
+    "InstrumentedLock",
+    "REGISTRY",
+    "Registry",
+    "Timings",
+    "note",
+    "record",
+    "render",
+    "stage",
+]
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+def _key(labelnames, labels):
+    if set(labels) != set(labelnames):
+        raise ValueError(
+            "Expected labels %s, got %s" % (sorted(labelnames), sorted(labels))
+        )
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+class Family:
+    """The samples of one metric, as returned by `Registry.collect()`.
+    Each sample is a (suffix, labels, value) tuple.
+
+    """
+
+    def __init__(self, name, type, help, samples=None):
+        self.name = name
+        self.type = type
+        self.help = help
+        self.samples = samples or []
+
+    def add(self, labels, value, suffix=""):
+        self.samples.append((suffix, labels, value))
+        return self
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(_key(self.labelnames, labels), 0)
+
+    def collect(self):
+        family = Family(self.name, self.type, self.help)
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                family.add(dict(zip(self.labelnames, key)), value)
+        return family
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket, then +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        with self._lock:
+            counts = self._values.get(_key(self.labelnames, labels))
+            return 0 if counts is None else sum(counts[:-1])
+
+    def collect(self):
+        family = Family(self.name, self.type, self.help)
+        with self._lock:
+            values = sorted((key, list(counts)) for key, counts in self._values.items())
+
+        for key, counts in values:
+            labels = dict(zip(self.labelnames, key))
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                family.add(dict(labels, le=_format(bound)), total, "_bucket")
+            family.add(labels, counts[-1], "_sum")
+            family.add(labels, total, "_count")
+        return family
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._caches = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def collector(self, func):
+        """Register a callable returning a list of `Family`, called every
+        time the metrics are collected. Can be used as a decorator.
+
+        """
+        with self._lock:
+            self._collectors.append(func)
+        return func
+
+    def caches(self, func):
+        """Register a callable returning the statistics of caches, as a list
+        of dicts with 'name', 'hits', 'misses' and optionally 'entries' and
+        'nbytes' keys. Can be used as a decorator.
+
+        """
+        with self._lock:
+            self._caches.append(func)
+        return func
+
+    def collect(self, families=(), caches=()):
+        """Return all the metrics, with the extra `families` and `caches`
+        of the caller.
+
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+            providers = list(self._caches)
+
+        result = [metric.collect() for metric in metrics]
+        result.extend(families)
+        for collector in collectors:
+            result.extend(collector())
+
+        caches = list(caches)
+        for provider in providers:
+            caches.extend(provider())
+        result.extend(cache_families(caches))
+
+        return result
+
+
+REGISTRY = Registry()
+
+
+def _format(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render(families=None):
+    """Return the metrics in the Prometheus text exposition format. By
+    default, all the metrics of `REGISTRY`.
+
+    """
+    if families is None:
+        families = REGISTRY.collect()
+
+    lines = []
+    for family in families:
+        lines.append("# HELP %s %s" % (family.name, family.help))
+        lines.append("# TYPE %s %s" % (family.name, family.type))
+        for suffix, labels, value in family.samples:
+            if labels:
+                labels = "{%s}" % ",".join(
+                    '%s="%s"' % (k, _escape(v)) for k, v in labels.items()
+                )
+            else:
+                labels = ""
+            lines.append("%s%s%s %s" % (family.name, suffix, labels, _format(value)))
+    lines.append("")
+    return "\n".join(lines)
+
+
+REQUESTS = REGISTRY.counter(
+    "skinnywms_requests_total",
+    "WMS requests processed, by operation and outcome",
+    ("operation", "outcome"),
+)
+
+REQUEST_DURATION = REGISTRY.histogram(
+    "skinnywms_request_duration_seconds",
+    "Time to process WMS requests, by operation and layer",
+    ("operation", "layer"),
+)
+
+STAGE_DURATION = REGISTRY.histogram(
+    "skinnywms_stage_duration_seconds",
+    "Time spent in each stage of the processing of requests",
+    ("stage",),
+)
+
+LOCK_WAIT = REGISTRY.histogram(
+    "skinnywms_lock_wait_seconds",
+    "Time spent waiting to acquire the global locks",
+    ("lock",),
+)
+
+LOCK_HELD = REGISTRY.histogram(
+    "skinnywms_lock_held_seconds",
+    "Time during which the global locks are held",
+    ("lock",),
+)
+
+
+OPERATIONS = ("getcapabilities", "getmap", "getlegendgraphic")
+
+
+def operation(req, params, known=None):
+    """Return the operation label of a WMS request, and the layer labels of
+    each of its layers. Other operations are counted together, and so are
+    the layers for which `known(name)` is false, to keep the number of labels
+    bounded.
+
+    """
+    if req not in OPERATIONS:
+        return "other", [""]
+
+    names = params.get("layers", params.get("layer", "")).split(",")
+    layers = {
+        name if known is not None and known(name) else "other"
+        for name in names
+        if name
+    }
+    return req, sorted(layers) or [""]
+
+
+# The stages reported in the Server-Timing header, and the stages they cover
+SERVER_TIMING = (
+    ("lookup", ("catalog", "lookup", "styles")),
+    ("queue", ("queue",)),
+    ("render", ("plot",)),
+    ("encode", ("encode", "read")),
+    ("cache", ("cache",)),
+)
+
+
+class Timings:
+    """Time spent in each stage by one request, and what was learnt about
+    the request on the way (e.g. the fields rendered, or whether it was
+    served from a cache).
+
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.info = {}
+        self._depth = 0
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        """Return the value of the Server-Timing header."""
+        entries = []
+        for name, stages in SERVER_TIMING:
+            if any(stage in self.stages for stage in stages):
+                seconds = sum(self.stages.get(stage, 0) for stage in stages)
+                entries.append("%s;dur=%.1f" % (name, seconds * 1000))
+        entries.append("total;dur=%.1f" % (self.elapsed() * 1000))
+        return ", ".join(entries)
+
+
+# Timings of the request being processed
+CURRENT_TIMINGS = contextvars.ContextVar("skinnywms_timings", default=None)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Time a stage of the processing of a request: 'parse', 'catalog',
+    'lookup', 'styles', 'cache', 'queue', 'plot', 'encode', 'read' or 'send'.
+
+    Stages nested in another stage are only reported in the metrics, not in
+    the timings of the current request, so that they are not counted twice.
+
+    """
+    timings = CURRENT_TIMINGS.get()
+    if timings is not None:
+        timings._depth += 1
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_DURATION.observe(elapsed, stage=name)
+        if timings is not None:
+            timings._depth -= 1
+            if timings._depth == 0:
+                timings.add(name, elapsed)
+
+
+def record(name, seconds):
+    """Report a stage timed by the caller."""
+    STAGE_DURATION.observe(seconds, stage=name)
+    timings = CURRENT_TIMINGS.get()
+    if timings is not None and timings._depth == 0:
+        timings.add(name, seconds)
+
+
+def note(key, value):
+    """Add information about the request being processed."""
+    timings = CURRENT_TIMINGS.get()
+    if timings is not None:
+        timings.info[key] = value
+
+
+def start_stage(name):
+    """Start timing a stage that does not end in the current scope, and
+    return the callable that ends it.
+
+    """
+    start = time.perf_counter()
+
+    def end():
+        STAGE_DURATION.observe(time.perf_counter() - start, stage=name)
+
+    return end
+
+
+class InstrumentedLock:
+    """A `threading.Lock` recording how long it is waited for and held."""
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._acquired = None
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        if acquired:
+            self._acquired = time.perf_counter()
+            LOCK_WAIT.observe(self._acquired - start, lock=self.name)
+        return acquired
+
+    def release(self):
+        LOCK_HELD.observe(time.perf_counter() - self._acquired, lock=self.name)
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return True
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def cache_families(caches):
+    """Families of the hits, misses, entries and size of caches."""
+    families = [
+        Family("skinnywms_cache_hits_total", "counter", "Cache hits"),
+        Family("skinnywms_cache_misses_total", "counter", "Cache misses"),
+        Family("skinnywms_cache_entries", "gauge", "Number of cached entries"),
+        Family("skinnywms_cache_bytes", "gauge", "Size of the cached arrays"),
+    ]
+    for cache in caches:
+        labels = dict(cache=cache["name"])
+        for family, key in zip(families, ("hits", "misses", "entries", "nbytes")):
+            if key in cache:
+                family.add(labels, cache[key])
+    return families
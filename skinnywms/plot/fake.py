@@ -0,0 +1,138 @@
+# (C) Copyright 2012-2019 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""A stand-in for `Magics.macro`, to be given as the `driver` of `Plotter`
+and `Styler`. It records the calls made to it and writes a fixed image
+instead of plotting, so that the overhead of the server can be measured
+(and tested) without Magics.
+
+"""
+
+import base64
+import threading
+import time
+
+__all__ = [
+    "FakeDriver",
+]
+
+# A transparent 1x1 PNG
+PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6"
+    "kgAAAABJRU5ErkJggg=="
+)
+
+# What Magics returns
+WMSCRS = {
+    "crss": [
+        dict(name="EPSG:4326", w_lon=-180.0, s_lat=-90.0, e_lon=180.0, n_lat=90.0),
+        dict(
+            name="EPSG:3857",
+            w_lon=-20026376.39,
+            s_lat=-20048966.1,
+            e_lon=20026376.39,
+            n_lat=20048966.1,
+        ),
+    ],
+    "geographic_bounding_box": dict(w_lon=-180.0, e_lon=180.0, s_lat=-90.0, n_lat=90.0),
+}
+
+STYLES = [
+    dict(
+        name="fake_contour",
+        title="Fake contour",
+        description="Style of the fake driver",
+        legend=dict(width=350, height=50),
+    ),
+]
+
+VERBS = (
+    "mcoast",
+    "mcont",
+    "mgrib",
+    "mlegend",
+    "mmap",
+    "mnetcdf",
+    "mwind",
+    "output",
+)
+
+
+class Action:
+    """Same attributes as the actions of `Magics.macro`."""
+
+    def __init__(self, verb, args):
+        self.verb = verb
+        self.args = args
+
+    def __repr__(self):
+        return "%s(%s)" % (self.verb, self.args)
+
+
+class FakeDriver:
+    """Record the calls, and write `image` to the output file of every plot,
+    after sleeping `delay` seconds to simulate the rendering.
+
+    """
+
+    def __init__(self, image=PNG, delay=0.0, styles=STYLES):
+        self.image = image
+        self.delay = delay
+        self.styles = styles
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def _record(self, verb, args):
+        with self._lock:
+            self.calls.append((verb, args))
+
+    def __getattr__(self, verb):
+        if verb not in VERBS:
+            raise AttributeError(verb)
+
+        def action(*args, **kwargs):
+            params = dict(*args, **kwargs)
+            self._record(verb, params)
+            return Action(verb, params)
+
+        return action
+
+    def silent(self):
+        pass
+
+    def version(self):
+        return "FakeDriver"
+
+    def wmscrs(self):
+        return WMSCRS
+
+    def wmsstyles(self, data):
+        self._record("wmsstyles", data.args)
+        return dict(styles=self.styles)
+
+    def plot(self, *actions):
+        self._record("plot", actions)
+
+        if self.delay:
+            time.sleep(self.delay)
+
+        for action in actions:
+            if action.verb == "output":
+                args = action.args
+                path = "%s.%s" % (args["output_name"], args["output_formats"][0])
+                with open(path, "wb") as f:
+                    f.write(self.image)
+
+    def verbs(self):
+        """The verbs called so far, in order."""
+        with self._lock:
+            return [verb for verb, _ in self.calls]
+
+    def reset(self):
+        with self._lock:
+            self.calls = []
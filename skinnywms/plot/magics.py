@@ -9,13 +9,17 @@
 import logging
 import mimetypes
 import os
-import threading
 import pprint
 import json
 
-from Magics import macro
+from skinnywms import datatypes, errors, metrics
+from skinnywms.stylecache import StyleCache
 
-from skinnywms import datatypes, errors
+try:
+    from Magics import macro
+except ImportError:
+    # Only other drivers can be used, e.g. skinnywms.plot.fake.FakeDriver
+    macro = None
 
 
 __all__ = [
@@ -31,7 +35,7 @@ mimetypes.add_type("application/x-netcdf", ".nc4", strict=False)
 MAGICS_OUTPUT_TYPES = {
     "image/png": "png",
 }
-LOCK = threading.Lock()
+LOCK = metrics.InstrumentedLock("magics")
 
 MACRO_TEXT = """
 {}
@@ -154,6 +158,8 @@ class Plotter(datatypes.Plotter):
     log = logging.getLogger(__name__)
 
     def __init__(self, baselayer=None, styles=None, driver=macro):
+        if driver is None:
+            raise ImportError("Magics is not installed")
         self.driver = driver
 
         self.wmscrs = driver.wmscrs()
@@ -259,9 +265,9 @@ class Plotter(datatypes.Plotter):
         return self.driver.mmap(**params)
 
     def mlayers(self, context, layers, styles):
+        """The actions rendering the layers, with their `Style` objects."""
         result = []
         for layer, style in zip(layers, styles):
-            style = layer.style(style)
             result += layer.render(context, self.driver, style)
         return result
 
@@ -309,6 +315,10 @@ class Plotter(datatypes.Plotter):
         output_fname = output.target(magics_format)
         path, _ = os.path.splitext(output_fname)
 
+        # Before taking the lock, as the styles of a layer are looked up
+        # with Magics the first time they are needed
+        selected = [layer.style(style) for layer, style in zip(layers, styles)]
+
         with LOCK:
 
             self.driver.silent()
@@ -329,7 +339,7 @@ class Plotter(datatypes.Plotter):
                 ),
             ]
 
-            args += self.mlayers(context, layers, styles)
+            args += self.mlayers(context, layers, selected)
 
             if _macro:
                 return (
@@ -345,7 +355,8 @@ class Plotter(datatypes.Plotter):
 
             # self.log.debug('plot(): Calling self.driver.plot(%s)', args)
             try:
-                self.driver.plot(*args)
+                with metrics.stage("plot"):
+                    self.driver.plot(*args)
             except Exception as e:
                 self.log.exception("Magics error: %s", e)
                 raise
@@ -368,6 +379,9 @@ class Plotter(datatypes.Plotter):
         output_fname = output.target(magics_format)
         path, _ = os.path.splitext(output_fname)
 
+        # Before taking the lock, see `plot`
+        contour = layer.style(style)
+
         with LOCK:
 
             # Magics is talking in cm.
@@ -398,10 +412,6 @@ class Plotter(datatypes.Plotter):
                 ),
             ]
 
-            contour = layer.style(
-                style,
-            )
-
             args += layer.render(
                 context,
                 self.driver,
@@ -434,7 +444,8 @@ class Plotter(datatypes.Plotter):
 
             # self.log.debug('plot(): Calling self.driver.plot(%s)', args)
             try:
-                self.driver.plot(*args, legend)
+                with metrics.stage("plot"):
+                    self.driver.plot(*args, legend)
             except Exception as e:
                 self.log.exception("Magics error: %s", e)
                 raise
@@ -484,9 +495,15 @@ class Styler(datatypes.Styler):
 
     log = logging.getLogger(__name__)
 
-    def __init__(self, user_style=None, driver=macro):
+    def __init__(self, user_style=None, driver=macro, cache=None):
+        if driver is None:
+            raise ImportError("Magics is not installed")
         self.user_style = None
         self.driver = driver
+        # Where to keep the styles found by Magics between runs
+        self.cache = None
+        if cache:
+            self.cache = StyleCache(cache, self.version())
         if user_style:
             try:
                 with open(user_style, "r") as f:
@@ -496,42 +513,63 @@ class Styler(datatypes.Styler):
             except:
                 self.user_style = None
 
-    def netcdf_styles(self, field, ncvar, path, variable):
-        if self.user_style:
-            return [MagicsWebStyle(self.user_style["name"])]
-        with LOCK:
+    def save(self):
+        if self.cache is not None:
+            self.cache.save()
+
+    def version(self):
+        """Version of Magics and of the style library, which the styles
+        found depend on.
+
+        """
+        return "%s;%s;%s" % (
+            self.driver.version(),
+            os.environ.get("MAGICS_STYLE_PATH", ""),
+            os.environ.get("MAGICS_USER_STYLE_PATH", ""),
+        )
+
+    def _styles(self, field, data):
+        identity = None
+        if self.cache is not None:
+            identity = field.identity()
+            styles = self.cache.get(identity)
+            if styles is not None:
+                return [MagicsWebStyle(**s) for s in styles]
+
+        with LOCK, metrics.stage("styles"):
             try:
-                styles = self.driver.wmsstyles(
-                    self.driver.mnetcdf(
-                        netcdf_filename=path, netcdf_value_variable=variable
-                    )
-                )
+                styles = self.driver.wmsstyles(data()).get("styles", [])
                 # Looks like they are provided in reverse order
-
-                return [MagicsWebStyle(**s) for s in styles.get("styles", [])]
             except Exception as e:
-                self.log.exception("netcdf_styles: Error: %s", e)
-                styles = {}
+                self.log.exception("Cannot find the styles of %s: %s", field, e)
+                return []
 
-        return [MagicsWebStyle(**s) for s in styles.get("styles", [])]
+        if identity is not None:
+            self.cache.put(identity, styles)
 
-    def grib_styles(self, field, grib, path, index):
+        return [MagicsWebStyle(**s) for s in styles]
+
+    def netcdf_styles(self, field, ncvar, path, variable):
         if self.user_style:
             return [MagicsWebStyle(self.user_style["name"])]
 
-        with LOCK:
-            try:
-                styles = self.driver.wmsstyles(
-                    self.driver.mgrib(
-                        grib_input_file_name=path, grib_field_position=index + 1
-                    )
-                )
-                # Looks like they are provided in reverse order
-            except Exception as e:
-                self.log.exception("grib_styles: Error: %s", e)
-                styles = {}
+        return self._styles(
+            field,
+            lambda: self.driver.mnetcdf(
+                netcdf_filename=path, netcdf_value_variable=variable
+            ),
+        )
+
+    def grib_styles(self, field, grib, path, index):
+        if self.user_style:
+            return [MagicsWebStyle(self.user_style["name"])]
 
-        return [MagicsWebStyle(**s) for s in styles.get("styles", [])]
+        return self._styles(
+            field,
+            lambda: self.driver.mgrib(
+                grib_input_file_name=path, grib_field_position=index + 1
+            ),
+        )
 
     def contours(self, field, driver, style, legend={}):
 
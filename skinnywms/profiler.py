@@ -0,0 +1,245 @@
+# (C) Copyright 2012-2019 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""Statistical profiler, sampling the Python stacks of the threads of the
+server at regular intervals. The result is given as collapsed stacks, one
+line per distinct stack with the number of times it was seen, as expected
+by flamegraph.pl, speedscope and similar tools.
+
+"""
+
+import collections
+import contextlib
+import logging
+import os
+import sys
+import threading
+import time
+
+__all__ = [
+    "Sampler",
+    "options",
+    "profile",
+    "profile_request",
+]
+
+LOG = logging.getLogger(__name__)
+
+MAX_SECONDS = 300
+
+# Shorter intervals would keep the sampler thread busy, holding the GIL
+MIN_INTERVAL = 0.001
+
+_SESSIONS = []
+_SESSIONS_LOCK = threading.Lock()
+
+_PREFIXES = sorted({path or os.getcwd() for path in sys.path}, key=len, reverse=True)
+
+
+def _short_path(path):
+    for prefix in _PREFIXES:
+        if prefix and path.startswith(prefix + os.sep):
+            return path[len(prefix) + 1 :]
+    return path
+
+
+class Sampler:
+    """Sample the stacks of some or all the threads every `interval` seconds,
+    in a background thread.
+
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = 0
+        self.stacks = collections.Counter()
+
+        # None to sample all the threads
+        self._threads = None
+        self._exclude = set()
+        self._labels = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, threads=None, exclude=()):
+        self._threads = None if threads is None else set(threads)
+        self._exclude = set(exclude)
+        self._thread = threading.Thread(
+            target=self._run, name="skinnywms-profiler", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self
+
+    def add_thread(self, ident):
+        with self._lock:
+            self._threads.add(ident)
+
+    def remove_thread(self, ident):
+        with self._lock:
+            self._threads.discard(ident)
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            self.sample(me)
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = "%s (%s:%s)" % (
+                code.co_name,
+                _short_path(code.co_filename),
+                code.co_firstlineno,
+            )
+        return label
+
+    def sample(self, me=None):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        with self._lock:
+            threads = None if self._threads is None else set(self._threads)
+
+        for ident, frame in sys._current_frames().items():
+            if ident == me or ident in self._exclude:
+                continue
+            if threads is not None and ident not in threads:
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            stack.reverse()
+
+            self.stacks[";".join(stack)] += 1
+
+        self.samples += 1
+
+    def collapsed(self):
+        return "".join(
+            "%s %s\n" % (stack, count) for stack, count in sorted(self.stacks.items())
+        )
+
+
+class _Session:
+    def __init__(self, count, match, interval):
+        self.remaining = count
+        self.match = {k.lower(): str(v).lower() for k, v in match.items()}
+        self.running = 0
+        self.done = threading.Event()
+        self.sampler = Sampler(interval).start(threads=())
+
+    def matches(self, params):
+        return all(
+            str(params.get(k, "")).lower() == v for k, v in self.match.items()
+        )
+
+    def finished(self):
+        with _SESSIONS_LOCK:
+            self.running -= 1
+            if self.remaining == 0 and self.running == 0:
+                self.done.set()
+
+
+def _claim(params):
+    with _SESSIONS_LOCK:
+        for session in _SESSIONS:
+            if session.remaining > 0 and session.matches(params):
+                session.remaining -= 1
+                session.running += 1
+                return session
+    return None
+
+
+@contextlib.contextmanager
+def profile_request(params):
+    """Sample the current thread while processing a request, if a profiling
+    session is waiting for requests with these (WMS) parameters.
+
+    """
+    # Fast path, as this is called for every request
+    session = _claim(params) if _SESSIONS else None
+    if session is None:
+        yield
+        return
+
+    ident = threading.get_ident()
+    session.sampler.add_thread(ident)
+    try:
+        yield
+    finally:
+        session.sampler.remove_thread(ident)
+        session.finished()
+
+
+def options(args):
+    """Return the keyword arguments of `profile()` given as HTTP request
+    parameters. The parameters other than 'seconds', 'requests', 'timeout'
+    and 'interval' select the requests to profile, e.g.
+    '?requests=10&request=GetMap&layers=2t'.
+
+    """
+    kwargs = dict(match={})
+    types = dict(seconds=float, requests=int, timeout=float, interval=float)
+    for name, value in args.items():
+        if name in types:
+            try:
+                kwargs[name] = types[name](value)
+            except ValueError:
+                raise ValueError("Invalid value for '%s': %r" % (name, value))
+        else:
+            kwargs["match"][name] = value
+    return kwargs
+
+
+def profile(seconds=None, requests=None, match=None, timeout=60, interval=0.01):
+    """Profile the server, and return the collapsed stacks.
+
+    Either sample all the threads for `seconds` seconds, or sample the
+    threads processing the next `requests` requests whose parameters
+    match `match`, waiting for them at most `timeout` seconds.
+
+    """
+    if (seconds is None) == (requests is None):
+        raise ValueError("Either 'seconds' or 'requests' must be given")
+
+    if not interval >= MIN_INTERVAL:
+        raise ValueError("'interval' must be at least %s" % (MIN_INTERVAL,))
+
+    if seconds is not None:
+        if not 0 < seconds <= MAX_SECONDS:
+            raise ValueError("'seconds' must be between 0 and %s" % (MAX_SECONDS,))
+        sampler = Sampler(interval).start(exclude=[threading.get_ident()])
+        time.sleep(seconds)
+        return sampler.stop().collapsed()
+
+    if requests <= 0:
+        raise ValueError("'requests' must be positive")
+
+    session = _Session(requests, match or {}, interval)
+    with _SESSIONS_LOCK:
+        _SESSIONS.append(session)
+    try:
+        if not session.done.wait(min(timeout, MAX_SECONDS)):
+            LOG.warning(
+                "Profiling timed out, %s requests not seen", session.remaining
+            )
+    finally:
+        with _SESSIONS_LOCK:
+            _SESSIONS.remove(session)
+            # Requests still running are not waited for
+            session.remaining = 0
+
+    return session.sampler.stop().collapsed()
@@ -6,15 +6,26 @@
 # granted to it by virtue of its status as an intergovernmental organisation nor
 # does it submit to any jurisdiction.
 
+import collections
+import contextlib
+import functools
+import gzip
+import hashlib
+import json
 import logging
 import os
 import tempfile
+import threading
+import time
 
 
-from skinnywms import errors, protocol
+from skinnywms import admission, errors, metrics, profiler, protocol
 
 LOG = logging.getLogger(__name__)
 
+# One JSON line per request slower than WMSServer.slow_request_threshold
+SLOW_LOG = logging.getLogger("skinnywms.slow")
+
 
 def revert_bbox(bbox):
     minx, miny, maxx, maxy = bbox
@@ -51,13 +62,94 @@ class TmpFile:
         os.unlink(self.fname)
 
 
+def field_info(layer):
+    """Where the data of a layer comes from, for the logs."""
+    return dict(
+        name=getattr(layer, "name", None),
+        path=getattr(layer, "path", None),
+        offset=getattr(layer, "offset", None),
+        index=getattr(layer, "index", None),
+    )
+
+
 class NoCaching:
     def create_output(self):
         return TmpFile()
 
 
+class CapabilitiesDocument:
+    def __init__(self, content_type, content):
+        self.content_type = content_type
+        self.content = content.encode("utf-8")
+        self.gzipped = gzip.compress(self.content, mtime=0)
+        self.etag = '"%s"' % (hashlib.sha1(self.content).hexdigest(),)
+
+    def matches(self, if_none_match):
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        return self.etag in [e.strip() for e in if_none_match.split(",")]
+
+
+class CapabilitiesCache:
+    """Rendered GetCapabilities documents, keyed by catalog version,
+    WMS version and service URL.
+
+    """
+
+    def __init__(self, size=32):
+        self._size = size
+        self._documents = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            document = self._documents.get(key)
+            if document is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._documents.move_to_end(key)
+            return document
+
+    def put(self, key, document):
+        with self._lock:
+            self._documents[key] = document
+            self._documents.move_to_end(key)
+            while len(self._documents) > self._size:
+                self._documents.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._documents
+
+    def clear(self):
+        with self._lock:
+            self._documents.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                name="capabilities",
+                entries=len(self._documents),
+                hits=self.hits,
+                misses=self.misses,
+            )
+
+
 class WMSServer:
-    def __init__(self, availability, plotter, styler, caching=NoCaching()):
+    def __init__(
+        self,
+        availability,
+        plotter,
+        styler,
+        caching=NoCaching(),
+        render_queue=None,
+        slow_request_threshold=None,
+    ):
 
         self.availability = availability
         self.availability.set_context(self)
@@ -69,6 +161,14 @@ class WMSServer:
         self.styler.set_context(self)
 
         self.caching = caching
+        self.capabilities_cache = CapabilitiesCache()
+
+        if render_queue is None:
+            render_queue = admission.RenderQueue()
+        self.render_queue = render_queue
+
+        # In seconds, None to disable the slow request log
+        self.slow_request_threshold = slow_request_threshold
 
         # For objects to store context
         self.stash = {}
@@ -78,14 +178,42 @@ class WMSServer:
         self.availability.set_context(self)
 
     def process(
-        self, request, Response, send_file, render_template, reraise=False, output=None
+        self,
+        request,
+        Response,
+        send_file,
+        render_template,
+        reraise=False,
+        output=None,
+        alive=None,
+        deadline=None,
+        availability=None,
     ):
+        """Process a WMS request. `alive` is an optional callable telling
+        whether the client is still waiting for the response, and `deadline`
+        the `time.monotonic()` time after which it should not be rendered.
+        `availability` is the catalog of the dataset requested, if not the
+        one of the server.
+
+        """
+
+        if availability is None:
+            availability = self.availability
 
         url = request.url.split("?")[0]
 
         LOG.info(request.url)
 
-        params, _ = protocol.filter_wms_params(request.args)
+        # A front end may have started timing the request already
+        timings = metrics.CURRENT_TIMINGS.get()
+        token = None
+        if timings is None:
+            timings = metrics.Timings()
+            token = metrics.CURRENT_TIMINGS.set(timings)
+
+        with metrics.stage("parse"):
+            params, _ = protocol.filter_wms_params(request.args)
+        wms_params = dict(params)
 
         service_orig = params.setdefault("service", "wms")
         service = service_orig.lower()
@@ -98,65 +226,99 @@ class WMSServer:
         if output is None:
             output = self.caching.create_output()
 
-        try:
-            LOG.info(req)
-            if service != "wms":
-                raise errors.ServiceNotDefined(service_orig)
-
-            if version not in protocol.SUPPORTED_VERSIONS:
-                raise Exception("Unsupported WMS version {}".format(version))
-
-            if req == "getcapabilities":
-                content_type, content = self.get_capabilities(
-                    version, url, render_template
-                )
-            elif req == "getmap":
-                params = protocol.get_wms_parameters(req, version, params)
-                params["_macro"] = request.args.get("_macro", False)
-                params["output"] = output
-
-                for k in ("request", "service"):
-                    try:
-                        del params[k]
-                    except KeyError:
-                        pass
-                if version == "1.1.1":
-                    srs = params.pop("srs")
-                    params["crs"] = srs
-
-                content_type, path = self.get_map(**params)
-                resp = send_file(path, content_type)
-                output.cleanup()
-
-                return resp
-
-            elif req == "getlegendgraphic":
-                params = protocol.get_wms_parameters(req, version, params)
+        # The parameters are parsed in place by the operations
+        labels = dict(params)
+        outcome = "ok"
+        start = time.perf_counter()
 
-                params["output"] = output
-
-                for k in ("request", "service"):
-                    try:
-                        del params[k]
-                    except KeyError:
-                        pass
-
-                content_type, path = self.get_legend(**params)
-                resp = send_file(path, content_type)
-                output.cleanup()
-
-                return resp
+        try:
+            with profiler.profile_request(wms_params):
+                LOG.info(req)
+                if service != "wms":
+                    raise errors.ServiceNotDefined(service_orig)
+
+                if version not in protocol.SUPPORTED_VERSIONS:
+                    raise Exception("Unsupported WMS version {}".format(version))
+
+                if req == "getcapabilities":
+                    document = self.capabilities_document(
+                        version, url, render_template, availability
+                    )
+                    response = self.capabilities_response(request, Response, document)
+
+                elif req == "getmap":
+                    with metrics.stage("parse"):
+                        params = protocol.get_wms_parameters(req, version, params)
+                    params["_macro"] = request.args.get("_macro", False)
+                    params["output"] = output
+
+                    for k in ("request", "service"):
+                        try:
+                            del params[k]
+                        except KeyError:
+                            pass
+                    if version == "1.1.1":
+                        srs = params.pop("srs")
+                        params["crs"] = srs
+
+                    content_type, path = self.get_map(
+                        availability=availability,
+                        slot=functools.partial(
+                            self.render_queue.slot,
+                            admission.PRIORITIES[req],
+                            deadline=deadline,
+                            alive=alive,
+                        ),
+                        **params
+                    )
+                    with metrics.stage("read"):
+                        response = send_file(path, content_type)
+                    output.cleanup()
+
+                elif req == "getlegendgraphic":
+                    with metrics.stage("parse"):
+                        params = protocol.get_wms_parameters(req, version, params)
+
+                    params["output"] = output
+
+                    for k in ("request", "service"):
+                        try:
+                            del params[k]
+                        except KeyError:
+                            pass
+
+                    content_type, path = self.get_legend(
+                        availability=availability,
+                        slot=functools.partial(
+                            self.render_queue.slot,
+                            admission.PRIORITIES[req],
+                            deadline=deadline,
+                            alive=alive,
+                        ),
+                        **params
+                    )
+                    with metrics.stage("read"):
+                        response = send_file(path, content_type)
+                    output.cleanup()
+
+                else:
+                    raise errors.OperationNotSupported(req_orig)
+
+            response.headers["Server-Timing"] = timings.server_timing()
+            return response
 
-            else:
-                raise errors.OperationNotSupported(req_orig)
         except errors.WMSError as exc:
+            outcome = exc.__class__.__name__
             if reraise:
                 raise
             LOG.exception("%s(): Error: %s", req, exc)
             content_type = exc.content_type(version)
             content = exc.body(version)
+            status = exc.status
+            headers = exc.headers()
 
         except Exception as exc:
+            outcome = "error"
             if reraise:
                 raise
 
@@ -164,8 +326,62 @@ class WMSServer:
             exc = errors.wrap(exc)
             content_type = exc.content_type(version)
             content = exc.body(version)
+            status = exc.status
+            headers = exc.headers()
+
+        finally:
+            elapsed = time.perf_counter() - start
+            # After the request, by when the catalog of the dataset is loaded
+            operation, layers = metrics.operation(
+                req, labels, lambda name: self.has_layer(name, availability)
+            )
+            for layer in layers:
+                metrics.REQUEST_DURATION.observe(
+                    elapsed, operation=operation, layer=layer
+                )
+            metrics.REQUESTS.inc(operation=operation, outcome=outcome)
+            self.log_slow_request(
+                wms_params, operation, ",".join(layers), outcome, timings
+            )
+            # Once per request, for the styles of all the layers looked up
+            self.styler.save()
+            if token is not None:
+                metrics.CURRENT_TIMINGS.reset(token)
+
+        headers["Server-Timing"] = timings.server_timing()
+        return Response(content, status=status, mimetype=content_type, headers=headers)
+
+    def has_layer(self, name, availability):
+        """Whether a layer is offered, by the catalog or by the plotter."""
+        return availability.has_layer(name) or any(
+            layer.name == name for layer in self.plotter.layers()
+        )
 
-        return Response(content, mimetype=content_type)
+    def log_slow_request(self, params, operation, layer, outcome, timings):
+        elapsed = timings.elapsed()
+        threshold = self.slow_request_threshold
+        if threshold is None or elapsed < threshold:
+            return
+
+        SLOW_LOG.warning(
+            json.dumps(
+                dict(
+                    request="&".join(
+                        "%s=%s" % (k, v) for k, v in sorted(params.items())
+                    ),
+                    operation=operation,
+                    layer=layer,
+                    fields=timings.info.get("fields"),
+                    cache=timings.info.get("cache"),
+                    outcome=outcome,
+                    duration=round(elapsed * 1000, 1),
+                    timings={
+                        k: round(v * 1000, 1) for k, v in sorted(timings.stages.items())
+                    },
+                ),
+                default=str,
+            )
+        )
 
     def get_map(
         self,
@@ -185,7 +401,17 @@ class WMSServer:
         exceptions=None,
         time=None,
         transparent=True,
+        availability=None,
+        slot=contextlib.nullcontext,
     ):
+        """Render a map. The layers are looked up, loading the catalog of the
+        dataset if needed, before `slot()` is entered, so that only the
+        rendering itself holds a render slot.
+
+        """
+
+        if availability is None:
+            availability = self.availability
 
         if not styles:
             styles = []
@@ -197,13 +423,16 @@ class WMSServer:
         dims = {"time": time, "elevation": elevation, "dim_index": dim_index}
 
         layer_objs = []
-        for name in layers:
-            try:
-                layer = self.availability.layer(name, dims)
-            except errors.LayerNotDefined:
-                layer = self.plotter.layer(name)
+        with metrics.stage("lookup"):
+            for name in layers:
+                try:
+                    layer = availability.layer(name, dims)
+                except errors.LayerNotDefined:
+                    layer = self.plotter.layer(name)
 
-            layer_objs.append(layer)
+                layer_objs.append(layer)
+
+            metrics.note("fields", [field_info(layer) for layer in layer_objs])
 
         # Interpret the BBox
 
@@ -211,24 +440,25 @@ class WMSServer:
 
         LOG.debug("->{}_{}".format(version, crs))
 
-        mime_type, path = self.plotter.plot(
-            self,
-            output,
-            bbox,
-            crs,
-            format,
-            height,
-            layer_objs,
-            styles,
-            version,
-            width,
-            _macro=_macro,
-            bgcolor=bgcolor,
-            elevation=elevation,
-            exceptions=exceptions,
-            time=time,
-            transparent=transparent,
-        )
+        with slot():
+            mime_type, path = self.plotter.plot(
+                self,
+                output,
+                bbox,
+                crs,
+                format,
+                height,
+                layer_objs,
+                styles,
+                version,
+                width,
+                _macro=_macro,
+                bgcolor=bgcolor,
+                elevation=elevation,
+                exceptions=exceptions,
+                time=time,
+                transparent=transparent,
+            )
 
         return mime_type, path
 
@@ -243,35 +473,116 @@ class WMSServer:
         width=600,
         exceptions=None,
         transparent=True,
+        availability=None,
+        slot=contextlib.nullcontext,
     ):
 
+        if availability is None:
+            availability = self.availability
+
         time = None
 
-        try:
-            legend = self.availability.layer(layer, time)
-        except errors.LayerNotDefined:
-            legend = self.plotter.layer
-
-        path = self.plotter.legend(
-            self,
-            output,
-            format,
-            height,
-            legend,
-            style,
-            version,
-            width,
-            transparent,
-        )
+        with metrics.stage("lookup"):
+            try:
+                legend = availability.layer(layer, time)
+            except errors.LayerNotDefined:
+                legend = self.plotter.layer
+
+        with slot():
+            path = self.plotter.legend(
+                self,
+                output,
+                format,
+                height,
+                legend,
+                style,
+                version,
+                width,
+                transparent,
+            )
 
         return format, path
 
-    def get_capabilities(self, version, service_url, render_template):
+    def metrics(self):
+        """Return the metrics of the server, in the Prometheus text format."""
+        caches = [self.capabilities_cache.stats()]
+        style_cache = getattr(self.styler, "cache", None)
+        if style_cache is not None:
+            caches.append(style_cache.stats())
+
+        return metrics.render(
+            metrics.REGISTRY.collect(
+                families=self.render_queue.families(), caches=caches
+            )
+        )
+
+    def capabilities_response(self, request, Response, document):
+        headers = {"ETag": document.etag, "Vary": "Accept-Encoding"}
+
+        if document.matches(request.headers.get("If-None-Match")):
+            return Response(status=304, headers=headers)
+
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            headers["Content-Encoding"] = "gzip"
+            content = document.gzipped
+        else:
+            content = document.content
+
+        return Response(content, mimetype=document.content_type, headers=headers)
+
+    def capabilities_key(self, version, service_url, availability=None):
+        if availability is None:
+            availability = self.availability
+        return (availability.version, version, service_url)
+
+    def has_capabilities(self, version, service_url, availability):
+        """Whether the capabilities of `availability` can be served from the
+        cache, i.e. without loading the catalog or rendering the document.
+
+        """
+        if not availability.loaded:
+            return False
+        key = self.capabilities_key(version, service_url, availability)
+        return key in self.capabilities_cache
+
+    def capabilities_document(
+        self, version, service_url, render_template, availability=None
+    ):
+        if availability is None:
+            availability = self.availability
+
+        # Loading the catalog changes its version, so make sure this is done
+        # before computing the key
+        availability.ensure_loaded()
+
+        key = self.capabilities_key(version, service_url, availability)
+        with metrics.stage("cache"):
+            document = self.capabilities_cache.get(key)
+
+        metrics.note("cache", "miss" if document is None else "hit")
+
+        if document is None:
+            with metrics.stage("encode"):
+                document = CapabilitiesDocument(
+                    *self.get_capabilities(
+                        version, service_url, render_template, availability
+                    )
+                )
+            # Not if the catalog was replaced in the meantime
+            if availability.version == key[0]:
+                self.capabilities_cache.put(key, document)
+        return document
+
+    def get_capabilities(
+        self, version, service_url, render_template, availability=None
+    ):
+        if availability is None:
+            availability = self.availability
 
-        layers = list(self.availability.layers())
+        layers = list(availability.layers())
         LOG.info("Layers are %s", layers)
 
-        if self.availability.auto_add_plotter_layers:
+        if availability.auto_add_plotter_layers:
             layers += list(self.plotter.layers())
 
         layers = sorted(layers, key=lambda k: k.zindex)
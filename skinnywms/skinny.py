@@ -1,4 +1,4 @@
-from skinnywms.wmssvr import application
+from skinnywms.wmssvr import create_app, parse_args
 
 
 __all__ = [
@@ -7,7 +7,7 @@ __all__ = [
 
 
 def main():
-    application.run(debug=True, threaded=False)
+    create_app(parse_args()).run(debug=True, threaded=False)
 
 
 if __name__ == "__main__":
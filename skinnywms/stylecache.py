@@ -0,0 +1,81 @@
+# (C) Copyright 2012-2019 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""Styles found by Magics for the fields, kept on disk between runs."""
+
+import json
+import threading
+
+from skinnywms import jsonfile
+
+__all__ = [
+    "StyleCache",
+]
+
+def _key(identity):
+    return json.dumps(identity, sort_keys=True, default=str)
+
+
+class StyleCache:
+    """A JSON file of the styles of the fields, keyed by the identity of the
+    fields (e.g. paramId, levtype and units for GRIB) and only valid for a
+    given `version` of Magics and of its style library. It is shared by the
+    processes of a server: the entries added are written by `save()`, merged
+    with the content of the file, which is replaced atomically.
+
+    """
+
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._styles = self._read()
+        self._changed = False
+
+    def _read(self):
+        return jsonfile.read(self.path, self.version, "styles", "style cache")
+
+    def get(self, identity):
+        """The styles of the fields with this identity, as a list of dicts, or
+        None if they are not in the cache.
+
+        """
+        with self._lock:
+            styles = self._styles.get(_key(identity))
+            if styles is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return styles
+
+    def put(self, identity, styles):
+        with self._lock:
+            self._styles[_key(identity)] = styles
+            self._changed = True
+
+    def save(self):
+        """Write the styles added since the last call, if any."""
+        with self._lock:
+            if not self._changed:
+                return
+
+            self._styles = jsonfile.merge(
+                self.path, self.version, "styles", self._styles, "style cache"
+            )
+            self._changed = False
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                name="styles",
+                entries=len(self._styles),
+                hits=self.hits,
+                misses=self.misses,
+            )
@@ -6,93 +6,366 @@
 # granted to it by virtue of its status as an intergovernmental organisation nor
 # does it submit to any jurisdiction.
 
-import os
 import argparse
+import gc
+import glob
+import os
+import os.path
+from collections import defaultdict
 
-from flask import Flask, request, Response, render_template, send_file, jsonify
+from flask import (
+    Blueprint,
+    Flask,
+    Response,
+    abort,
+    current_app,
+    jsonify,
+    render_template,
+    request,
+    send_file,
+)
 from flask_cors import CORS, cross_origin
-from .server import WMSServer
-from .plot.magics import Plotter, Styler
-from .data.fs import Availability
-from collections import defaultdict
-import json
-import glob, os.path
 from mergedeep import merge
 
+from . import errors, metrics, profiler
+from .admission import RenderQueue, socket_alive
+from .data.fs import Availability, Catalogs
+from .data.rejects import RejectedFiles
+from .data.watch import create_watcher
+from .plot.magics import Plotter, Styler
+from .server import WMSServer
 
-application = Flask(__name__)
-
-cors = CORS(application)
-application.config['CORS_HEADERS'] = 'Content-Type'
+__all__ = [
+    "create_app",
+    "create_asgi_app",
+    "execute",
+    "parse_args",
+]
 
 demo = os.path.join(os.path.dirname(__file__), "testdata", "sfc.grib")
 
 demo = os.environ.get("SKINNYWMS_DATA_PATH", demo)
 
-parser = argparse.ArgumentParser(description="Simple WMS server")
 
-parser.add_argument(
-    "-f",
-    "--path",
-    default=demo,
-    help="Path to a GRIB or NetCDF file, or a directory\
-                         containing GRIB and/or NetCDF files.",
-)
-parser.add_argument(
-    "--style", default="", help="Path to a directory where to find the styles"
-)
+def argument_parser():
+    parser = argparse.ArgumentParser(description="Simple WMS server")
 
-parser.add_argument(
-    "--user_style", default="", help="Path to a json file containing the style to use"
-)
+    parser.add_argument(
+        "-f",
+        "--path",
+        default=demo,
+        help="Path to a GRIB or NetCDF file, or a directory\
+                             containing GRIB and/or NetCDF files.",
+    )
+    parser.add_argument(
+        "--data-root",
+        default=os.environ.get("SKINNYWMS_DATA_ROOT", "data"),
+        help="Directory containing the <model>/<date>/<time> datasets",
+    )
+    parser.add_argument(
+        "--style", default="", help="Path to a directory where to find the styles"
+    )
 
-parser.add_argument("--host", default="0.0.0.0", help="Hostname")
-parser.add_argument("--port", default=5000, help="Port number")
-parser.add_argument(
-    "--baselayer", default="", help="Path to a directory where to find the baselayer"
-)
-parser.add_argument(
-    "--magics-prefix",
-    default="magics",
-    help="prefix used to pass information to magics",
-)
+    parser.add_argument(
+        "--user_style",
+        default="",
+        help="Path to a json file containing the style to use",
+    )
+    parser.add_argument(
+        "--style-cache",
+        default=os.environ.get("SKINNYWMS_STYLE_CACHE", ""),
+        help="Path to a json file where to keep the styles of the fields between runs",
+    )
 
-args = parser.parse_args()
+    parser.add_argument("--host", default="0.0.0.0", help="Hostname")
+    parser.add_argument("--port", default=5000, help="Port number")
+    parser.add_argument(
+        "--baselayer",
+        default="",
+        help="Path to a directory where to find the baselayer",
+    )
+    parser.add_argument(
+        "--magics-prefix",
+        default="magics",
+        help="prefix used to pass information to magics",
+    )
+    parser.add_argument(
+        "--preload",
+        action="store_true",
+        default=os.environ.get("SKINNYWMS_PRELOAD", "0") == "1",
+        help="Scan all the datasets when the application is created",
+    )
+    parser.add_argument(
+        "--scan-in-background",
+        action="store_true",
+        default=os.environ.get("SKINNYWMS_SCAN_IN_BACKGROUND", "0") == "1",
+        help="Scan all the datasets in the background when the application starts",
+    )
+    parser.add_argument(
+        "--partial-catalogs",
+        action="store_true",
+        default=os.environ.get("SKINNYWMS_PARTIAL_CATALOGS", "0") == "1",
+        help="Serve the layers of the files already scanned while a dataset is "
+        "first scanned",
+    )
+    parser.add_argument(
+        "--catalog-max-age",
+        type=float,
+        default=os.environ.get("SKINNYWMS_CATALOG_MAX_AGE"),
+        help="Seconds after which a dataset is scanned again, in the background",
+    )
+    parser.add_argument(
+        "--include",
+        default=os.environ.get("SKINNYWMS_INCLUDE", ""),
+        help="Comma separated patterns of the files of the datasets to scan "
+        "(default: all)",
+    )
+    parser.add_argument(
+        "--exclude",
+        default=os.environ.get("SKINNYWMS_EXCLUDE", ""),
+        help="Comma separated patterns of the files of the datasets not to scan",
+    )
+    parser.add_argument(
+        "--rejected-files",
+        default=os.environ.get("SKINNYWMS_REJECTED_FILES", ""),
+        help="Path to a json file where to keep the files that cannot be read "
+        "between runs",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        default=os.environ.get("SKINNYWMS_WATCH", "0") == "1",
+        help="Add the fields of the files added or changed to the datasets loaded, "
+        "and remove those of the files removed",
+    )
+    parser.add_argument(
+        "--watch-interval",
+        type=float,
+        default=float(os.environ.get("SKINNYWMS_WATCH_INTERVAL", "2")),
+        help="Minimum number of seconds between two updates of a dataset",
+    )
+    parser.add_argument(
+        "--render-threads",
+        type=int,
+        default=int(os.environ.get("SKINNYWMS_RENDER_THREADS", "4")),
+        help="Number of threads rendering maps in the asynchronous server",
+    )
+    parser.add_argument(
+        "--render-queue-depth",
+        type=int,
+        default=int(os.environ.get("SKINNYWMS_RENDER_QUEUE_DEPTH", "32")),
+        help="Maximum number of requests waiting to be rendered",
+    )
+    parser.add_argument(
+        "--render-timeout",
+        type=float,
+        default=float(os.environ.get("SKINNYWMS_RENDER_TIMEOUT", "30")),
+        help="Seconds a request may wait to be rendered before being dropped",
+    )
+    parser.add_argument(
+        "--slow-request-threshold",
+        type=float,
+        default=os.environ.get("SKINNYWMS_SLOW_REQUEST_THRESHOLD"),
+        help="Log the requests taking more than this number of seconds",
+    )
+    parser.add_argument(
+        "--admin",
+        action="store_true",
+        default=os.environ.get("SKINNYWMS_ADMIN", "0") == "1",
+        help="Enable the /admin endpoints (profiler)",
+    )
 
-if args.style != "":
-    os.environ["MAGICS_STYLE_PATH"] = args.style + ":ecmwf"
+    return parser
 
-if args.user_style != "":
-    os.environ["MAGICS_USER_STYLE_PATH"] = args.user_style
 
-server = WMSServer(
-    Availability(args.path), Plotter(args.baselayer), Styler(args.user_style)
-)
+def parse_args(argv=None):
+    return argument_parser().parse_args(argv)
 
-server.magics_prefix = args.magics_prefix
 
+def _config(config):
+    defaults = vars(parse_args([]))
+    if config is None:
+        return defaults
+    if isinstance(config, argparse.Namespace):
+        config = vars(config)
+    defaults.update(config)
+    return defaults
 
-@application.route("/wms", methods=["GET"])
-@cross_origin()
-def wms():
-    request_args = request.args.to_dict()
 
-    w_model = request_args['model'] if "model" in request_args else 'ecmwf'
-    date = request_args['date'] if "date" in request_args else '20220501'
-    time = request_args['time'] if "time" in request_args else '00'
+def dataset_location(data_root, args):
+    """The directory of the dataset selected by the `model`, `date` and
+    `time` request parameters. Raises `errors.DatasetNotDefined` if it is
+    not an existing directory of `data_root`, so that the parameters of the
+    requests cannot create catalogs of any other path.
+
+    """
+    w_model = args.get("model", "ecmwf")
+    date = args.get("date", "20220501")
+    time = args.get("time", "00")
+    location = os.path.join(data_root, w_model, date, time, "")
+
+    root = os.path.realpath(data_root)
+    path = os.path.realpath(location)
+    if (
+        path == root
+        or os.path.commonpath([root, path]) != root
+        or not os.path.isdir(path)
+    ):
+        raise errors.DatasetNotDefined(
+            "Unknown dataset {}/{}/{}".format(w_model, date, time)
+        )
+
+    return location
+
+
+def _locations(data_root):
+    pattern = os.path.join(data_root, "*", "*", "*")
+    return sorted(
+        os.path.join(path, "") for path in glob.glob(pattern) if os.path.isdir(path)
+    )
+
+
+def _patterns(value):
+    if isinstance(value, str):
+        value = value.split(",")
+    return [pattern.strip() for pattern in value if pattern.strip()]
+
+
+def _setup(config, driver=None):
+    config = _config(config)
+
+    if config["style"] != "":
+        os.environ["MAGICS_STYLE_PATH"] = config["style"] + ":ecmwf"
+
+    if config["user_style"] != "":
+        os.environ["MAGICS_USER_STYLE_PATH"] = config["user_style"]
+
+    drivers = {} if driver is None else dict(driver=driver)
+    server = WMSServer(
+        Availability(config["path"]),
+        Plotter(config["baselayer"], **drivers),
+        Styler(config["user_style"], cache=config["style_cache"], **drivers),
+        render_queue=RenderQueue(
+            max_depth=config["render_queue_depth"],
+            timeout=config["render_timeout"],
+        ),
+        slow_request_threshold=config["slow_request_threshold"],
+    )
+
+    server.magics_prefix = config["magics_prefix"]
+
+    catalogs = Catalogs(
+        max_age=config["catalog_max_age"],
+        partial=config["partial_catalogs"],
+        watcher=create_watcher(config["watch_interval"]) if config["watch"] else None,
+        include=_patterns(config["include"]),
+        exclude=_patterns(config["exclude"]),
+        rejected=RejectedFiles(config["rejected_files"] or None),
+    )
+    catalogs.set_context(server)
 
-    location = "data/" + w_model + "/" + date + "/" + time + "/"
+    if config["preload"]:
+        catalogs.preload(server, _locations(config["data_root"]))
+        # Keep the garbage collector from touching (and therefore copying)
+        # the pages of the preloaded objects in the forked workers
+        gc.freeze()
+    elif config["scan_in_background"]:
+        catalogs.preload_in_background(server, _locations(config["data_root"]))
 
-    server.setAvailability(Availability(location))
+    return dict(config=config, server=server, catalogs=catalogs)
 
-    return server.process(
+
+def create_app(config=None, driver=None):
+    """Create the WMS application. `config` is a dict or an argparse.Namespace
+    with the same keys as the command line options. `driver` replaces
+    `Magics.macro` to plot, e.g. with `skinnywms.plot.fake.FakeDriver()`.
+
+    With `preload`, all the datasets are scanned when the application is
+    created. When the application is created in the master process of a
+    pre-forking server (gunicorn --preload, uwsgi without lazy-apps), the
+    workers then share the catalogs copy-on-write instead of each scanning
+    the data again.
+
+    With `scan_in_background`, they are scanned in a thread started when the
+    application is created, and '/ready' answers 503 until they all are
+    (not with a pre-forking server loading the application before forking,
+    as the thread would not be in the workers). With `partial_catalogs`,
+    the layers of the files already scanned are served in the meantime.
+
+    """
+    app = Flask(__name__)
+    app.config["CORS_HEADERS"] = "Content-Type"
+    CORS(app)
+
+    app.extensions["skinnywms"] = _setup(config, driver)
+    app.register_blueprint(blueprint)
+
+    return app
+
+
+def create_asgi_app(config=None, driver=None):
+    """Create the WMS application for an ASGI server, e.g.
+    'uvicorn --factory skinnywms.wmssvr:create_asgi_app'. `config` is the
+    same as for `create_app()`, and so is `driver`.
+
+    Requests are parsed, and capabilities, catalogs and static pages served,
+    on the event loop; only the requests that render maps, legends or
+    documents not yet cached are run in a pool of `render_threads` threads.
+
+    """
+    from .asgi import ASGIApplication
+
+    return ASGIApplication(**_setup(config, driver))
+
+
+def _extension(name):
+    return current_app.extensions["skinnywms"][name]
+
+
+blueprint = Blueprint("skinnywms", __name__)
+
+
+@blueprint.app_errorhandler(errors.WMSError)
+def wms_error(exc):
+    version = errors.version_param(request.args) or "1.3.0"
+    return Response(
+        exc.body(version),
+        status=exc.status,
+        mimetype=exc.content_type(version),
+        headers=exc.headers(),
+    )
+
+
+@blueprint.route("/wms", methods=["GET"])
+@cross_origin()
+def wms():
+    location = dataset_location(_extension("config")["data_root"], request.args)
+
+    response = _extension("server").process(
         request,
         Response=Response,
         send_file=send_file,
         render_template=render_template,
         reraise=True,
+        alive=_client_alive(),
+        availability=_extension("catalogs").get(location),
     )
 
+    # The response is sent by the WSGI server once returned
+    response.call_on_close(metrics.start_stage("send"))
+
+    return response
+
+
+def _client_alive():
+    # Connection of the development server, and of the gunicorn sync and
+    # gthread workers
+    for key in ("werkzeug.socket", "gunicorn.socket"):
+        sock = request.environ.get(key)
+        if sock is not None:
+            return socket_alive(sock)
+    return None
+
 
 def getDirectoriesName(base_path, depth):
     list_dir = {}
@@ -151,10 +424,8 @@ def get_path_dict(paths):
     return default_to_regular(new_path_dict)
 
 
-@application.route("/listdir", methods=["GET"])
-def list_dir():
-    # request_args = request.args.to_dict()
-    # depth = request_args['depth']
+def list_datasets(data_root):
+    data_root = os.path.join(".", data_root)
     result = {}
     result_init = {}
     number_depth = ""
@@ -164,34 +435,93 @@ def list_dir():
         # for each depth add '/*' to string
         for number in range(0, depth):
             number_depth = number_depth + "/*"
-        files_depth = glob.glob('./data' + number_depth)
+        files_depth = glob.glob(data_root + number_depth)
         dirs_depth = filter(lambda f: os.path.isdir(f), files_depth)
         #  get dict of string directories
         result = get_path_dict(dirs_depth)
         #  get result of merge two dict
         result = merge(result_init, result)
 
-    return jsonify(result['.']['data'])
+    for part in data_root.split("/"):
+        result = result[part]
 
+    return result
 
-@application.route("/timeseries", methods=["GET"])
-def timeseries():
+
+def count_datasets(data_root):
     total_dir = 0
-    for base, dirs, files in os.walk("./data"):
+    for base, dirs, files in os.walk(data_root):
         for directories in dirs:
             total_dir += 1
-    return jsonify({"count": total_dir})
+    return {"count": total_dir}
+
+
+@blueprint.route("/listdir", methods=["GET"])
+def list_dir():
+    # request_args = request.args.to_dict()
+    # depth = request_args['depth']
+    return jsonify(list_datasets(_extension("config")["data_root"]))
 
 
-@application.route("/availability", methods=["GET"])
+@blueprint.route("/timeseries", methods=["GET"])
+def timeseries():
+    return jsonify(count_datasets(_extension("config")["data_root"]))
+
+
+@blueprint.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(_extension("server").metrics(), content_type=metrics.CONTENT_TYPE)
+
+
+@blueprint.route("/health", methods=["GET"])
+def health():
+    return jsonify(dict(status="ok"))
+
+
+@blueprint.route("/ready", methods=["GET"])
+def ready():
+    status = _extension("catalogs").status()
+    return jsonify(status), 200 if status["ready"] else 503
+
+
+@blueprint.route("/admin/profile", methods=["GET"])
+def admin_profile():
+    if not _extension("config")["admin"]:
+        abort(404)
+    try:
+        stacks = profiler.profile(**profiler.options(request.args))
+    except ValueError as exc:
+        return Response(str(exc), status=400, mimetype="text/plain")
+    return Response(stacks, mimetype="text/plain")
+
+
+@blueprint.route("/availability", methods=["GET"])
 def availability():
-    return jsonify(server.availability.as_dict())
+    location = dataset_location(_extension("config")["data_root"], request.args)
+    return jsonify(_extension("catalogs").get(location).as_dict())
 
 
-@application.route("/", methods=["GET"])
+@blueprint.route("/", methods=["GET"])
 def index():
     return render_template("leaflet_demo.html")
 
 
 def execute():
+    args = parse_args()
+    application = create_app(args)
     application.run(port=args.port, host=args.host, debug=True, threaded=True)
+
+
+def __getattr__(name):
+    # The module level application (e.g. for 'uwsgi --mount
+    # /=skinnywms.wmssvr:application') is only created when first used, and
+    # is configured from the environment rather than the command line.
+    if name == "application":
+        global application
+        application = create_app()
+        return application
+    if name == "asgi_application":
+        global asgi_application
+        asgi_application = create_asgi_app()
+        return asgi_application
+    raise AttributeError(name)
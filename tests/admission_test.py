@@ -0,0 +1,150 @@
+import asyncio
+import socket
+import threading
+import time
+
+import pytest
+
+from skinnywms import admission, errors
+
+
+def test_queue_full():
+    queue = admission.RenderQueue(max_depth=1)
+
+    running = queue.admit(admission.RENDER)
+    waiting = queue.admit(admission.RENDER)
+    assert running.granted and not waiting.granted
+
+    with pytest.raises(errors.ServiceUnavailable) as info:
+        queue.admit(admission.RENDER)
+
+    assert info.value.status == 503
+    assert int(info.value.headers()["Retry-After"]) >= 1
+    assert "ServiceExceptionReport" in info.value.body("1.3.0")
+
+    running.release()
+    assert waiting.granted
+    assert queue.stats()["rejected"] == 1
+
+
+def test_cheap_requests_first():
+    queue = admission.RenderQueue()
+
+    running = queue.admit(admission.RENDER)
+    render = queue.admit(admission.RENDER)
+    legend = queue.admit(admission.CHEAP)
+
+    running.release()
+    assert legend.granted and not render.granted
+
+    legend.release()
+    assert render.granted
+
+
+def test_deadline():
+    queue = admission.RenderQueue(timeout=0.05)
+
+    running = queue.admit(admission.RENDER)
+    waiting = queue.admit(admission.RENDER)
+
+    with pytest.raises(errors.ServiceUnavailable):
+        waiting.wait()
+
+    running.release()
+    assert not waiting.granted
+    stats = queue.stats()
+    assert (stats["waiting"], stats["running"], stats["expired"]) == (0, 0, 1)
+
+
+def test_slot_waits_for_release():
+    queue = admission.RenderQueue()
+    order = []
+
+    def render(name):
+        with queue.slot(admission.RENDER):
+            order.append(name)
+
+    with queue.slot(admission.RENDER):
+        thread = threading.Thread(target=render, args=("second",))
+        thread.start()
+        time.sleep(0.05)
+        order.append("first")
+
+    thread.join()
+    assert order == ["first", "second"]
+
+
+def test_wait_async():
+    queue = admission.RenderQueue()
+    running = queue.admit(admission.RENDER)
+    waiting = queue.admit(admission.CHEAP)
+
+    async def main():
+        asyncio.get_running_loop().call_later(0.05, running.release)
+        await waiting.wait_async()
+
+    asyncio.run(main())
+    assert waiting.granted
+
+
+def test_socket_alive():
+    client, server = socket.socketpair()
+    alive = admission.socket_alive(server)
+    assert alive()
+
+    client.send(b"GET")
+    assert alive()
+    assert server.recv(3) == b"GET"
+
+    client.close()
+    assert not alive()
+    server.close()
+
+
+def test_socket_alive_without_peek():
+    class TLSSocket:
+        def recv(self, size, flags=0):
+            raise ValueError("non-zero flags not allowed in calls to recv()")
+
+    assert admission.socket_alive(TLSSocket())()
+
+
+def test_liveness_checked_by_waiters():
+    queue = admission.RenderQueue()
+    checks = []
+
+    def alive():
+        # Not with the lock of the queue held
+        assert not queue._lock.locked()
+        checks.append(threading.current_thread())
+        return True
+
+    running = queue.admit(admission.RENDER)
+    waiting = [queue.admit(admission.RENDER, alive=alive) for _ in range(3)]
+    running.release()
+    queue.admit(admission.CHEAP).release()
+    for ticket in waiting:
+        ticket.release()
+    assert checks == []
+
+    with queue.slot(admission.RENDER, alive=alive):
+        pass
+    assert checks == [threading.current_thread()]
+
+
+def test_abandoned_requests_never_granted():
+    queue = admission.RenderQueue()
+    gone = threading.Event()
+
+    running = queue.admit(admission.RENDER)
+    abandoned = queue.admit(admission.RENDER, alive=lambda: not gone.is_set())
+    waiting = queue.admit(admission.RENDER)
+
+    gone.set()
+    with pytest.raises(errors.RequestCancelled) as info:
+        abandoned.wait()
+    assert info.value.status == 499
+
+    running.release()
+    assert waiting.granted and not abandoned.granted
+    assert queue.stats()["cancelled"] == 1
@@ -0,0 +1,117 @@
+import asyncio
+import concurrent.futures
+
+from skinnywms.asgi import ASGIApplication
+
+from helpers import Field, make_stub_server
+
+
+class Catalogs:
+    def __init__(self, availability):
+        self.availability = availability
+
+    def get(self, location):
+        return self.availability
+
+
+class Executor(concurrent.futures.ThreadPoolExecutor):
+    def __init__(self):
+        super().__init__(max_workers=1)
+        self.submitted = 0
+
+    def submit(self, *args, **kwargs):
+        self.submitted += 1
+        return super().submit(*args, **kwargs)
+
+
+def make_app():
+    server = make_stub_server()
+    config = dict(data_root="data")
+    return ASGIApplication(config, server, Catalogs(server.availability), Executor())
+
+
+def call(app, path, query=b""):
+    scope = dict(
+        type="http",
+        method="GET",
+        path=path,
+        query_string=query,
+        headers=[(b"host", b"localhost")],
+    )
+    messages = []
+
+    requests = [{"type": "http.request"}]
+
+    async def receive():
+        if requests:
+            return requests.pop()
+        # No disconnection
+        await asyncio.Event().wait()
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    start, body = messages
+    return start["status"], dict(start["headers"]), body["body"]
+
+
+def test_capabilities_served_on_event_loop_once_cached():
+    app = make_app()
+
+    status, headers, first = call(app, "/wms", b"request=GetCapabilities")
+    assert status == 200
+    assert headers[b"content-type"] == b"text/xml"
+    assert b"<Name>2t</Name>" in first
+    assert app.executor.submitted == 1
+
+    status, _, second = call(app, "/wms", b"request=GetCapabilities")
+    assert status == 200
+    assert second == first
+    assert app.executor.submitted == 1
+
+
+def test_errors_and_unknown_routes():
+    app = make_app()
+
+    status, headers, body = call(app, "/wms", b"request=GetFeatureInfo")
+    assert status == 200
+    assert b"OperationNotSupported" in body
+    assert headers[b"access-control-allow-origin"] == b"*"
+    assert app.executor.submitted == 0
+
+    assert call(app, "/missing")[0] == 404
+
+    status, _, body = call(app, "/wms", b"model=nope&request=GetCapabilities")
+    assert status == 404
+    assert b"LayerNotDefined" in body
+
+
+def test_availability_of_the_dataset():
+    app = make_app()
+
+    status, _, body = call(app, "/availability")
+    assert status == 200
+    assert b'"aliases": {"default": "2t"}' in body
+    # Not on the event loop, even though the catalog is loaded
+    assert app.executor.submitted == 1
+
+    assert call(app, "/availability", b"model=nope")[0] == 404
+
+
+def test_availability_described_once_per_version():
+    described = []
+
+    class Described(Field):
+        def as_dict(self):
+            described.append(self.name)
+            return super().as_dict()
+
+    availability = make_stub_server(Described("2t")).availability
+    first = availability.as_dict()
+    assert availability.as_dict() == first
+    assert described == ["2t"]
+
+    availability.add_field(Described("msl"))
+    assert len(availability.as_dict()["layers"]) == 2
+    assert described == ["2t", "2t", "msl"]
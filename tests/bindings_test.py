@@ -0,0 +1,91 @@
+import threading
+
+import numpy as np
+
+from skinnywms.grib_bindings import GribFile, bindings
+from skinnywms.grib_bindings.GribField import reduced_grid, reduced_grid_coordinates
+
+from helpers import encode
+
+
+def test_encode_message():
+    message = encode(shortName="t", level=850)
+    assert message[:4] == b"GRIB" and message[-4:] == b"7777"
+
+    handle = bindings.grib_handle_new_from_message_copy(message, len(message))
+    try:
+        assert bindings.grib_get_string(handle, "shortName") == "t"
+        assert bindings.grib_get_long(handle, "level") == 850
+        np.testing.assert_allclose(
+            bindings.grib_values(handle), np.arange(12.0) + 250, atol=0.01
+        )
+    finally:
+        bindings.grib_handle_delete(handle)
+
+
+def test_headers_only(tmp_path):
+    path = str(tmp_path / "data.grib")
+    with open(path, "wb") as f:
+        f.write(encode(shortName="t", level=850))
+        f.write(encode(shortName="z", level=500))
+
+    full = [(f.shortName, f.level, f.offset) for f in GribFile(path)]
+    headers = [(f.shortName, f.level, f.offset) for f in GribFile(path, True)]
+    assert full == headers == [("t", 850, 0), ("z", 500, full[1][2])]
+
+
+def test_decode_float32():
+    # Only decoded in double precision by ecCodes
+    message = encode(shortName="t", level=850, packingType="grid_jpeg")
+
+    handle = bindings.grib_handle_new_from_message_copy(message, len(message))
+    try:
+        assert bindings.grib_get_string(handle, "packingType") == "grid_jpeg"
+        values = bindings.grib_decode(handle, dtype=np.float32)
+        assert values.dtype == np.float32
+        np.testing.assert_allclose(values, np.arange(12.0) + 250, atol=0.01)
+
+        out = np.empty((3, 4), dtype=np.float32)
+        assert bindings.grib_decode(handle, out=out) is out
+        np.testing.assert_allclose(out.ravel(), values)
+    finally:
+        bindings.grib_handle_delete(handle)
+
+
+def test_decode_float32_scratch(monkeypatch):
+    message = encode(shortName="t", level=850, packingType="grid_jpeg")
+    monkeypatch.setattr(bindings, "_SCRATCH", threading.local())
+
+    handle = bindings.grib_handle_new_from_message_copy(message, len(message))
+    try:
+        # Not kept for fields larger than _SCRATCH_MAX
+        monkeypatch.setattr(bindings, "_SCRATCH_MAX", 8)
+        values = bindings.grib_decode(handle, dtype=np.float32)
+        np.testing.assert_allclose(values, np.arange(12.0) + 250, atol=0.01)
+        assert getattr(bindings._SCRATCH, "buffer", None) is None
+
+        monkeypatch.setattr(bindings, "_SCRATCH_MAX", 12)
+        bindings.grib_decode(handle, dtype=np.float32)
+        assert bindings._SCRATCH.buffer.size == 12
+    finally:
+        bindings.grib_handle_delete(handle)
+
+
+def test_reduced_grid_coordinates():
+    # With empty rows, as near the poles of some reduced_ll grids
+    pl = [0, 4, 8, 0, 20, 8, 4, 0]
+    latitudes = np.linspace(90, -90, len(pl))
+
+    expected = np.array(list(reduced_grid(pl, latitudes)))
+    lats, lons = reduced_grid_coordinates(pl, latitudes)
+    assert lats.size == lons.size == sum(pl)
+    assert np.array_equal(lats, expected[:, 0])
+    assert np.array_equal(lons, expected[:, 1])
+
+    lats, lons = reduced_grid_coordinates(pl, latitudes, dtype=np.float32)
+    assert lats.dtype == lons.dtype == np.float32
+    assert np.allclose(lons, expected[:, 1])
+
+    # Extra rows are ignored, as by zip()
+    lats, lons = reduced_grid_coordinates(pl + [16], latitudes)
+    assert np.array_equal(lons, expected[:, 1])
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from skinnywms.grib_bindings import cache
+from skinnywms.grib_bindings.cache import GeometryCache
+
+
+@pytest.fixture(autouse=True)
+def caches(monkeypatch):
+    # Not reported with the caches of the server
+    monkeypatch.setattr(cache, "CACHES", [])
+
+
+def test_bounded_entries():
+    geometries = GeometryCache("test", maxsize=2)
+    for key in "abc":
+        geometries.put(key, np.zeros(4))
+
+    assert len(geometries) == 2
+    assert geometries.get("a") is None
+    assert geometries.stats()["evictions"] == 1
+    assert geometries.stats()["nbytes"] == 2 * 32
+
+
+def test_bounded_bytes():
+    geometries = GeometryCache("test", maxbytes=100)
+    geometries.put("a", np.zeros(8))
+    geometries.put("b", (np.zeros(4), np.zeros(4)))
+    assert len(geometries) == 1
+    assert geometries.get("b") is not None
+
+    # The latest entry is kept, even if larger than maxbytes
+    geometries.put("c", np.zeros(100))
+    assert len(geometries) == 1
+    assert geometries.nbytes == 800
+
+
+def test_least_recently_used_evicted():
+    geometries = GeometryCache("test", maxsize=2)
+    geometries.put("a", np.zeros(1))
+    geometries.put("b", np.zeros(1))
+    assert geometries.get("a") is not None
+    geometries.put("c", np.zeros(1))
+
+    assert geometries.get("b") is None
+    assert geometries.get("a") is not None
+    assert geometries.stats()["hits"] == 2
+    assert geometries.stats()["misses"] == 1
+
+
+def test_read_only_and_shared():
+    geometries = GeometryCache("test")
+    value = geometries.put("a", dict(lats=np.zeros(2), lons=[np.zeros(2)]))
+    lats, lons = value["lats"], value["lons"]
+    assert not lats.flags.writeable
+    assert not lons[0].flags.writeable
+    with pytest.raises(ValueError):
+        lats[0] = 1
+
+    # The first value added wins
+    created = []
+    assert geometries.get_or_create("a", lambda: created.append(1)) is value
+    assert geometries.put("a", dict(lats=np.ones(2))) is value
+    assert created == []
@@ -0,0 +1,69 @@
+import gzip
+import json
+
+from helpers import Field, make_stub_server, process
+
+
+def render_template(name, **variables):
+    render_template.calls += 1
+    return "%s %s" % (name, " ".join(layer.name for layer in variables["layers"]))
+
+
+def get_capabilities(server, **headers):
+    return process(
+        server,
+        headers=headers,
+        render_template=render_template,
+        request="GetCapabilities",
+    )
+
+
+def test_capabilities_cached():
+    render_template.calls = 0
+    server = make_stub_server()
+
+    first = get_capabilities(server)
+    second = get_capabilities(server)
+
+    assert render_template.calls == 1
+    assert first.content == second.content == b"getcapabilities_1.3.0.xml 2t"
+    assert first.headers["ETag"] == second.headers["ETag"]
+
+
+def test_capabilities_invalidated_by_catalog_version():
+    render_template.calls = 0
+    server = make_stub_server()
+
+    first = get_capabilities(server)
+    server.availability.add_field(Field("msl"))
+    second = get_capabilities(server)
+
+    assert render_template.calls == 2
+    assert second.content == b"getcapabilities_1.3.0.xml 2t msl"
+    assert first.headers["ETag"] != second.headers["ETag"]
+
+
+def test_capabilities_conditional_and_gzip():
+    server = make_stub_server()
+
+    etag = get_capabilities(server).headers["ETag"]
+    assert get_capabilities(server, **{"If-None-Match": etag}).status == 304
+
+    compressed = get_capabilities(server, **{"Accept-Encoding": "gzip, deflate"})
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(compressed.content) == b"getcapabilities_1.3.0.xml 2t"
+
+
+def test_server_timing_and_slow_log(caplog):
+    server = make_stub_server()
+    server.slow_request_threshold = 0
+
+    first = get_capabilities(server)
+    second = get_capabilities(server)
+
+    assert first.headers["Server-Timing"].startswith("encode;dur=")
+    assert second.headers["Server-Timing"].startswith("cache;dur=")
+
+    slow = [json.loads(r.message) for r in caplog.records if r.name == "skinnywms.slow"]
+    assert [r["cache"] for r in slow] == ["miss", "hit"]
+    assert slow[0]["request"] == "request=GetCapabilities"
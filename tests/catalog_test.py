@@ -0,0 +1,81 @@
+from skinnywms.data.fs import Availability
+
+from helpers import encode, make_server
+
+
+def serve_steps(tmp_path, cache=None):
+    for step in (0, 6):
+        with open(str(tmp_path / ("step_%d.grib" % (step,))), "wb") as f:
+            for name in ("t", "z"):
+                f.write(encode(shortName=name, level=850, dataDate=20220501, step=step))
+
+    return make_server(Availability(str(tmp_path)), cache=cache)
+
+
+def test_fields_are_views(tmp_path):
+    server = serve_steps(tmp_path)
+    availability = server.availability
+    assert sorted(layer.name for layer in availability.layers()) == ["t_850", "z_850"]
+
+    field = availability.layer("z_850", {"time": "2022-05-01T18:00:00Z"})
+    assert field.path == str(tmp_path / "step_6.grib")
+    assert field.index == 1
+    assert field.offset > 0
+    assert field.title == "Geopotential at 850"
+    assert field.styles[0].name == "fake_contour"
+
+    # Read from the file
+    assert field.mars["param"] == "129"
+    assert field.mars["step"] == "6"
+
+    other = availability.layer("z_850", {"time": "2022-05-01T18:00:00Z"})
+    assert other is not field and other.offset == field.offset
+
+
+def test_styles_are_looked_up_when_needed(tmp_path):
+    server = serve_steps(tmp_path)
+    driver = server.styler.driver
+
+    layers = server.availability.layers()
+    assert len(layers) == 2
+    assert "wmsstyles" not in driver.verbs()
+
+    field = server.availability.layer("t_850", {"time": "2022-05-01T12:00:00Z"})
+    assert "wmsstyles" not in driver.verbs()
+
+    assert field.style("").name == "fake_contour"
+    assert driver.verbs() == ["mgrib", "wmsstyles"]
+    assert server.availability.layer("t_850", {}).styles is field.styles
+    assert driver.verbs() == ["mgrib", "wmsstyles"]
+
+
+def test_styles_are_not_looked_up_by_refresh(tmp_path):
+    server = serve_steps(tmp_path)
+    driver = server.styler.driver
+    assert len(server.availability.layers()) == 2
+
+    (tmp_path / "step_6.grib").unlink()
+    assert server.availability.refresh()
+    assert len(server.availability.layers()) == 2
+    assert "wmsstyles" not in driver.verbs()
+
+
+def test_styles_are_cached_on_disk(tmp_path):
+    data = tmp_path / "data"
+    data.mkdir()
+    cache = str(tmp_path / "styles.json")
+
+    server = serve_steps(data, cache)
+    server.availability.layer("t_850", {}).styles
+    assert server.styler.driver.verbs() == ["mgrib", "wmsstyles"]
+    server.styler.save()
+
+    server = serve_steps(data, cache)
+    styles = server.availability.layer("t_850", {}).styles
+    assert [s.name for s in styles] == ["fake_contour"]
+    assert server.styler.driver.verbs() == []
+    assert server.styler.cache.stats()["hits"] == 1
+
+    # Not for another parameter
+    server.availability.layer("z_850", {}).styles
+    assert server.styler.driver.verbs() == ["mgrib", "wmsstyles"]
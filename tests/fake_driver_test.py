@@ -0,0 +1,115 @@
+import pytest
+
+from skinnywms import errors, metrics
+from skinnywms.data.fs import Availability
+from skinnywms.plot.fake import PNG, FakeDriver
+
+from helpers import encode, make_server, process
+
+
+def serve_2t(tmp_path, driver):
+    (tmp_path / "2t.grib").write_bytes(
+        encode("regular_ll_sfc_grib2", shortName="2t", dataDate=20220501)
+    )
+    return make_server(Availability(str(tmp_path)), driver)
+
+
+def test_getmap(tmp_path):
+    driver = FakeDriver()
+    server = serve_2t(tmp_path, driver)
+
+    response = process(
+        server,
+        request="GetMap",
+        layers="2t",
+        styles="fake_contour",
+        crs="EPSG:4326",
+        bbox="-90,-180,90,180",
+        width="256",
+        height="128",
+        format="image/png",
+    )
+
+    assert response.content == PNG
+    assert response.mimetype == "image/png"
+    assert driver.verbs() == [
+        "mgrib",
+        "wmsstyles",
+        "output",
+        "mmap",
+        "mgrib",
+        "mcont",
+        "plot",
+    ]
+
+    _, mmap = driver.calls[3]
+    assert mmap["subpage_lower_left_latitude"] == -90
+    assert mmap["output_width"] == 256
+
+
+def test_legend(tmp_path):
+    driver = FakeDriver()
+    server = serve_2t(tmp_path, driver)
+
+    response = process(
+        server, request="GetLegendGraphic", layer="2t", style="fake_contour"
+    )
+
+    assert response.content == PNG
+    assert driver.verbs()[-1] == "plot"
+    assert "mlegend" in driver.verbs()
+
+
+def test_layer_labels(tmp_path):
+    server = serve_2t(tmp_path, FakeDriver())
+
+    def count(layer):
+        return metrics.REQUEST_DURATION.count(operation="getmap", layer=layer)
+
+    before = {layer: count(layer) for layer in ("2t", "other", "2t,nope")}
+    with pytest.raises(errors.LayerNotDefined):
+        process(
+            server,
+            request="GetMap",
+            layers="2t,nope",
+            styles="",
+            crs="EPSG:4326",
+            bbox="-90,-180,90,180",
+            width="256",
+            height="128",
+            format="image/png",
+        )
+    after = {layer: count(layer) for layer in before}
+
+    assert after["2t"] == before["2t"] + 1
+    assert after["other"] == before["other"] + 1
+    assert after["2t,nope"] == 0
+
+
+def test_render_slot_held_only_to_plot(tmp_path):
+    server = serve_2t(tmp_path, FakeDriver())
+    availability = server.availability
+    running = []
+
+    def load(load=availability.load):
+        running.append(("load", server.render_queue.stats()["running"]))
+        return load()
+
+    def plot(*args, plot=server.plotter.plot, **kwargs):
+        running.append(("plot", server.render_queue.stats()["running"]))
+        return plot(*args, **kwargs)
+
+    availability.load = load
+    server.plotter.plot = plot
+    process(
+        server,
+        request="GetMap",
+        layers="2t",
+        styles="",
+        crs="EPSG:4326",
+        bbox="-90,-180,90,180",
+        width="256",
+        height="128",
+        format="image/png",
+    )
+    assert running == [("load", 0), ("plot", 1)]
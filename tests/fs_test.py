@@ -0,0 +1,461 @@
+import os
+import threading
+import time
+
+import pytest
+
+from skinnywms.data import fs
+from skinnywms.data.fs import READERS, Availability, Catalogs
+from skinnywms.data.rejects import RejectedFiles
+from skinnywms.data.watch import InotifyWatcher, PollingWatcher, create_watcher
+from skinnywms.fields.GRIBField import GRIBReader
+from skinnywms.plot.fake import FakeDriver
+from skinnywms.wmssvr import create_app
+
+from helpers import encode, make_server
+
+SAMPLE = "regular_ll_sfc_grib2"
+
+
+def write(path, *names, step=0):
+    with open(str(path), "wb") as f:
+        for name in names:
+            f.write(encode(SAMPLE, shortName=name, dataDate=20220501, step=step))
+
+
+def layer_names(availability):
+    return sorted(layer.name for layer in availability.layers())
+
+
+def test_datasets_are_loaded_independently(tmp_path):
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    write(tmp_path / "a" / "data.grib", "2t")
+    write(tmp_path / "b" / "data.grib", "msl")
+
+    catalogs = Catalogs()
+    server = make_server(catalogs.get(str(tmp_path / "a")))
+    catalogs.set_context(server)
+
+    # As if 'a' was being scanned
+    a = catalogs.get(str(tmp_path / "a"))
+    with a._lock:
+        assert layer_names(catalogs.get(str(tmp_path / "b"))) == ["msl"]
+        assert not a.loaded
+
+    assert layer_names(a) == ["2t"]
+
+
+def test_reload_keeps_serving_the_previous_catalog(tmp_path):
+    write(tmp_path / "step_0.grib", "2t")
+    availability = Availability(str(tmp_path))
+    server = make_server(availability)
+
+    assert layer_names(availability) == ["2t"]
+    version = availability.version
+    previous = availability.layers()
+
+    write(tmp_path / "step_6.grib", "2t", "msl", step=6)
+
+    scanning = threading.Event()
+    done = threading.Event()
+    add_file = availability.add_file
+
+    def slow_add_file(*args):
+        scanning.set()
+        done.wait(10)
+        add_file(*args)
+
+    availability.add_file = slow_add_file
+    thread = availability.reload_in_background()
+    assert scanning.wait(10)
+
+    assert not availability.reload()
+    assert layer_names(availability) == ["2t"]
+    assert availability.version == version
+
+    done.set()
+    thread.join()
+    assert layer_names(availability) == ["2t", "msl"]
+    assert availability.version > version
+    assert server.availability is availability
+
+    # Still usable by the requests that got it before the reload
+    assert len(previous[0].dimensions[0].extent.split(",")) == 1
+
+
+def test_stale_catalogs_are_reloaded(tmp_path):
+    write(tmp_path / "step_0.grib", "2t")
+    availability = Availability(str(tmp_path), max_age=0)
+    # The context of the fields
+    server = make_server(availability)
+
+    assert layer_names(availability) == ["2t"]
+    write(tmp_path / "step_6.grib", "msl", step=6)
+
+    deadline = time.monotonic() + 10
+    while layer_names(availability) != ["2t", "msl"]:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_requests_use_their_dataset(tmp_path):
+    for name, directory in (("2t", "00"), ("msl", "12")):
+        (tmp_path / "model" / "20220501" / directory).mkdir(parents=True)
+        write(tmp_path / "model" / "20220501" / directory / "data.grib", name)
+
+    app = create_app(dict(data_root=str(tmp_path)), driver=FakeDriver())
+    client = app.test_client()
+
+    def capabilities(time):
+        url = "/wms?model=model&date=20220501&time=%s&request=GetCapabilities"
+        return client.get(url % (time,)).get_data(as_text=True)
+
+    results = {}
+
+    def get(time):
+        results[time] = [capabilities(time) for _ in range(10)]
+
+    threads = [threading.Thread(target=get, args=(t,)) for t in ("00", "12")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert all("<Name>2t</Name>" in r and "msl" not in r for r in results["00"])
+    assert all("<Name>msl</Name>" in r and "2t<" not in r for r in results["12"])
+
+
+def test_scan_progress(tmp_path):
+    write(tmp_path / "step_0.grib", "2t", "msl")
+    write(tmp_path / "step_6.grib", "2t", step=6)
+    (tmp_path / "notes.txt").write_text("not a GRIB file")
+    availability = Availability(str(tmp_path))
+    server = make_server(availability)
+
+    assert availability.status() == dict(state="pending", loaded=False)
+
+    availability.load()
+    status = availability.status()
+    assert status["state"] == "ready"
+    assert status["loaded"]
+    assert (status["files"], status["files_done"]) == (3, 3)
+    assert (status["fields"], status["skipped"], status["errors"]) == (3, 1, 0)
+    assert server.availability is availability
+
+
+def test_ready_once_scanned(tmp_path, monkeypatch):
+    (tmp_path / "model" / "20220501" / "00").mkdir(parents=True)
+    write(tmp_path / "model" / "20220501" / "00" / "data.grib", "2t")
+
+    done = threading.Event()
+    add_file = Availability.add_file
+
+    def slow_add_file(*args):
+        done.wait(10)
+        add_file(*args)
+
+    monkeypatch.setattr(Availability, "add_file", slow_add_file)
+    config = dict(data_root=str(tmp_path), scan_in_background=True)
+    client = create_app(config, driver=FakeDriver()).test_client()
+
+    assert client.get("/health").status_code == 200
+    response = client.get("/ready")
+    assert response.status_code == 503
+    assert not response.get_json()["ready"]
+
+    done.set()
+    deadline = time.monotonic() + 10
+    while client.get("/ready").status_code != 200:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+    (status,) = client.get("/ready").get_json()["datasets"].values()
+    assert status["files_done"] == 1
+    assert status["fields"] == 1
+
+
+def test_partial_catalogs(tmp_path, monkeypatch):
+    write(tmp_path / "step_0.grib", "2t")
+    write(tmp_path / "step_6.grib", "msl", step=6)
+    monkeypatch.setattr("skinnywms.data.fs.PARTIAL_INTERVAL", 0)
+
+    availability = Availability(str(tmp_path), partial=True)
+    server = make_server(availability)
+
+    second = threading.Event()
+    done = threading.Event()
+    add_file = availability.add_file
+
+    def slow_add_file(path, scan):
+        if path.endswith("step_6.grib"):
+            second.set()
+            done.wait(10)
+        add_file(path, scan)
+
+    availability.add_file = slow_add_file
+
+    # Starts the scan, without waiting for it
+    availability.ensure_loaded()
+    assert second.wait(10)
+    assert layer_names(availability) == ["2t"]
+    assert not availability.loaded
+
+    done.set()
+    deadline = time.monotonic() + 10
+    while not availability.loaded:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert layer_names(availability) == ["2t", "msl"]
+    assert server.availability is availability
+
+
+def times(availability, name):
+    (layer,) = [layer for layer in availability.layers() if layer.name == name]
+    return [field.time for field in layer.fields()]
+
+
+def test_refresh(tmp_path):
+    write(tmp_path / "step_0.grib", "2t")
+    availability = Availability(str(tmp_path))
+    server = make_server(availability)
+
+    assert layer_names(availability) == ["2t"]
+    version = availability.version
+    assert not availability.refresh()
+    assert availability.version == version
+
+    write(tmp_path / "step_6.grib", "2t", step=6)
+    assert availability.refresh()
+    assert len(times(availability, "2t")) == 2
+    assert availability.version > version
+
+    version = availability.version
+    write(tmp_path / "step_0.grib", "msl")
+    assert availability.refresh()
+    assert layer_names(availability) == ["2t", "msl"]
+    assert len(times(availability, "2t")) == 1
+    assert availability.version > version
+
+    (tmp_path / "step_6.grib").unlink()
+    assert availability.refresh()
+    assert layer_names(availability) == ["msl"]
+    assert list(availability._paths) == [str(tmp_path / "step_0.grib")]
+    assert server.availability is availability
+
+
+@pytest.mark.parametrize("watcher", [PollingWatcher, InotifyWatcher])
+def test_watch(tmp_path, watcher):
+    write(tmp_path / "step_0.grib", "2t")
+    availability = Availability(str(tmp_path), watcher=watcher(interval=0.05))
+    server = make_server(availability)
+
+    assert layer_names(availability) == ["2t"]
+    (tmp_path / "12").mkdir()
+    write(tmp_path / "12" / "step_12.grib", "msl", step=12)
+
+    deadline = time.monotonic() + 10
+    while layer_names(availability) != ["2t", "msl"]:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert server.availability is availability
+    availability._watcher.stop()
+
+
+def test_watcher_falls_back_to_polling(monkeypatch):
+    class Libc:
+        def inotify_init1(self, flags):
+            return -1
+
+    monkeypatch.setattr("skinnywms.data.watch.sys.platform", "linux")
+    monkeypatch.setattr("skinnywms.data.watch._libc", Libc)
+    assert isinstance(create_watcher(), PollingWatcher)
+
+
+def test_growing_grib_file(tmp_path, monkeypatch):
+    path = tmp_path / "run.grib"
+    messages = [
+        encode(SAMPLE, shortName="2t", dataDate=20220501, step=s) for s in (0, 6, 12)
+    ]
+    path.write_bytes(messages[0])
+
+    offsets = []
+
+    class Reader(GRIBReader):
+        def __init__(self, context, path, offset=0, index=0):
+            super(Reader, self).__init__(context, path, offset, index)
+            offsets.append(offset)
+
+    monkeypatch.setattr("skinnywms.data.fs.GRIBReader", Reader)
+    monkeypatch.setitem(READERS, b"GRIB", Reader)
+    availability = Availability(str(path.parent))
+    server = make_server(availability)
+    assert len(times(availability, "2t")) == 1
+
+    # The last message is still being written
+    with open(str(path), "ab") as f:
+        f.write(messages[1] + messages[2][:50])
+    assert availability.refresh()
+    assert len(times(availability, "2t")) == 2
+    assert offsets == [0, len(messages[0])]
+
+    with open(str(path), "ab") as f:
+        f.write(messages[2][50:])
+    assert availability.refresh()
+    assert len(times(availability, "2t")) == 3
+    assert offsets == [0, len(messages[0]), len(messages[0]) + len(messages[1])]
+    assert availability._paths[str(path)] == 3
+
+    field = availability.layer("2t", dict(time="2022-05-02T00:00:00Z"))
+    assert field.mars["step"] == "12"
+    assert server.availability is availability
+
+
+def test_unsupported_files(tmp_path, monkeypatch):
+    data = tmp_path / "data"
+    data.mkdir()
+    # After some padding
+    (data / "fc.grib").write_bytes(b"\0" * 16 + encode(SAMPLE, shortName="2t"))
+    (data / "tc_bufr4.bin").write_bytes(b"\0" * 8 + b"BUFR" + b"\0" * 100)
+    write(data / "old.grib", "msl")
+    rejected = str(tmp_path / "rejected.json")
+
+    def load():
+        availability = Availability(
+            str(data), exclude=["old.*"], rejected=RejectedFiles(rejected)
+        )
+        server = make_server(availability)
+        assert layer_names(availability) == ["2t"]
+        assert server.availability is availability
+        return availability
+
+    availability = load()
+    assert availability._paths[str(data / "tc_bufr4.bin")] == ["Unsupported BUFR file"]
+    assert availability.status()["skipped"] == 1
+
+    sniffed = []
+    sniff = fs._sniff
+
+    def spy(path):
+        sniffed.append(os.path.basename(path))
+        return sniff(path)
+
+    monkeypatch.setattr(fs, "_sniff", spy)
+    availability = load()
+    assert sniffed == ["fc.grib"]
+    assert availability.status()["skipped"] == 1
+
+    with open(str(data / "tc_bufr4.bin"), "ab") as f:
+        f.write(b"\0")
+    load()
+    assert sniffed == ["fc.grib", "fc.grib", "tc_bufr4.bin"]
+
+
+def test_unknown_datasets(tmp_path):
+    (tmp_path / "data" / "model" / "20220501" / "00").mkdir(parents=True)
+    write(tmp_path / "data" / "model" / "20220501" / "00" / "data.grib", "2t")
+    (tmp_path / "other" / "20220501" / "00").mkdir(parents=True)
+
+    app = create_app(dict(data_root=str(tmp_path / "data")), driver=FakeDriver())
+    client = app.test_client()
+    catalogs = app.extensions["skinnywms"]["catalogs"]
+
+    for model in ("nope", "../other", "model/../../other"):
+        url = "/wms?model=%s&date=20220501&time=00&request=GetCapabilities"
+        response = client.get(url % (model,))
+        assert response.status_code == 404
+        assert b"LayerNotDefined" in response.get_data()
+
+    assert catalogs.status()["datasets"] == {}
+
+    url = "/wms?model=model&date=20220501&time=00&request=GetCapabilities"
+    assert b"<Name>2t</Name>" in client.get(url).get_data()
+
+
+def test_wms_errors(tmp_path):
+    (tmp_path / "ecmwf" / "20220501" / "00").mkdir(parents=True)
+    write(tmp_path / "ecmwf" / "20220501" / "00" / "data.grib", "2t")
+    app = create_app(dict(data_root=str(tmp_path)), driver=FakeDriver())
+    client = app.test_client()
+
+    url = (
+        "/wms?request=GetMap&version=1.3.0&layers=%s&styles=&crs=EPSG:4326"
+        "&bbox=-90,-180,90,180&width=256&height=128&format=image/png%s"
+    )
+    for query, code in (
+        (("2t", "&TIME=garbage"), b"InvalidDimensionValue"),
+        (("2t", "&DIM_INDEX=99"), b"InvalidDimensionValue"),
+        (("nope", ""), b"LayerNotDefined"),
+    ):
+        response = client.get(url % query)
+        assert response.status_code == 200
+        assert response.mimetype == "text/xml"
+        assert b"<ServiceExceptionReport" in response.get_data()
+        assert code in response.get_data()
+
+
+def test_ready_ignores_requested_datasets(tmp_path, monkeypatch):
+    (tmp_path / "model" / "20220501" / "00").mkdir(parents=True)
+    write(tmp_path / "model" / "20220501" / "00" / "data.grib", "2t")
+
+    config = dict(
+        data_root=str(tmp_path), scan_in_background=True, partial_catalogs=True
+    )
+    client = create_app(config, driver=FakeDriver()).test_client()
+    deadline = time.monotonic() + 10
+    while client.get("/ready").status_code != 200:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+    # A new run, first requested by a client while the server is ready
+    (tmp_path / "model" / "20220501" / "12").mkdir(parents=True)
+    write(tmp_path / "model" / "20220501" / "12" / "data.grib", "msl")
+
+    done = threading.Event()
+    add_file = Availability.add_file
+
+    def slow_add_file(*args):
+        done.wait(10)
+        add_file(*args)
+
+    monkeypatch.setattr(Availability, "add_file", slow_add_file)
+    url = "/wms?model=model&date=20220501&time=12&request=GetCapabilities"
+    assert client.get(url).status_code == 200
+
+    response = client.get("/ready")
+    assert response.status_code == 200
+    datasets = response.get_json()["datasets"]
+    assert sorted(status["preload"] for status in datasets.values()) == [False, True]
+    done.set()
+
+
+def test_availability_of_the_dataset(tmp_path):
+    for name, directory in (("2t", "00"), ("msl", "12")):
+        (tmp_path / "model" / "20220501" / directory).mkdir(parents=True)
+        write(tmp_path / "model" / "20220501" / directory / "data.grib", name)
+
+    app = create_app(dict(data_root=str(tmp_path)), driver=FakeDriver())
+    client = app.test_client()
+
+    url = "/availability?model=model&date=20220501&time=12"
+    layers = client.get(url).get_json()["layers"]
+    assert [layer["fields"][0]["name"] for layer in layers] == ["msl"]
+
+    url = "/availability?model=model&date=20220501&time=18"
+    assert client.get(url).status_code == 404
+
+
+def test_winds_are_paired_within_a_file(tmp_path):
+    write(tmp_path / "winds.grib", "10u", "10v")
+    write(tmp_path / "v.grib", "10v")
+    server = make_server(Availability(str(tmp_path)))
+
+    for _ in range(2):
+        # The second component is the wind
+        u, v = GRIBReader(server, str(tmp_path / "winds.grib")).get_fields()
+        assert v.wind and not u.wind
+        assert (v.ucomponent, v.vcomponent) == (0, 1)
+
+        # Not with the components of the other files, nor of the previous scans
+        (field,) = GRIBReader(server, str(tmp_path / "v.grib")).get_fields()
+        assert not field.wind
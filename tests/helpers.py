@@ -0,0 +1,104 @@
+"""Helpers shared by the tests: GRIB messages, stand-ins for the fields, the
+plotter, the styler and the web framework, and servers built from them.
+
+"""
+
+import datetime
+
+import numpy as np
+
+from skinnywms import datatypes
+from skinnywms.grib_bindings import bindings
+from skinnywms.plot import magics
+from skinnywms.plot.fake import FakeDriver
+from skinnywms.server import WMSServer
+
+BASE = datetime.datetime(2022, 5, 1)
+
+
+def encode(sample="regular_ll_pl_grib2", **keys):
+    handle = bindings.grib_handle_new_from_samples(sample)
+    try:
+        bindings.grib_set(handle, "Ni", 4)
+        bindings.grib_set(handle, "Nj", 3)
+        for name, value in keys.items():
+            bindings.grib_set(handle, name, value)
+        bindings.grib_set_double_array(handle, "values", np.arange(12.0) + 250)
+        return bindings.grib_get_message(handle)
+    finally:
+        bindings.grib_handle_delete(handle)
+
+
+class Field(datatypes.Field):
+    def __init__(self, name="2t", time=BASE, elevation=None):
+        self.name = name
+        self.title = name
+        self.time = time
+        self.elevation = elevation
+        self.styles = []
+
+    def as_dict(self):
+        return dict(name=self.name)
+
+
+class Plotter(datatypes.Plotter):
+    supported_crss = ()
+    geographic_bounding_box = None
+
+    def layers(self):
+        return []
+
+
+class Styler(datatypes.Styler):
+    pass
+
+
+class Request:
+    def __init__(self, headers=None, **args):
+        self.url = "http://localhost/wms?" + "&".join(
+            "%s=%s" % kv for kv in args.items()
+        )
+        self.args = args
+        self.headers = headers or {}
+
+
+class Response:
+    def __init__(self, content=None, status=200, mimetype=None, headers=None):
+        self.content = content
+        self.status = status
+        self.mimetype = mimetype
+        self.headers = headers or {}
+
+
+def send_file(path, mimetype):
+    with open(path, "rb") as f:
+        return Response(f.read(), mimetype=mimetype)
+
+
+def process(server, headers=None, render_template=None, **args):
+    return server.process(
+        Request(headers=headers, **args),
+        Response=Response,
+        send_file=send_file,
+        render_template=render_template,
+        reraise=True,
+    )
+
+
+def make_server(availability, driver=None, cache=None):
+    """A server plotting with Magics, through the fake driver."""
+    if driver is None:
+        driver = FakeDriver()
+    return WMSServer(
+        availability,
+        magics.Plotter(driver=driver),
+        magics.Styler(driver=driver, cache=cache),
+    )
+
+
+def make_stub_server(*fields):
+    """A server of these fields, with stand-ins for the plotter and styler."""
+    availability = datatypes.Availability()
+    for field in fields or (Field(),):
+        availability.add_field(field)
+    return WMSServer(availability, Plotter(), Styler())
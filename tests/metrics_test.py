@@ -0,0 +1,70 @@
+from skinnywms import metrics
+
+
+def test_render():
+    registry = metrics.Registry()
+    counter = registry.counter("requests_total", "Requests", ("operation",))
+    histogram = registry.histogram("duration_seconds", "Duration", buckets=(0.1, 1))
+
+    counter.inc(operation="getmap")
+    counter.inc(2, operation="getmap")
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    registry.caches(lambda: [dict(name="regular", hits=3, misses=1)])
+
+    assert metrics.render(registry.collect()).split("\n") == [
+        "# HELP requests_total Requests",
+        "# TYPE requests_total counter",
+        'requests_total{operation="getmap"} 3',
+        "# HELP duration_seconds Duration",
+        "# TYPE duration_seconds histogram",
+        'duration_seconds_bucket{le="0.1"} 1',
+        'duration_seconds_bucket{le="1"} 2',
+        'duration_seconds_bucket{le="+Inf"} 3',
+        "duration_seconds_sum 5.55",
+        "duration_seconds_count 3",
+        "# HELP skinnywms_cache_hits_total Cache hits",
+        "# TYPE skinnywms_cache_hits_total counter",
+        'skinnywms_cache_hits_total{cache="regular"} 3',
+        "# HELP skinnywms_cache_misses_total Cache misses",
+        "# TYPE skinnywms_cache_misses_total counter",
+        'skinnywms_cache_misses_total{cache="regular"} 1',
+        "# HELP skinnywms_cache_entries Number of cached entries",
+        "# TYPE skinnywms_cache_entries gauge",
+        "# HELP skinnywms_cache_bytes Size of the cached arrays",
+        "# TYPE skinnywms_cache_bytes gauge",
+        "",
+    ]
+
+
+def test_instrumented_lock():
+    lock = metrics.InstrumentedLock("test")
+    waited = metrics.LOCK_WAIT.count(lock="test")
+
+    with lock:
+        assert lock.locked()
+        assert not lock.acquire(blocking=False)
+
+    assert not lock.locked()
+    assert metrics.LOCK_WAIT.count(lock="test") == waited + 1
+    assert metrics.LOCK_HELD.count(lock="test") == waited + 1
+
+
+def test_operation_labels():
+    known = {"2t", "msl"}.__contains__
+    assert metrics.operation("getmap", dict(layers="2t"), known) == ("getmap", ["2t"])
+    assert metrics.operation("getmap", dict(layers="msl,2t,x,y"), known) == (
+        "getmap",
+        ["2t", "msl", "other"],
+    )
+    assert metrics.operation("getlegendgraphic", dict(layer="z"), known) == (
+        "getlegendgraphic",
+        ["other"],
+    )
+    assert metrics.operation("getcapabilities", {}, known) == ("getcapabilities", [""])
+    assert metrics.operation("getfeatureinfo", dict(layers="2t"), known) == (
+        "other",
+        [""],
+    )
@@ -0,0 +1,71 @@
+import threading
+import time
+
+import pytest
+
+from skinnywms import profiler
+
+
+def busy(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_profile_seconds():
+    stop = threading.Event()
+    thread = threading.Thread(target=busy, args=(stop,))
+    thread.start()
+    try:
+        stacks = profiler.profile(seconds=0.2, interval=0.005)
+    finally:
+        stop.set()
+        thread.join()
+
+    assert any("busy (" in line for line in stacks.splitlines())
+    for line in stacks.splitlines():
+        stack, count = line.rsplit(" ", 1)
+        assert int(count) > 0
+
+
+def test_profile_requests():
+    result = {}
+
+    def run():
+        result["stacks"] = profiler.profile(
+            requests=1, match=dict(request="getmap"), timeout=5, interval=0.005
+        )
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    while not profiler._SESSIONS:
+        time.sleep(0.01)
+
+    def getcapabilities():
+        with profiler.profile_request(dict(request="GetCapabilities")):
+            time.sleep(0.05)
+
+    def getmap():
+        with profiler.profile_request(dict(request="GetMap", layers="2t")):
+            time.sleep(0.05)
+
+    getcapabilities()
+    getmap()
+    thread.join()
+
+    assert "getmap (" in result["stacks"]
+    assert "getcapabilities (" not in result["stacks"]
+
+
+def test_options():
+    assert profiler.options({"seconds": "5", "layers": "2t"}) == dict(
+        seconds=5.0, match=dict(layers="2t")
+    )
+    with pytest.raises(ValueError):
+        profiler.options({"requests": "many"})
+    with pytest.raises(ValueError):
+        profiler.profile(seconds=0)
+    for interval in (0, -1, float("nan")):
+        with pytest.raises(ValueError):
+            profiler.profile(seconds=1, interval=interval)
+        with pytest.raises(ValueError):
+            profiler.profile(requests=1, interval=interval)
@@ -0,0 +1,91 @@
+import datetime
+
+import pytest
+
+from skinnywms import datatypes, errors
+
+from helpers import BASE, Field
+
+
+def at(step, elevation=None):
+    return Field("t", BASE + datetime.timedelta(hours=step), elevation)
+
+
+def make_layer(time_matching="nearest"):
+    layer = datatypes.DataLayer(at(0), time_matching)
+    for step in (6, 12, 24):
+        layer.add_field(at(step))
+    return layer
+
+
+def selected_step(layer, **dims):
+    field = layer.select(dims)
+    return (field.time - BASE) // datetime.timedelta(hours=1)
+
+
+def test_select_exact_and_default():
+    layer = make_layer()
+    assert selected_step(layer) == 0
+    assert selected_step(layer, time="2022-05-01T12:00:00Z") == 12
+    assert selected_step(layer, time="2022-05-01T12:00:00.000Z") == 12
+    assert selected_step(layer, time="2022-05-01T14:00:00+02:00") == 12
+
+
+def test_select_matching():
+    assert selected_step(make_layer("nearest"), time="2022-05-01T20:00:00Z") == 24
+    assert selected_step(make_layer("previous"), time="2022-05-01T20:00:00Z") == 12
+    assert selected_step(make_layer("next"), time="2022-05-01T07:00:00Z") == 12
+
+    with pytest.raises(errors.InvalidDimensionValue):
+        make_layer("exact").select({"time": "2022-05-01T07:00:00Z"})
+
+    with pytest.raises(errors.InvalidDimensionValue):
+        make_layer("next").select({"time": "2022-05-02T07:00:00Z"})
+
+
+def test_select_interval_and_current():
+    layer = make_layer()
+    assert selected_step(layer, time="2022-05-01T05:00:00Z/2022-05-01T13:00:00Z") == 12
+    assert selected_step(layer, time="2022-05-01T05:00:00Z/present") == 24
+    assert selected_step(layer, time="current") == 24
+
+    with pytest.raises(errors.InvalidDimensionValue):
+        layer.select({"time": "2022-05-01T13:00:00Z/2022-05-01T14:00:00Z"})
+
+    with pytest.raises(errors.InvalidDimensionValue):
+        layer.select({"time": "yesterday"})
+
+
+def test_select_dim_index():
+    layer = make_layer()
+    assert selected_step(layer, dim_index="2") == 12
+    assert selected_step(layer, dim_index="-1") == 24
+
+    with pytest.raises(errors.InvalidDimensionValue):
+        layer.select({"dim_index": "4"})
+
+
+def test_select_elevation():
+    layer = datatypes.DataLayer(at(0, 500))
+    layer.add_field(at(0, 850))
+    layer.add_field(at(6, 500))
+
+    assert layer.select({"elevation": "500"}).elevation == 500
+    assert layer.select({"elevation": "850.0"}).elevation == 850
+
+    with pytest.raises(errors.InvalidDimensionValue):
+        layer.select({"time": "2022-05-01T06:00:00Z", "elevation": "850"})
+
+
+def test_select_default_elevation():
+    layer = datatypes.DataLayer(at(0, 850))
+    for step, elevation in ((0, 500), (0, 250), (6, 500), (6, 850)):
+        layer.add_field(at(step, elevation))
+
+    assert layer.select({}).elevation == 850
+    assert layer.select({"time": "2022-05-01T00:00:00Z"}).elevation == 850
+    assert layer.select({"time": "2022-05-01T06:00:00Z"}).elevation == 500
+    assert layer.select({"dim_index": "1"}).elevation == 500
+    field = layer.select({"time": "2022-05-01T06:00:00Z", "elevation": "850"})
+    assert field.elevation == 850
+
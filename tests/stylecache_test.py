@@ -0,0 +1,63 @@
+import json
+
+from skinnywms.stylecache import StyleCache
+
+STYLES = [dict(name="sh_all_fM64t52i4", title="Temperature", description="")]
+
+
+def test_put_and_get(tmp_path):
+    path = str(tmp_path / "cache" / "styles.json")
+    identity = dict(paramId=130, levtype="pl", units="K")
+
+    cache = StyleCache(path, "4.16.0")
+    assert cache.get(identity) is None
+    cache.put(identity, STYLES)
+    assert cache.get(dict(identity)) == STYLES
+    assert StyleCache(path, "4.16.0").get(identity) is None
+
+    cache.save()
+    assert StyleCache(path, "4.16.0").get(identity) == STYLES
+    assert StyleCache(path, "4.17.0").get(identity) is None
+    assert cache.stats() == dict(name="styles", entries=1, hits=1, misses=1)
+
+
+def test_shared_between_processes(tmp_path):
+    path = str(tmp_path / "styles.json")
+    first = StyleCache(path, "4.16.0")
+    second = StyleCache(path, "4.16.0")
+
+    first.put(dict(paramId=130), STYLES)
+    first.save()
+    second.put(dict(paramId=167), STYLES)
+    second.put(dict(paramId=168), STYLES)
+    second.save()
+
+    with open(path) as f:
+        assert len(json.load(f)["styles"]) == 3
+
+
+def test_corrupted(tmp_path):
+    path = tmp_path / "styles.json"
+    path.write_text("{")
+    cache = StyleCache(str(path), "4.16.0")
+    assert cache.get(dict(paramId=130)) is None
+
+    cache.put(dict(paramId=130), STYLES)
+    cache.save()
+    assert StyleCache(str(path), "4.16.0").get(dict(paramId=130)) == STYLES
+
+
+def test_saved_once(tmp_path, monkeypatch):
+    path = tmp_path / "styles.json"
+    cache = StyleCache(str(path), "4.16.0")
+    writes = []
+    monkeypatch.setattr(
+        "skinnywms.jsonfile._write", lambda path, content: writes.append(content)
+    )
+
+    cache.save()
+    for param in (130, 167, 168):
+        cache.put(dict(paramId=param), STYLES)
+    cache.save()
+    cache.save()
+    assert [len(content["styles"]) for content in writes] == [3]
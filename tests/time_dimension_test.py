@@ -0,0 +1,45 @@
+import datetime
+
+from skinnywms import datatypes
+
+from helpers import BASE, Field
+
+
+def hours(*steps):
+    return [BASE + datetime.timedelta(hours=h) for h in steps]
+
+
+def test_time_dimension_extent():
+    dimension = datatypes.TimeDimension(hours(12, 0, 6, 18, 30, 42, 54, 60))
+
+    assert dimension.default == "2022-05-01T00:00:00Z"
+    assert dimension.extent == (
+        "2022-05-01T00:00:00Z/2022-05-01T18:00:00Z/PT6H,"
+        "2022-05-02T06:00:00Z/2022-05-03T06:00:00Z/PT12H,"
+        "2022-05-03T12:00:00Z"
+    )
+
+
+def test_time_dimension_short_runs():
+    assert datatypes.TimeDimension(hours(0)).extent == "2022-05-01T00:00:00Z"
+    assert datatypes.TimeDimension(hours(0, 6, 18)).extent == (
+        "2022-05-01T00:00:00Z,2022-05-01T06:00:00Z,2022-05-01T18:00:00Z"
+    )
+
+
+def test_data_layer_dimensions_are_incremental():
+    times = hours(*range(0, 240, 3))
+    layer = datatypes.DataLayer(Field(time=times[-1]))
+    for time in reversed(times[:-1]):
+        layer.add_field(Field(time=time))
+
+    dimensions = layer.dimensions
+    assert dimensions is layer.dimensions
+    assert dimensions[0].extent == datatypes.TimeDimension(times).extent
+    assert dimensions[0].extent == (
+        "2022-05-01T00:00:00Z/2022-05-10T21:00:00Z/PT3H"
+    )
+
+    layer.add_field(Field(time=datetime.datetime(2022, 5, 12)))
+    assert layer.dimensions is not dimensions
+    assert layer.dimensions[0].extent.endswith(",2022-05-12T00:00:00Z")